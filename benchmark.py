@@ -0,0 +1,387 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Benchmarks every source -> output projection pair on synthetic panoramas
+# and prints one JSON record per case. Each case runs in a fresh process so
+# its peak RSS is its own. With --startup it instead times how quickly the
+# command line starts and fails if that regresses, with --accuracy it
+# checks the float32 mapping against the float64 one, and with --changed it
+# times updating an output after a small edit of its source.
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import vrProjector
+
+PROJECTIONS = {
+  'Equirectangular': vrProjector.EquirectangularProjection,
+  'Cubemap': vrProjector.CubemapProjection,
+  'Fisheye': vrProjector.FisheyeProjection,
+  'SideBySideFisheye': vrProjector.SideBySideFisheyeProjection,
+  'Perspective': vrProjector.PerspectiveProjection,
+}
+
+FACES = ('front', 'right', 'back', 'left', 'top', 'bottom')
+
+# (width, height) of a projection's image[s] for a nominal width: cubemap
+# faces are a quarter of it, fisheyes are square and perspective views are
+# 16:9 at half of it
+def imageSize(projection, width):
+  if projection == 'Cubemap':
+    return (width//4, width//4)
+  if projection == 'Fisheye':
+    return (width//2, width//2)
+  if projection == 'Perspective':
+    return (width//2, width*9//32)
+  return (width, width//2)
+
+def outputPixels(projection, size):
+  return size[0]*size[1]*(6 if projection == 'Cubemap' else 1)
+
+def initProjection(projection, size):
+  out = PROJECTIONS[projection]()
+  if projection == 'Cubemap':
+    out.initImages(*size)
+  else:
+    out.initImage(*size)
+  return out
+
+def imageFiles(directory, projection, extension='png'):
+  if projection == 'Cubemap':
+    return [os.path.join(directory, '%s.%s' % (face, extension)) for face in FACES]
+  return [os.path.join(directory, '%s.%s' % (projection, extension))]
+
+# a synthetic equirectangular panorama: smooth colour ramps over a fine
+# checkerboard, so both the gathers and the filters see real detail
+def syntheticEquirectangular(width, height):
+  y, x = np.mgrid[0:height, 0:width]
+  checker = ((x//8 + y//8) % 2)*64
+  image = np.empty((height, width, 3), np.uint8)
+  image[..., 0] = (x*191//width + checker).astype(np.uint8)
+  image[..., 1] = (y*191//height + checker).astype(np.uint8)
+  image[..., 2] = ((x+y)*191//(width+height) + checker).astype(np.uint8)
+  return image
+
+# write a synthetic source of the given projection into directory, once
+def makeSource(directory, projection, width):
+  files = imageFiles(directory, projection)
+  if all(os.path.exists(f) for f in files):
+    return files
+  equirect = vrProjector.EquirectangularProjection()
+  equirect.image = syntheticEquirectangular(width, width//2)
+  equirect.imsize = (width, width//2)
+  equirect.set_angular_resolution()
+  source = initProjection(projection, imageSize(projection, width))
+  source.reprojectToThis(equirect)
+  if projection == 'Cubemap':
+    source.saveImages(*files)
+  else:
+    source.saveImage(files[0])
+  return files
+
+def runCase(case):
+  timings = {}
+  faceSeconds = {}
+  start = time.time()
+  source = PROJECTIONS[case['source']]()
+  if case['source'] == 'Cubemap':
+    faceSeconds['load'] = source.loadImages(*case['sourceFiles'])
+  else:
+    source.loadImage(case['sourceFiles'][0])
+  source.set_interpolation(case['interpolation'])
+  timings['load'] = time.time() - start
+
+  size = imageSize(case['output'], case['outWidth'])
+  out = initProjection(case['output'], size)
+  out.set_precision(case['precision'])
+  if case['mode'] == 'scalar':
+    timings['mapping'] = 0.0
+    start = time.time()
+    out.reprojectToThisScalar(source)
+    timings['sampling'] = time.time() - start
+  else:
+    start = time.time()
+    table = vrProjector.RemapTable.build(out, source)
+    timings['mapping'] = time.time() - start
+    start = time.time()
+    out.reprojectToThis(source, remapTable=table, workers=case['workers'])
+    timings['sampling'] = time.time() - start
+
+  start = time.time()
+  outFiles = imageFiles(case['outDir'], case['output'], case['outFormat'])
+  out.set_encoding(case['compression'], case['quality'])
+  if case['output'] == 'Cubemap':
+    faceSeconds['save'] = out.saveImages(*outFiles)
+  else:
+    out.saveImage(outFiles[0])
+  timings['save'] = time.time() - start
+
+  pixels = outputPixels(case['output'], size)
+  reproject = timings['mapping'] + timings['sampling']
+  return {
+    'source': case['source'],
+    'output': case['output'],
+    'sourceSize': list(source.imsize),
+    'outSize': list(size),
+    'interpolation': case['interpolation'],
+    'mode': case['mode'],
+    'precision': case['precision'],
+    'workers': case['workers'],
+    'outFormat': case['outFormat'],
+    'compression': case['compression'],
+    'quality': case['quality'],
+    'outputMegapixels': pixels/1e6,
+    'megapixelsPerSecond': pixels/1e6/reproject if reproject > 0 else None,
+    'seconds': timings,
+    'faceSeconds': faceSeconds,
+    'peakRssMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,
+  }
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+WRAPPER = os.path.join(REPOSITORY, 'vrProjectorWrapper.py')
+
+# modules the command line must not import before it has a job to run
+HEAVY_MODULES = ('numpy', 'PIL')
+
+# milliseconds the command line may take to start over a bare interpreter
+STARTUP_BUDGET_MS = 100
+
+# source texels the float32 mapping may be off from the float64 one
+ACCURACY_BUDGET = 0.01
+
+# keyword arguments running a subprocess against this checkout, whatever
+# the current directory
+def repositoryProcess():
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join([REPOSITORY] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+  return {'cwd': REPOSITORY, 'env': env}
+
+# best of repeats wall clock milliseconds to run a command to completion.
+# Raises CalledProcessError if it exits with anything but returncode, so a
+# command that fails early is never counted as fast
+def commandMilliseconds(command, repeats, returncode=0):
+  best = None
+  for _ in range(repeats):
+    start = time.time()
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **repositoryProcess())
+    elapsed = (time.time() - start)*1000
+    if result.returncode != returncode:
+      raise subprocess.CalledProcessError(result.returncode, command)
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+# heavy modules loaded by the time vrProjectorCmd --help has printed
+def helpImports():
+  script = ('import runpy, sys\n'
+            'sys.argv = [%r, "--help"]\n'
+            'try:\n'
+            '  runpy.run_path(%r, run_name="__main__")\n'
+            'except SystemExit as e:\n'
+            '  if e.code:\n'
+            '    raise\n'
+            'sys.stderr.write(" ".join(m for m in %r if m in sys.modules))\n') % (WRAPPER, WRAPPER, HEAVY_MODULES)
+  result = subprocess.run([sys.executable, '-c', script], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          check=True, universal_newlines=True, **repositoryProcess())
+  return result.stderr.split()
+
+# startup times of the command line and the package against a budget in
+# milliseconds over a bare interpreter; returns the record and whether it
+# passed
+def runStartup(budget, repeats):
+  baseline = commandMilliseconds([sys.executable, '-c', 'pass'], repeats)
+  record = {
+    'pythonMs': baseline,
+    'helpMs': commandMilliseconds([sys.executable, WRAPPER, '--help'], repeats),
+    # argparse exits with 2 on bad arguments
+    'badArgumentsMs': commandMilliseconds([sys.executable, WRAPPER, '--sourceProjection'], repeats, 2),
+    'importMs': commandMilliseconds([sys.executable, '-c', 'import vrProjector'], repeats),
+    'helpImports': helpImports(),
+    'budgetMs': budget,
+  }
+  slowest = max(record['helpMs'], record['badArgumentsMs'], record['importMs']) - baseline
+  record['passed'] = slowest <= budget and not record['helpImports']
+  return record
+
+# where the float32 direction mapping samples the source against the
+# float64 angle mapping, which is the one the scalar path computes per
+# pixel, for a rotated source so no pixel sits exactly on a texel edge.
+# Errors are distances in source texels; pixels the two put on different
+# cube faces or only one of them covers are counted rather than measured
+def runAccuracy(sourceName, outName, sourceWidth, outWidth, budget):
+  source = initProjection(sourceName, imageSize(sourceName, sourceWidth))
+  source.set_rotation(10, 5, 3)
+  out = initProjection(outName, imageSize(outName, outWidth))
+  u64, v64, face64 = out._map_rows(source, slice(None))[:3]
+  out.set_precision('float32')
+  u32, v32, face32 = out._map_rows(source, slice(None))[:3]
+  covered = np.isfinite(u64) & np.isfinite(v64)
+  same = covered & np.isfinite(u32) & np.isfinite(v32)
+  if face64 is not None:
+    same &= face64 == face32
+  width, height = source.imsize
+  dx, dy = source._texel_delta((u32[same] - u64[same])*width, (v32[same] - v64[same])*height)
+  error = np.hypot(dx, dy)
+  record = {
+    'source': sourceName,
+    'output': outName,
+    'sourceSize': list(source.imsize),
+    'outSize': list(out.imsize),
+    'maxTexelError': float(error.max()) if error.size else 0.0,
+    'meanTexelError': float(error.mean()) if error.size else 0.0,
+    'coverageChanges': int((covered != (np.isfinite(u32) & np.isfinite(v32))).sum()),
+    'faceChanges': 0 if face64 is None else int((covered & (face64 != face32)).sum()),
+    'budgetTexels': budget,
+  }
+  record['passed'] = record['maxTexelError'] <= budget
+  return record
+
+# reprojectToThisChanged after a size x size edit in the middle of the top
+# half of the source, against a full reprojectToThis of the edited source,
+# which it must match. The first update also builds the output's direction
+# index, so it is timed apart from a second edit
+def runChanged(sourceName, outName, sourceWidth, outWidth, interpolation, size, workers):
+  source = initProjection(sourceName, imageSize(sourceName, sourceWidth))
+  source.set_interpolation(interpolation)
+  images = [np.asarray(image) for image in source._images()]
+  rng = np.random.default_rng(0)
+  for image in images:
+    image[...] = rng.integers(0, 256, image.shape)
+  out = initProjection(outName, imageSize(outName, outWidth))
+  out.reprojectToThis(source, workers=workers)
+  full = initProjection(outName, imageSize(outName, outWidth))
+  start = time.time()
+  full.reprojectToThis(source, workers=workers)
+  fullSeconds = time.time() - start
+
+  width, height = source.imsize
+  record = {
+    'source': sourceName, 'output': outName, 'sourceSize': list(source.imsize), 'outSize': list(out.imsize),
+    'interpolation': interpolation, 'workers': workers, 'editSize': size, 'fullSeconds': fullSeconds,
+  }
+  for name, x0 in (('firstSeconds', width//2), ('seconds', width//2 + 2*size)):
+    rectangle = (x0, height//4, x0 + size, height//4 + size)
+    if sourceName == 'Cubemap':
+      rectangle = (0,) + rectangle
+    images[0][rectangle[-3]:rectangle[-1], rectangle[-4]:rectangle[-2]] ^= 0xff
+    start = time.time()
+    record['pixels'] = out.reprojectToThisChanged(source, [rectangle], workers=workers)
+    record[name] = time.time() - start
+  full.reprojectToThis(source, workers=workers)
+  record['speedup'] = fullSeconds/record['seconds']
+  record['passed'] = all(np.array_equal(a, b) for a, b in zip(out._images(), full._images()))
+  return record
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark reprojection between every pair of projections')
+  parser.add_argument('--sources', default=','.join(PROJECTIONS), help='comma separated source projections. Default: all')
+  parser.add_argument('--outputs', default=','.join(PROJECTIONS), help='comma separated output projections. Default: all')
+  parser.add_argument('--outWidths', default='512,2048', help='comma separated nominal output widths; cubemap faces are a quarter of it, fisheyes half of it square and perspective views half of it at 16:9')
+  parser.add_argument('--sourceWidth', type=int, default=2048, help='nominal width of the synthetic sources')
+  parser.add_argument('--interpolations', default='nearest,bilinear', help='comma separated interpolation modes')
+  parser.add_argument('--modes', default='vectorized,parallel', help='comma separated reprojection paths: scalar, vectorized, parallel')
+  parser.add_argument('--precisions', default='float64', help='comma separated mapping precisions: float64, float32')
+  parser.add_argument('--workers', type=int, default=0, help='worker threads for the parallel mode. 0 uses every core.')
+  parser.add_argument('--scalarMaxWidth', type=int, default=256, help='largest output width run through the slow scalar path')
+  parser.add_argument('--outFormat', default='png', help='extension of the output images: png, jpg, tif or npy; tif without --compression and npy are written uncompressed')
+  parser.add_argument('--compression', type=int, help='PNG zlib level 0-9, or for TIFFs 0 for uncompressed and above 0 for deflate')
+  parser.add_argument('--quality', type=int, help='JPEG quality 1-100')
+  parser.add_argument('--output', help='write the JSON records to this file instead of stdout')
+  parser.add_argument('--inline', action='store_true', help='run every case in this process; peak RSS then accumulates')
+  parser.add_argument('--startup', action='store_true', help='time --help, argument errors and import vrProjector instead, exiting nonzero if they exceed --startupBudget or load NumPy or Pillow')
+  parser.add_argument('--startupBudget', type=float, default=STARTUP_BUDGET_MS, help='milliseconds startup may take over a bare python interpreter')
+  parser.add_argument('--repeats', type=int, default=5, help='runs per startup timing; the fastest is reported')
+  parser.add_argument('--accuracy', action='store_true', help='compare the float32 mapping of every pair against the float64 one at the first of --outWidths instead, exiting nonzero if any is off by more than --accuracyBudget')
+  parser.add_argument('--accuracyBudget', type=float, default=ACCURACY_BUDGET, help='source texels the float32 mapping may be off by')
+  parser.add_argument('--changed', action='store_true', help='time reprojectToThisChanged after a --changedSize square edit of the source against a full pass for every pair and interpolation at the first of --outWidths instead, exiting nonzero if any result differs from the full pass')
+  parser.add_argument('--changedSize', type=int, default=64, help='edge of the square source edit in pixels')
+  parser.add_argument('--case', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.startup:
+    record = runStartup(args.startupBudget, args.repeats)
+    print(json.dumps(record, indent=2))
+    if not record['passed']:
+      sys.exit(1)
+    return
+
+  if args.accuracy:
+    outWidth = int(args.outWidths.split(',')[0])
+    records = [runAccuracy(sourceName, outName, args.sourceWidth, outWidth, args.accuracyBudget)
+               for sourceName in args.sources.split(',') for outName in args.outputs.split(',')]
+    print(json.dumps(records, indent=2))
+    if not all(record['passed'] for record in records):
+      sys.exit(1)
+    return
+
+  if args.changed:
+    outWidth = int(args.outWidths.split(',')[0])
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    records = [runChanged(sourceName, outName, args.sourceWidth, outWidth, interpolation, args.changedSize, workers)
+               for sourceName in args.sources.split(',') for outName in args.outputs.split(',')
+               for interpolation in args.interpolations.split(',')]
+    print(json.dumps(records, indent=2))
+    if not all(record['passed'] for record in records):
+      sys.exit(1)
+    return
+
+  if args.case is not None:
+    print(json.dumps(runCase(json.loads(args.case))))
+    return
+
+  workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+  # sources and outputs are written to a scratch directory removed at the end
+  with tempfile.TemporaryDirectory(prefix='vrProjector-benchmark-') as workdir:
+    records = []
+    for sourceName in args.sources.split(','):
+      sourceFiles = makeSource(workdir, sourceName, args.sourceWidth)
+      for outName in args.outputs.split(','):
+        for outWidth in [int(w) for w in args.outWidths.split(',')]:
+          for interpolation in args.interpolations.split(','):
+            for mode in args.modes.split(','):
+              if mode == 'scalar' and outWidth > args.scalarMaxWidth:
+                continue
+              # the scalar path always works in float64
+              for precision in (args.precisions.split(',') if mode != 'scalar' else ['float64']):
+                case = {
+                  'source': sourceName, 'sourceFiles': sourceFiles,
+                  'output': outName, 'outWidth': outWidth, 'outDir': workdir,
+                  'interpolation': interpolation, 'mode': mode, 'precision': precision,
+                  'workers': workers if mode == 'parallel' else 1,
+                  'outFormat': args.outFormat, 'compression': args.compression, 'quality': args.quality,
+                }
+                if args.inline:
+                  record = runCase(case)
+                else:
+                  result = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)],
+                                          stdout=subprocess.PIPE, check=True, universal_newlines=True)
+                  record = json.loads(result.stdout)
+                records.append(record)
+                sys.stderr.write('%s -> %s %dx%d %s %s %s: %.1f MP/s\n' % (record['source'], record['output'],
+                  record['outSize'][0], record['outSize'][1], interpolation, mode, precision, record['megapixelsPerSecond'] or 0.0))
+
+  output = json.dumps(records, indent=2)
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      f.write(output + '\n')
+  else:
+    print(output)
+
+if __name__ == "__main__":
+    main()
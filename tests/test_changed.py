@@ -0,0 +1,71 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+import vrProjector
+
+IMAGES = os.path.join(REPOSITORY, 'images')
+FACE_FILES = [os.path.join(IMAGES, '%s.png' % face) for face in ('front', 'right', 'back', 'left', 'top', 'bottom')]
+
+# The retouch workflow of the README: load a source from an image file,
+# reproject it, edit a region of the source in place and update the output
+# with reprojectToThisChanged, which must match a full reprojectToThis of
+# the edited source
+class ChangedTest(unittest.TestCase):
+  def output(self, name):
+    if name == 'Cubemap':
+      out = vrProjector.CubemapProjection()
+      out.initImages(96, 96, None, 3)
+    else:
+      out = getattr(vrProjector, name + 'Projection')()
+      out.initImage(192, 96 if name != 'Fisheye' else 192, None, 3)
+    return out
+
+  def check(self, source, out, rectangles, edit):
+    out.reprojectToThis(source)
+    edit()
+    changed = out.reprojectToThisChanged(source, rectangles)
+    self.assertGreater(changed, 0)
+    updated = [image.copy() for image in out._images()]
+    for image in out._images():
+      image[...] = 0
+    out.reprojectToThis(source)
+    for image, expected in zip(updated, out._images()):
+      np.testing.assert_array_equal(image, expected)
+
+  def test_equirectangular_file(self):
+    for outName in ('Equirectangular', 'Cubemap', 'Fisheye', 'SideBySideFisheye', 'Perspective'):
+      for interpolation in ('nearest', 'bilinear', 'bicubic'):
+        with self.subTest(output=outName, interpolation=interpolation):
+          source = vrProjector.EquirectangularProjection()
+          source.loadImage(os.path.join(IMAGES, 'equirectangular.png'))
+          source.set_interpolation(interpolation)
+          def edit():
+            source.image[400:460, 1000:1100] = 255 - source.image[400:460, 1000:1100]
+          self.check(source, self.output(outName), [(1000, 400, 1100, 460)], edit)
+
+  def test_cubemap_files(self):
+    source = vrProjector.CubemapProjection()
+    source.loadImages(*FACE_FILES)
+    source.set_interpolation('bilinear')
+    def edit():
+      source.faces[4, 100:180, 500:620] = 0
+    self.check(source, self.output('Equirectangular'), [(4, 500, 100, 620, 180)], edit)
+
+if __name__ == '__main__':
+  unittest.main()
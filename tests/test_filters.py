@@ -0,0 +1,131 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vrProjector
+
+WIDTH = 64
+HEIGHT = 32
+
+class FilterTest(unittest.TestCase):
+  def equirectangular(self, interpolation):
+    source = vrProjector.EquirectangularProjection()
+    source.initImage(WIDTH, HEIGHT, None, 3)
+    source.image[...] = np.random.default_rng(0).integers(0, 256, source.image.shape)
+    # row 0 is the north pole, a single point
+    source.image[0] = source.image[0, 0]
+    source.set_interpolation(interpolation)
+    return source
+
+  # texel i sits at v = i/height, so a tap past a pole is the texel as far
+  # the other side of it on the opposite meridian: samples d texels over the
+  # north pole (row 0) match those d texels below it half way round, and
+  # likewise about the south pole at v = 1
+  def test_pole_rows(self):
+    u = np.arange(WIDTH)/float(WIDTH)
+    opposite = (u + 0.5) % 1.0
+    for interpolation in ('bilinear', 'bicubic', 'lanczos'):
+      source = self.equirectangular(interpolation)
+      for d in (0.25, 1.25, 2.5):
+        with self.subTest(interpolation=interpolation, pole='north', d=d):
+          over = source.sample_array(u, np.full(WIDTH, -d/HEIGHT), None)
+          under = source.sample_array(opposite, np.full(WIDTH, d/HEIGHT), None)
+          np.testing.assert_allclose(over, under, atol=1)
+    # the south pole itself is not a row of the image, so just bilinear,
+    # whose taps d texels from it never reach it, is exact there
+    source = self.equirectangular('bilinear')
+    for d in (1.25, 2.5):
+      with self.subTest(interpolation='bilinear', pole='south', d=d):
+        over = source.sample_array(u, np.full(WIDTH, (HEIGHT+d)/HEIGHT), None)
+        under = source.sample_array(opposite, np.full(WIDTH, (HEIGHT-d)/HEIGHT), None)
+        np.testing.assert_array_equal(over, under)
+
+  # random texture coordinates, with some on every edge so footprints
+  # that cross it are wrapped
+  def texcoords(self, count=4000):
+    rng = np.random.default_rng(1)
+    u = rng.random(count)
+    v = rng.random(count)
+    u[:count//8] = rng.choice((0.0, 0.999), count//8)
+    v[count//8:count//4] = rng.choice((0.0, 0.999), count//8)
+    return u, v
+
+  def cubemap(self, layout=None, dtype=np.uint8):
+    source = vrProjector.CubemapProjection()
+    source.initImages(24, 24, layout, 3, dtype)
+    for image in source._images():
+      image[...] = np.random.default_rng(2).integers(0, 256, image.shape)
+    return source
+
+  # uint8 images are blended in fixed point, within one level of the same
+  # image blended in floating point
+  def test_fixed_point(self):
+    u, v = self.texcoords()
+    face = np.random.default_rng(3).integers(0, 6, u.size).astype(np.int8)
+    for interpolation in ('bilinear', 'bicubic', 'lanczos'):
+      for name in ('Equirectangular', 'Cubemap'):
+        with self.subTest(interpolation=interpolation, source=name):
+          if name == 'Cubemap':
+            source = self.cubemap()
+            exact = self.cubemap(dtype=np.float32)
+            exact.faces[...] = source.faces
+          else:
+            source = self.equirectangular(interpolation)
+            exact = vrProjector.EquirectangularProjection()
+            exact.setImage(source.image.astype(np.float32))
+          source.set_interpolation(interpolation)
+          exact.set_interpolation(interpolation)
+          sampleFace = face if name == 'Cubemap' else None
+          pixels = source.sample_array(u, v, sampleFace).astype(int)
+          expected = np.clip(np.rint(exact.sample_array(u, v, sampleFace)), 0, 255)
+          self.assertLessEqual(np.abs(pixels - expected).max(), 1)
+
+  def test_flat_stays_flat(self):
+    u, v = self.texcoords()
+    for interpolation in ('bilinear', 'bicubic', 'lanczos'):
+      with self.subTest(interpolation=interpolation):
+        source = self.equirectangular(interpolation)
+        source.image[...] = (17, 128, 254)
+        np.testing.assert_array_equal(source.sample_array(u, v, None), np.broadcast_to((17, 128, 254), (u.size, 3)))
+
+  # images that are views of a larger one, such as the eyes of a side by
+  # side stereo frame or the faces of a packed cubemap, sample as a copy of
+  # them would
+  def test_views(self):
+    u, v = self.texcoords()
+    for interpolation in ('bilinear', 'bicubic'):
+      with self.subTest(interpolation=interpolation, source='sidebyside'):
+        stereo = vrProjector.StereoEquirectangularProjection('sidebyside')
+        stereo.initImage(WIDTH, HEIGHT, None, 3)
+        stereo.packed[...] = np.random.default_rng(4).integers(0, 256, stereo.packed.shape)
+        stereo.set_interpolation(interpolation)
+        copy = vrProjector.EquirectangularProjection()
+        copy.setImage(stereo.eyes[1].copy())
+        copy.set_interpolation(interpolation)
+        np.testing.assert_array_equal(stereo.eye(1).sample_array(u, v, None), copy.sample_array(u, v, None))
+      with self.subTest(interpolation=interpolation, source='cross'):
+        face = np.random.default_rng(3).integers(0, 6, u.size).astype(np.int8)
+        packed = self.cubemap('cross')
+        stacked = self.cubemap()
+        for view, image in zip(packed.faces, stacked.faces):
+          view[...] = image
+        packed.set_interpolation(interpolation)
+        stacked.set_interpolation(interpolation)
+        np.testing.assert_array_equal(packed.sample_array(u, v, face), stacked.sample_array(u, v, face))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,74 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vrProjector.AbstractProjection import AbstractProjection, _tifffile
+
+# Saved images keep their pixel type wherever the format can hold it, and
+# warn where it cannot
+class FormatsTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.rng = np.random.default_rng(0)
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def path(self, name):
+    return os.path.join(self.directory.name, name)
+
+  def roundTrip(self, image, name, **encoding):
+    AbstractProjection._saveImage(image, (image.shape[1], image.shape[0]), self.path(name), **encoding)
+    return AbstractProjection._loadImage(self.path(name))[0]
+
+  def test_png_keeps_16_bits(self):
+    for channels in (1, 2, 3, 4):
+      for compression in (None, 0, 9):
+        with self.subTest(channels=channels, compression=compression):
+          image = self.rng.integers(0, 65536, (37, 53, channels)).astype(np.uint16)
+          with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            loaded = self.roundTrip(image, 'image.png', compression=compression)
+          self.assertEqual(loaded.dtype, np.uint16)
+          np.testing.assert_array_equal(loaded, image)
+
+  def test_float_png_is_16_bit(self):
+    image = self.rng.random((20, 30, 3)).astype(np.float32)
+    loaded = self.roundTrip(image, 'image.png')
+    self.assertEqual(loaded.dtype, np.uint16)
+    self.assertLess(np.abs(loaded/65535.0 - image).max(), 1.0/65535)
+
+  def test_8_bit_png_is_silent(self):
+    image = self.rng.integers(0, 256, (8, 8, 4)).astype(np.uint8)
+    with warnings.catch_warnings():
+      warnings.simplefilter('error')
+      np.testing.assert_array_equal(self.roundTrip(image, 'image.png'), image)
+
+  def test_jpeg_warns_before_dropping_bits(self):
+    image = self.rng.integers(0, 65536, (8, 8, 3)).astype(np.uint16)
+    with self.assertWarns(UserWarning):
+      AbstractProjection._saveImage(image, (8, 8), self.path('image.jpg'))
+
+  @unittest.skipIf(_tifffile() is None, 'tifffile is not installed')
+  def test_grey_alpha_tiff_keeps_alpha(self):
+    image = self.rng.integers(0, 65536, (8, 8, 2)).astype(np.uint16)
+    np.testing.assert_array_equal(self.roundTrip(image, 'image.tif'), image)
+
+if __name__ == '__main__':
+  unittest.main()
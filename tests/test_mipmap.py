@@ -0,0 +1,77 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vrProjector
+from vrProjector.AbstractProjection import downsample
+
+# mip levels are built a band of rows at a time, so memory-mapped sources
+# are never read in whole and maxMemory holds while they are built
+class MipmapTest(unittest.TestCase):
+  def setUp(self):
+    self.workdir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.workdir.cleanup)
+
+  # an odd sized source, so bands of every level have edges to pad
+  def image(self):
+    return np.random.default_rng(0).integers(0, 256, (301, 603, 3)).astype(np.uint8)
+
+  def mapped(self, image):
+    filename = os.path.join(self.workdir.name, 'source.npy')
+    np.save(filename, image)
+    source = vrProjector.EquirectangularProjection()
+    source.loadImage(filename)
+    return source
+
+  def test_bands_match_single_pass(self):
+    image = self.image()
+    for maxMemory in (None, 1, 64*1024):
+      with self.subTest(maxMemory=maxMemory):
+        source = vrProjector.EquirectangularProjection()
+        source.setImage(image)
+        source.set_mipmap(True)
+        expected = image
+        for level in source._mip_levels(maxMemory)[1:]:
+          expected = downsample(expected)
+          np.testing.assert_array_equal(level.image, expected)
+        self.assertEqual(min(expected.shape[:2]), 1)
+
+  def test_mapped_levels(self):
+    source = self.mapped(self.image())
+    source.set_mipmap(True)
+    levels = source._mip_levels(64*1024)
+    self.assertTrue(all(isinstance(level.image, np.memmap) for level in levels))
+
+  # a memory-mapped source reprojected within maxMemory gives the same
+  # pixels as one in memory
+  def test_reproject_within_max_memory(self):
+    image = self.image()
+    inMemory = vrProjector.EquirectangularProjection()
+    inMemory.setImage(image)
+    outputs = []
+    for source in (self.mapped(image), inMemory):
+      source.set_mipmap(True)
+      source.set_interpolation('bilinear')
+      out = vrProjector.CubemapProjection()
+      out.initImages(32, 32, None, 3)
+      out.reprojectToThis(source, maxMemory=256*1024)
+      outputs.append(out.faces)
+    np.testing.assert_array_equal(outputs[0], outputs[1])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,35 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark
+
+# The float32 direction mapping must land within ACCURACY_BUDGET source
+# texels of the float64 angle mapping for every pair of projections. Errors
+# grow with the source size, so the source is a large one
+class PrecisionTest(unittest.TestCase):
+  SOURCE_WIDTH = 8192
+  OUT_WIDTH = 512
+
+  def test_float32_within_budget(self):
+    for sourceName in benchmark.PROJECTIONS:
+      for outName in benchmark.PROJECTIONS:
+        with self.subTest(source=sourceName, output=outName):
+          record = benchmark.runAccuracy(sourceName, outName, self.SOURCE_WIDTH, self.OUT_WIDTH, benchmark.ACCURACY_BUDGET)
+          self.assertLessEqual(record['maxTexelError'], benchmark.ACCURACY_BUDGET, record)
+          self.assertTrue(record['passed'], record)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,91 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vrProjector
+
+PROJECTIONS = ('Equirectangular', 'StereoEquirectangular', 'Cubemap', 'Fisheye', 'SideBySideFisheye', 'Perspective')
+
+# reprojectToThis must give the same pixels as the per-pixel
+# reprojectToThisScalar for every pair of projections, including where
+# samples fall exactly on texel and cube edges and where the source has no
+# sample
+class ScalarTest(unittest.TestCase):
+  def projection(self, name, height, channels, dtype=np.uint8):
+    projection = getattr(vrProjector, name + 'Projection')()
+    if name == 'Cubemap':
+      projection.initImages(height, height, None, channels, dtype)
+    else:
+      projection.initImage(2*height if name != 'Fisheye' else height, height, None, channels, dtype)
+    return projection
+
+  def source(self, name, channels, dtype=np.uint8):
+    source = self.projection(name, 64, channels, dtype)
+    rng = np.random.default_rng(len(name))
+    for image in source._images():
+      image[...] = rng.integers(1, 255, image.shape)
+    return source
+
+  def check(self, source, outName, height, channels, dtype=np.uint8):
+    vectorized = self.projection(outName, height, channels, dtype)
+    scalar = self.projection(outName, height, channels, dtype)
+    vectorized.reprojectToThis(source)
+    scalar.reprojectToThisScalar(source)
+    for image, expected in zip(vectorized._images(), scalar._images()):
+      np.testing.assert_array_equal(image, expected)
+
+  def test_every_pair(self):
+    for sourceName in PROJECTIONS:
+      source = self.source(sourceName, 3)
+      for outName in PROJECTIONS:
+        with self.subTest(source=sourceName, output=outName):
+          # the same size as the source, so samples land on texel edges
+          self.check(source, outName, 64, 3)
+
+  # sources with alpha keep it transparent where they have no sample, and
+  # outputs that add alpha make it opaque wherever the source has a sample
+  def test_alpha(self):
+    for sourceName in PROJECTIONS:
+      for channels in (1, 4):
+        source = self.source(sourceName, channels, np.uint16)
+        for outName in PROJECTIONS:
+          with self.subTest(source=sourceName, output=outName, channels=channels):
+            self.check(source, outName, 32, 4, np.uint16)
+
+  # the face and face-local coordinates of directions on cube edges and
+  # corners, where the dominant axis is a tie, and with signed zeros
+  def test_cubemap_face_lookup(self):
+    values = (-1.0, -0.5, -0.3, -0.0, 0.0, 0.3, 0.5, 1.0)
+    directions = [d for d in itertools.product(values, repeat=3) if any(d)]
+    directions = np.concatenate([directions, np.random.default_rng(0).normal(size=(5000, 3))])
+    x, y, z = (np.ascontiguousarray(c) for c in directions.T)
+    u, v, face = vrProjector.CubemapProjection()._texcoord_from_direction(x, y, z)
+    expected = np.array([vrProjector.CubemapProjection._face_texcoord(*d) for d in directions])
+    np.testing.assert_array_equal(u, expected[:, 0])
+    np.testing.assert_array_equal(v, expected[:, 1])
+    np.testing.assert_array_equal(face, expected[:, 2])
+
+  def test_rotation(self):
+    for sourceName in PROJECTIONS:
+      source = self.source(sourceName, 3)
+      source.set_rotation(30, 20, 10)
+      with self.subTest(source=sourceName):
+        self.check(source, 'Equirectangular', 32, 3)
+
+if __name__ == '__main__':
+  unittest.main()
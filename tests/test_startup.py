@@ -0,0 +1,41 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark
+
+# The command line and the package must start without NumPy or Pillow, which
+# are only imported once there is a job to run
+class StartupTest(unittest.TestCase):
+  def test_help_does_not_import_heavy_modules(self):
+    self.assertEqual(benchmark.helpImports(), [])
+
+  def test_import_does_not_import_heavy_modules(self):
+    script = 'import sys, vrProjector; sys.stdout.write(" ".join(m for m in %r if m in sys.modules))' % (benchmark.HEAVY_MODULES,)
+    result = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE, check=True, universal_newlines=True,
+                            **benchmark.repositoryProcess())
+    self.assertEqual(result.stdout.split(), [])
+
+  def test_classes_load_on_first_use(self):
+    script = 'import vrProjector.RemapTable, vrProjector; assert isinstance(vrProjector.RemapTable, type); assert isinstance(vrProjector.CubemapProjection, type)'
+    subprocess.run([sys.executable, '-c', script], check=True, **benchmark.repositoryProcess())
+
+  def test_startup_within_budget(self):
+    record = benchmark.runStartup(benchmark.STARTUP_BUDGET_MS, 3)
+    self.assertTrue(record['passed'], record)
+
+if __name__ == '__main__':
+  unittest.main()
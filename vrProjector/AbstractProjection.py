@@ -11,22 +11,447 @@
 
 
 # imports
-from PIL import Image
+import copy
 import math
 import abc
+import os
+import struct
+import tempfile
+import warnings
+import zlib
 import numpy as np
 
-from multiprocessing.dummy import Pool as ThreadPool
+from .Profiler import span
+
+# Pillow is only needed to decode and encode image files, and the thread
+# pool only for parallel reprojection, so both are imported on first use
+def _pil():
+  from PIL import Image
+  return Image
+
+# tifffile is optional; without it TIFFs go through Pillow, which only
+# handles 8-bit colour, 16-bit grey and float grey TIFFs
+def _tifffile():
+  try:
+    import tifffile
+  except ImportError:
+    return None
+  return tifffile
+
+# PNG colour types by band count
+PNG_COLOUR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+# rows filtered and compressed at a time when writing a 16-bit PNG
+PNG_BAND_ROWS = 256
+
+def _png_chunk(kind, data):
+  return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+# write a uint16 (h, w, channels) image as a 16-bit PNG, which Pillow can
+# only do for grey. Rows are Paeth filtered, or left unfiltered at level 0,
+# and compressed a band at a time so the working memory stays small
+def _write_png16(destFile, img, level=None):
+  height, width, channels = img.shape
+  bpp = 2*channels
+  compressor = zlib.compressobj(6 if level is None else level)
+  with open(destFile, 'wb') as f:
+    f.write(b'\x89PNG\r\n\x1a\n')
+    f.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 16, PNG_COLOUR_TYPES[channels], 0, 0, 0)))
+    above = np.zeros((1, width*bpp), np.int16)
+    for start in range(0, height, PNG_BAND_ROWS):
+      rows = np.ascontiguousarray(img[start:start+PNG_BAND_ROWS], '>u2').view(np.uint8).reshape(-1, width*bpp)
+      if level == 0:
+        filtered, kind = rows, 0
+      else:
+        x = rows.astype(np.int16)
+        b = np.concatenate((above, x[:-1]))
+        a = np.zeros_like(x)
+        a[:, bpp:] = x[:, :-bpp]
+        c = np.zeros_like(x)
+        c[:, bpp:] = b[:, :-bpp]
+        pa, pb, pc = np.abs(b - c), np.abs(a - c), np.abs(a + b - 2*c)
+        predictor = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+        filtered, kind = ((x - predictor) & 0xff).astype(np.uint8), 4
+        above = x[-1:]
+      lines = np.empty((filtered.shape[0], filtered.shape[1] + 1), np.uint8)
+      lines[:, 0] = kind
+      lines[:, 1:] = filtered
+      data = compressor.compress(lines.tobytes())
+      if data:
+        f.write(_png_chunk(b'IDAT', data))
+    f.write(_png_chunk(b'IDAT', compressor.flush()))
+    f.write(_png_chunk(b'IEND', b''))
+
+# pixel types images are worked on in, end to end
+DTYPES = (np.dtype(np.uint8), np.dtype(np.uint16), np.dtype(np.float32))
+
+def _check_dtype(dtype, what='Image'):
+  dtype = np.dtype(dtype)
+  if dtype not in DTYPES:
+    raise ValueError('%s has unsupported pixel type %s, valid types are: %s' % (what, dtype, ', '.join(str(d) for d in DTYPES)))
+  return dtype
+
+# value of full brightness and of an opaque alpha channel: the largest
+# integer, or 1.0 for floats
+def full_scale(dtype):
+  dtype = np.dtype(dtype)
+  if np.issubdtype(dtype, np.integer):
+    return np.iinfo(dtype).max
+  return 1.0
+
+# pixels as dtype, rescaled so full_scale maps to full_scale; floats are
+# clipped to 0..1 on the way to integers
+def convert_dtype(pixels, dtype):
+  dtype = np.dtype(dtype)
+  if pixels.dtype == dtype:
+    return pixels
+  if np.issubdtype(dtype, np.floating):
+    out = pixels.astype(dtype)
+    if np.issubdtype(pixels.dtype, np.integer):
+      out *= 1.0/np.iinfo(pixels.dtype).max
+    return out
+  scale = np.iinfo(dtype).max
+  if np.issubdtype(pixels.dtype, np.integer):
+    # uint8 <-> uint16 rounds to the nearest step, and is exact upwards
+    source = np.iinfo(pixels.dtype).max
+    out = pixels.astype(np.uint32)
+    out *= scale
+    out += source//2
+    out //= source
+    return out.astype(dtype)
+  out = np.nan_to_num(pixels.astype(np.float32), nan=0.0)
+  out *= scale
+  np.clip(np.rint(out, out=out), 0, scale, out=out)
+  return out.astype(dtype)
+
+# pixels with channels bands. Grey (1, 2 bands) and colour (3, 4 bands)
+# images convert into each other, grey by Rec. 601 luma like Pillow's
+# "L" mode, and alpha is added as opaque or dropped; other band counts
+# are padded with full_scale or cut off
+def convert_channels(pixels, channels):
+  have = pixels.shape[-1]
+  if have == channels:
+    return pixels
+  if not (1 <= have <= 4 and 1 <= channels <= 4):
+    if have > channels:
+      return pixels[..., :channels]
+    pad = np.full(pixels.shape[:-1] + (channels-have,), full_scale(pixels.dtype), pixels.dtype)
+    return np.concatenate((pixels, pad), axis=-1)
+  colour = pixels[..., :1 if have < 3 else 3]
+  wanted = 1 if channels < 3 else 3
+  if colour.shape[-1] < wanted:
+    colour = np.repeat(colour, wanted, axis=-1)
+  elif colour.shape[-1] > wanted:
+    luma = colour.dot(np.array((0.299, 0.587, 0.114), np.float32))[..., np.newaxis]
+    colour = luma.astype(pixels.dtype) if np.issubdtype(pixels.dtype, np.floating) else convert_dtype(luma/full_scale(pixels.dtype), pixels.dtype)
+  if channels not in (2, 4):
+    return np.ascontiguousarray(colour)
+  if have in (2, 4):
+    alpha = pixels[..., -1:]
+  else:
+    alpha = np.full(pixels.shape[:-1] + (1,), full_scale(pixels.dtype), pixels.dtype)
+  return np.concatenate((colour, alpha), axis=-1)
+
+# reconstruction filters for texel-space sampling: (radius in texels, kernel)
+def _linear_kernel(t):
+  return np.maximum(0.0, 1.0-np.abs(t))
+
+def _cubic_kernel(t, a=-0.5):
+  t = np.abs(t)
+  near = ((a+2.0)*t - (a+3.0))*t*t + 1.0
+  far = ((a*t - 5.0*a)*t + 8.0*a)*t - 4.0*a
+  return np.where(t <= 1.0, near, np.where(t < 2.0, far, 0.0))
+
+def _lanczos_kernel(t, a=3.0):
+  return np.where(np.abs(t) < a, np.sinc(t)*np.sinc(t/a), 0.0)
+
+FILTERS = {
+  'nearest': (0, None),
+  'bilinear': (1, _linear_kernel),
+  'bicubic': (2, _cubic_kernel),
+  'lanczos': (3, _lanczos_kernel),
+}
+
+# fractional bits of the fixed point weights uint8 images are filtered with,
+# in each direction. The positive lobes of a lanczos footprint over texels
+# of 255 come to 84% of the int32 range, the most any filter reaches
+FILTER_BITS = 11
+
+# coordinate types the mapping from output pixels to source texels can be
+# worked out in: float64 goes through angles, float32 through unit direction
+# vectors, which skips the trigonometry in between and needs half the memory
+PRECISIONS = {
+  'float64': np.float64,
+  'float32': np.float32,
+}
+
+# 2x2 area average of (..., height, width, channels) images, rounding to
+# the nearest value; odd edges are padded by repeating the last row/column
+def downsample(images):
+  height, width = images.shape[-3:-1]
+  if height % 2 or width % 2:
+    pad = ((0, 0),)*(images.ndim-3) + ((0, height % 2), (0, width % 2), (0, 0))
+    images = np.pad(images, pad, mode='edge')
+  integer = np.issubdtype(images.dtype, np.integer)
+  total = images[..., 0::2, 0::2, :].astype(np.uint32 if integer else np.float32)
+  total += images[..., 1::2, 0::2, :]
+  total += images[..., 0::2, 1::2, :]
+  total += images[..., 1::2, 1::2, :]
+  if integer:
+    total += 2
+    total //= 4
+  else:
+    total /= 4
+  return total.astype(images.dtype)
+
+# rows of a mip level downsampled at a time when there is no maxMemory to
+# size the bands from
+MIP_BAND_ROWS = 256
+
+# changed masks for every mip level of a source: each level marks a texel
+# changed if any of the texels it averages is, padded like downsample
+def changed_levels(changed, levels):
+  masks = [changed]
+  while len(masks) < levels:
+    mask = masks[-1]
+    height, width = mask.shape[-2:]
+    if height % 2 or width % 2:
+      mask = np.pad(mask, ((0, 0),)*(mask.ndim-2) + ((0, height % 2), (0, width % 2)), mode='edge')
+    masks.append(mask[..., 0::2, 0::2] | mask[..., 1::2, 0::2] | mask[..., 0::2, 1::2] | mask[..., 1::2, 1::2])
+  return masks
+
+# rotation matrix of a camera turned yaw degrees right, pitch degrees up and
+# roll degrees clockwise from looking along +x with +z down
+def rotation_matrix(yaw=0.0, pitch=0.0, roll=0.0):
+  yaw, pitch, roll = (math.radians(a) for a in (yaw, pitch, roll))
+  cy, sy = math.cos(yaw), math.sin(yaw)
+  cp, sp = math.cos(pitch), math.sin(pitch)
+  cr, sr = math.cos(roll), math.sin(roll)
+  rz = np.array(((cy, -sy, 0), (sy, cy, 0), (0, 0, 1)))
+  ry = np.array(((cp, 0, sp), (0, 1, 0), (-sp, 0, cp)))
+  rx = np.array(((1, 0, 0), (0, cr, -sr), (0, sr, cr)))
+  return rz.dot(ry).dot(rx)
+
+# rotation matrix of the quaternion w + xi + yj + zk, normalised first
+def quaternion_matrix(w, x, y, z):
+  n = math.sqrt(w*w + x*x + y*y + z*z)
+  if n == 0:
+    raise ValueError('Zero quaternion has no rotation')
+  w, x, y, z = w/n, x/n, y/n, z/n
+  return np.array((
+    (1-2*(y*y+z*z), 2*(x*y-w*z), 2*(x*z+w*y)),
+    (2*(x*y+w*z), 1-2*(x*x+z*z), 2*(y*z-w*x)),
+    (2*(x*z-w*y), 2*(y*z+w*x), 1-2*(x*x+y*y)),
+  ))
 
 class AbstractProjection:
   __metaclass__ = abc.ABCMeta
 
+  # True for projections whose image is only partly covered by the sphere;
+  # their valid_mask is exported as alpha
+  MASKED = False
+
   def __init__(self):
-    self.use_bilinear = False
+    self.interpolation = 'nearest'
+    self.rotation = None
+    self.mipmap = False
+    self._mips = None
+    self.precision = 'float64'
+    self.compression = None
+    self.quality = None
     pass
 
   def set_use_bilinear(self, val):
-    self.use_bilinear = val
+    self.set_interpolation('bilinear' if val else 'nearest')
+
+  @property
+  def use_bilinear(self):
+    return self.interpolation != 'nearest'
+
+  # one of FILTERS: nearest, bilinear, bicubic or lanczos
+  def set_interpolation(self, mode):
+    if mode not in FILTERS:
+      raise ValueError('Unsupported interpolation %s, valid values are: %s' % (mode, ', '.join(sorted(FILTERS))))
+    self.interpolation = mode
+
+  # one of PRECISIONS, for this projection as the output: the type its
+  # reprojections work out where every output pixel samples the source in
+  def set_precision(self, precision):
+    if precision not in PRECISIONS:
+      raise ValueError('Unsupported precision %s, valid values are: %s' % (precision, ', '.join(sorted(PRECISIONS))))
+    self.precision = precision
+
+  # how saveImage encodes: compression is the PNG level, 0 (stored, fastest)
+  # to 9 (smallest), and for TIFFs the deflate level, 0 leaving them
+  # uncompressed; quality, 1 to 100, is that of JPEG and WebP images. None
+  # keeps each format's default. .npy images are never compressed
+  def set_encoding(self, compression=None, quality=None):
+    if compression is not None and not 0 <= int(compression) <= 9:
+      raise ValueError('Compression levels are 0 to 9, got %s' % compression)
+    if quality is not None and not 1 <= int(quality) <= 100:
+      raise ValueError('Quality is 1 to 100, got %s' % quality)
+    self.compression = None if compression is None else int(compression)
+    self.quality = None if quality is None else int(quality)
+
+  # set_encoding as keyword arguments of _saveImage
+  def _encoding(self):
+    return {'compression': self.compression, 'quality': self.quality}
+
+  # with mipmapping on, every output pixel is sampled from the level of a mip
+  # pyramid of the source whose texels match its footprint, so shrinking a
+  # large source does not alias. The pyramid is built on first use and
+  # again whenever the image is replaced; call set_mipmap again after
+  # changing the image in place
+  def set_mipmap(self, val):
+    self.mipmap = bool(val)
+    self._mips = None
+
+  # the image[s] mip levels are built from, and a shallow copy of this
+  # projection sampling other image[s] instead
+  def _mip_source(self):
+    return self.image
+
+  def _mip_level(self, image):
+    level = copy.copy(self)
+    level.mipmap = False
+    level._mips = None
+    level.image = image
+    level.imsize = (image.shape[1], image.shape[0])
+    return level
+
+  # this projection followed by ever smaller copies, down to 1 texel. Each
+  # level is downsampled from the one before a band of rows at a time, so
+  # a memory-mapped source is never read in whole; its levels go to
+  # memory-mapped temporary files, and maxMemory (bytes) bounds the bands
+  def _mip_levels(self, maxMemory=None):
+    base = self._mip_source()
+    if self._mips is None or self._mips[0] is not base:
+      image = base if isinstance(base, np.ndarray) else np.asarray(base)
+      mapped = isinstance(image, np.memmap)
+      with span('mipmap', pixels=image.size//image.shape[-1], mapped=mapped) as s:
+        levels = [self]
+        while min(image.shape[-3:-1]) > 1:
+          image = self._downsample_level(image, mapped, maxMemory)
+          levels.append(self._mip_level(image))
+        s.set(levels=len(levels))
+      # holding base keeps its id from being reused by a new image
+      self._mips = (base, levels)
+    return self._mips[1]
+
+  # downsample(image), a band of rows at a time, into memory or with mapped
+  # into a memory-mapped temporary file. Bands start on even rows of image,
+  # so the level is the same as one made in a single pass
+  @staticmethod
+  def _downsample_level(image, mapped, maxMemory=None):
+    height, width = image.shape[-3:-1]
+    shape = image.shape[:-3] + ((height+1)//2, (width+1)//2, image.shape[-1])
+    if mapped:
+      level = np.memmap(tempfile.TemporaryFile(), image.dtype, 'w+', shape=shape)
+    else:
+      level = np.empty(shape, image.dtype)
+    rows = MIP_BAND_ROWS
+    if maxMemory is not None:
+      # per level row: the two rows of image it reads, its 4 byte sums and
+      # the row itself
+      rowBytes = int(np.prod(shape[:-3]))*shape[-2]*shape[-1]*(5*image.itemsize + 4)
+      rows = max(1, int(maxMemory // rowBytes))
+    for start in range(0, shape[-3], rows):
+      level[..., start:start+rows, :, :] = downsample(image[..., 2*start:2*(start+rows), :, :])
+    return level
+
+  # mip level per output pixel: log2 of the larger of the distances, in
+  # texels, to the next output pixel along a row and down a column
+  def _mip_lod(self, u, v, face, top):
+    footprint = None
+    for axis in range(-min(2, u.ndim), 0):
+      if u.shape[axis] < 2:
+        continue
+      dx = np.diff(u, axis=axis).astype(np.float32)
+      dx *= self.imsize[0]
+      dy = np.diff(v, axis=axis).astype(np.float32)
+      dy *= self.imsize[1]
+      dx, dy = self._texel_delta(dx, dy)
+      dx *= dx
+      dy *= dy
+      dx += dy
+      if face is not None:
+        # neighbours on another face say nothing about the footprint
+        dx[np.diff(face, axis=axis) != 0] = 0
+      # the last pixel along the axis reuses the distance before it
+      d2 = np.empty(u.shape, np.float32)
+      head = [slice(None)]*u.ndim
+      head[axis] = slice(0, -1)
+      d2[tuple(head)] = dx
+      head[axis] = slice(-1, None)
+      d2[tuple(head)] = np.take(dx, [-1], axis=axis)
+      footprint = d2 if footprint is None else np.fmax(footprint, d2, out=footprint)
+    if footprint is None:
+      return np.zeros(u.shape, np.intp)
+    # floor(log2(footprint)/2 + 0.5) without a logarithm: frexp gives e with
+    # 2**(e-1) <= 2*footprint < 2**e; NaN and zero footprints give level 0
+    footprint *= 2
+    _, exponent = np.frexp(footprint)
+    exponent -= 1
+    exponent //= 2
+    return np.clip(exponent, 0, top).astype(np.intp)
+
+  # flat indices of the pixels at each mip level in lod: (level, None) for
+  # the most common level, meaning every pixel, then (level, indices) for
+  # the others, which are sampled again over the first
+  @staticmethod
+  def _mip_groups(lod, levels):
+    counts = np.bincount(lod.ravel(), minlength=levels)
+    main = int(np.argmax(counts))
+    groups = [(main, None)]
+    if counts[main] == lod.size:
+      return groups
+    rest = np.flatnonzero(lod != main)
+    restlod = lod.ravel()[rest]
+    order = np.argsort(restlod, kind='stable')
+    rest = rest[order]
+    bounds = np.searchsorted(restlod[order], np.arange(levels+1))
+    for level in range(levels):
+      if level != main and bounds[level] < bounds[level+1]:
+        groups.append((level, rest[bounds[level]:bounds[level+1]]))
+    return groups
+
+  # texture coordinates on mip level. A level texel averages 2**level base
+  # texels, so for the filters, which place texel i at u = i/width, it
+  # sits half a block further on than texel i of the level would
+  def _mip_texcoords(self, level, u, v):
+    if level == 0 or FILTERS[self.interpolation][1] is None:
+      return u, v
+    shift = (2**level - 1)*0.5
+    return u - shift/self.imsize[0], v - shift/self.imsize[1]
+
+  # texel distances between neighbouring samples, taking the short way
+  # round for projections that wrap
+  def _texel_delta(self, dx, dy):
+    return dx, dy
+
+  # re-orient this projection as a source: every direction looked up in it
+  # is first turned by yaw, pitch and roll in degrees (see rotation_matrix),
+  # or by a (w, x, y, z) quaternion, so the output's centre shows what lies
+  # at (yaw, pitch) here. The rotation happens in the same pass as the
+  # reprojection, and is part of the mapping's cache key
+  def set_rotation(self, yaw=0.0, pitch=0.0, roll=0.0, quaternion=None):
+    if quaternion is not None:
+      rotation = quaternion_matrix(*quaternion)
+    else:
+      rotation = rotation_matrix(yaw, pitch, roll)
+    self.rotation = None if np.allclose(rotation, np.eye(3), rtol=0, atol=1e-12) else rotation
+
+  # angles turned by self.rotation
+  def _rotate_angles(self, theta, phi):
+    return self.angles_from_direction_array(*self._rotate_directions(*self.point_on_sphere_array(theta, phi)))
+
+  # directions turned by self.rotation, in their own type
+  def _rotate_directions(self, x, y, z):
+    r = self.rotation.astype(np.result_type(x, np.float32))
+    rx = r[0, 0]*x + r[0, 1]*y + r[0, 2]*z
+    ry = r[1, 0]*x + r[1, 1]*y + r[1, 2]*z
+    rz = r[2, 0]*x + r[2, 1]*y + r[2, 2]*z
+    return rx, ry, rz
 
   def get_pixel_from_uv(self, u, v, image):
     x = int(self.imsize[0]*u)
@@ -36,101 +461,1108 @@ class AbstractProjection:
     pix = image[y,x]
     return pix
 
+  # array version of get_pixel_from_uv; u, v are arrays of the same shape and
+  # NaN entries (no source sample) come back as zero pixels
+  def get_pixel_from_uv_array(self, u, v, image):
+    valid = np.isfinite(u) & np.isfinite(v)
+    x = (self.imsize[0]*np.where(valid, u, 0.0)).astype(np.intp)
+    y = (self.imsize[1]*np.where(valid, v, 0.0)).astype(np.intp)
+    x = np.clip(x, 0, self.imsize[0]-1)
+    y = np.clip(y, 0, self.imsize[1]-1)
+    pix = self._take_texels(image, x, y)
+    pix[~valid] = 0
+    return pix
+
+  # image[y,x] for in-range integer coordinates; a flat take on contiguous
+  # images is several times faster than 2D fancy indexing
+  @staticmethod
+  def _take_texels(image, x, y):
+    if image.flags.c_contiguous:
+      flat = image.reshape((-1,) + image.shape[2:])
+      return np.take(flat, y*image.shape[1] + x, axis=0)
+    return image[y,x]
+
+  # Pillow modes kept as they are, with the pixel type they decode to; 32-bit
+  # integer images are clipped to uint16 and anything else is converted to
+  # RGB, or RGBA when it carries transparency
+  NATIVE_MODES = {
+    'L': np.uint8, 'LA': np.uint8, 'RGB': np.uint8, 'RGBA': np.uint8,
+    'I;16': np.uint16, 'I;16L': np.uint16, 'I;16B': np.uint16,
+    'F': np.float32,
+  }
+
+  # the returned array is a writable copy of the decoded image with the
+  # image's own band count and pixel type (one of DTYPES), so an RGB
+  # file stays (h, w, 3) uint8 and a 16-bit grey PNG (h, w, 1) uint16. .npy
+  # files are memory-mapped read-only rather than read, for images larger
+  # than RAM, and TIFFs are read with tifffile when it is installed, for
+  # 16-bit and float colour
   @staticmethod
   def _loadImage(imageFile):
-    img = Image.open(imageFile)
-    imsize = img.size
-    #parsed = Image.new("RGB", imsize, (255, 255, 255))
-    #bands = img.split()
-    #parsed.paste(img, mask=(bands[3] if len(bands) == 4 else None))
-    #npimage = np.array(parsed.getdata(), np.uint8).reshape(img.size[1], img.size[0], 3)
-    parsed = Image.new("RGBA", imsize, (255, 255, 255, 0))
-    parsed.paste(img)
-    npimage = np.array(parsed.getdata(), np.uint8).reshape(img.size[1], img.size[0], 4)
-    return npimage, imsize
+    with span('load', file=str(imageFile)) as s:
+      lower = imageFile.lower()
+      if lower.endswith('.npy'):
+        return AbstractProjection._checkArrayImage(np.load(imageFile, mmap_mode='r'), imageFile)
+      tifffile = _tifffile() if lower.endswith(('.tif', '.tiff')) else None
+      if tifffile is not None:
+        npimage = tifffile.imread(imageFile)
+        if npimage.ndim == 2:
+          npimage = npimage[..., np.newaxis]
+        elif npimage.dtype.kind == 'f' and npimage.dtype != np.float32:
+          npimage = npimage.astype(np.float32)
+        npimage, imsize = AbstractProjection._checkArrayImage(npimage, imageFile)
+        s.set(pixels=imsize[0]*imsize[1], bytes=npimage.nbytes)
+        return npimage, imsize
+      img = _pil().open(imageFile)
+      imsize = img.size
+      rawmode = AbstractProjection._pilRawmode(img)
+      if rawmode is not None and img.format == 'PNG' and (rawmode in ('RGB;16B', 'RGBA;16B') or (rawmode == 'LA;16B' and img.mode == 'RGBA')):
+        npimage = AbstractProjection._loadPng16(imageFile, img, rawmode)
+      elif img.mode == 'I':
+        npimage = np.clip(np.asarray(img), 0, 65535).astype(np.uint16)
+      else:
+        if rawmode is not None and ';16' in rawmode and AbstractProjection.NATIVE_MODES.get(img.mode) != np.uint16:
+          warnings.warn('%s: Pillow decodes its 16-bit %s samples to 8 bits' % (imageFile, rawmode.split(';')[0]) +
+                        ('; install tifffile to keep them' if img.format == 'TIFF' else ''), stacklevel=3)
+        if img.mode not in AbstractProjection.NATIVE_MODES:
+          hasAlpha = 'A' in img.getbands() or 'transparency' in img.info
+          img = img.convert('RGBA' if hasAlpha else 'RGB')
+        # one copy out of Pillow's buffer, which np.asarray would only wrap
+        # read-only, so the image can be edited in place
+        npimage = np.array(img)
+        # big-endian 16-bit modes decode byte-swapped
+        if npimage.dtype != AbstractProjection.NATIVE_MODES[img.mode]:
+          npimage = npimage.astype(AbstractProjection.NATIVE_MODES[img.mode])
+      if npimage.ndim == 2:
+        npimage = npimage[..., np.newaxis]
+      s.set(pixels=imsize[0]*imsize[1], bytes=npimage.nbytes)
+      return npimage, imsize
+
+  # the raw mode a Pillow image decodes its file from, before loading
+  @staticmethod
+  def _pilRawmode(img):
+    if len(img.tile) != 1:
+      return None
+    args = img.tile[0][3]
+    return args if isinstance(args, str) else (args[0] if args and isinstance(args[0], str) else None)
+
+  # Pillow has no 16-bit colour modes and keeps the high byte of each
+  # sample; decoding the file again with the little-endian raw mode of the
+  # same layout keeps the low byte instead, through the same unfiltering.
+  # Grey with alpha, which Pillow opens as RGBA, has as many bits per pixel
+  # as 8-bit RGBA, so decoding it as that gives every byte at once
+  @staticmethod
+  def _loadPng16(imageFile, img, rawmode):
+    codec, extents, offset, _ = img.tile[0]
+    if rawmode == 'LA;16B':
+      img.tile = [(codec, extents, offset, 'RGBA')]
+      samples = np.array(img)
+      npimage = samples[..., 0::2].astype(np.uint16) << 8
+      npimage |= samples[..., 1::2]
+      return npimage
+    high = np.array(img)
+    low = _pil().open(imageFile)
+    low.tile = [(codec, extents, offset, rawmode[:-1] + 'L')]
+    npimage = high.astype(np.uint16) << 8
+    npimage |= np.array(low)
+    return npimage
+
+  @staticmethod
+  def _checkArrayImage(image, imageFile):
+    if image.ndim != 3:
+      raise ValueError('%s: expected a (height, width, channels) array, got shape %s' % (imageFile, image.shape))
+    _check_dtype(image.dtype, imageFile)
+    return image, (image.shape[1], image.shape[0])
 
   def loadImage(self, imageFile):
     self.image, self.imsize = self._loadImage(imageFile)
     self.set_angular_resolution()
 
+  # use an image already in memory, such as a decoded video frame
+  def setImage(self, image):
+    self.image, self.imsize = self._checkArrayImage(image, 'Image')
+    self.set_angular_resolution()
+
+  # memory-map headerless pixel data, stored row by row with interleaved
+  # channels starting at offset bytes into the file
+  def loadRawImage(self, imageFile, width, height, channels=3, dtype=np.uint8, offset=0):
+    image = np.memmap(imageFile, dtype=dtype, mode='r', offset=offset, shape=(height, width, channels))
+    self.image, self.imsize = self._checkArrayImage(image, imageFile)
+    self.set_angular_resolution()
+
+  # (channels, dtype) of this projection's image[s], for making an output
+  # that keeps a source's format
+  def pixel_format(self):
+    image = self._images()[0]
+    return image.shape[-1], image.dtype
+
+  # channels bands of dtype, one of DTYPES. With a filename the image is
+  # created as a memory-mapped .npy file, so outputs larger than RAM are
+  # written straight to disk
   @staticmethod
-  def _initImage(width, height):
-    image = np.ndarray((height, width, 4), dtype=np.uint8)
+  def _initImage(width, height, filename=None, channels=4, dtype=np.uint8):
+    dtype = _check_dtype(dtype)
+    if filename is not None:
+      return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(height, width, channels))
+    image = np.ndarray((height, width, channels), dtype=dtype)
     return image
 
-  def initImage(self, width, height):
-    self.image = self._initImage(width, height)
+  def initImage(self, width, height, filename=None, channels=4, dtype=np.uint8):
+    self.image = self._initImage(width, height, filename, channels, dtype)
     self.imsize = (width, height)
     self.set_angular_resolution()
 
+  # the array Pillow can encode to destFile for img: 8-bit grey, grey with
+  # alpha, RGB or RGBA, 16-bit grey, or float grey for TIFFs. Anything else
+  # is converted to 8 bits here, at the save boundary and nowhere earlier
   @staticmethod
-  def _saveImage(img, imgsize, destFile):
-    mode = 'RGBA'
-    arr = img.reshape(img.shape[0]*img.shape[1], img.shape[2])
-    if len(arr[0]) == 3:
-        arr = np.c_[arr, 255*np.ones((len(arr),1), np.uint8)]
-    img =  Image.frombuffer(mode, imgsize, arr.tostring(), 'raw', mode, 0, 1)
-    img.save(destFile)
+  def _pilArray(img, destFile):
+    channels = img.shape[-1]
+    tiff = destFile.lower().endswith(('.tif', '.tiff'))
+    if channels == 1 and (img.dtype == np.uint16 or (img.dtype == np.float32 and tiff)):
+      return img[..., 0]
+    if channels not in (1, 2, 3, 4):
+      img = convert_channels(img, 4 if channels > 4 else 3)
+    elif channels in (2, 4) and destFile.lower().endswith(('.jpg', '.jpeg')):
+      # JPEG has no alpha
+      img = convert_channels(img, channels-1)
+      channels -= 1
+    if img.dtype != np.uint8:
+      warnings.warn('%s: %s images are written with 8 bits per channel in this format; use .png, .npy or, with tifffile, .tif to keep them' % (destFile, img.dtype.name), stacklevel=4)
+    img = convert_dtype(img, np.uint8)
+    return img[..., 0] if channels == 1 else img
+
+  # Image.fromarray wraps the array buffer directly when it is contiguous;
+  # 3 band images are saved as RGB and 4 band images as RGBA. .npy
+  # destinations are written as arrays, or just flushed when the image is
+  # already memory-mapped to that file. TIFFs are written by tifffile when
+  # it is installed, keeping any pixel type, and uint16 or float images to
+  # .png as 16-bit PNGs. Formats that hold only 8 bits warn before they
+  # drop precision. compression and quality are as for set_encoding
+  @staticmethod
+  def _saveImage(img, imgsize, destFile, compression=None, quality=None):
+    if tuple(imgsize) != (img.shape[1], img.shape[0]):
+      raise ValueError('Image is %dx%d, expected %dx%d' % ((img.shape[1], img.shape[0]) + tuple(imgsize)))
+    with span('save', file=str(destFile), pixels=img.shape[0]*img.shape[1], bytes=img.nbytes):
+      lower = destFile.lower()
+      if lower.endswith('.npy'):
+        if isinstance(img, np.memmap) and img.filename is not None and os.path.abspath(img.filename) == os.path.abspath(destFile):
+          img.flush()
+        else:
+          np.save(destFile, img)
+        return
+      tiff = lower.endswith(('.tif', '.tiff'))
+      tifffile = _tifffile() if tiff else None
+      if tifffile is not None:
+        options = {}
+        if compression:
+          options = {'compression': 'zlib', 'compressionargs': {'level': compression}}
+        if img.shape[-1] >= 3:
+          tifffile.imwrite(destFile, np.ascontiguousarray(img), photometric='rgb', extrasamples=('unassalpha',)*(img.shape[-1]-3), **options)
+        elif img.shape[-1] == 2:
+          tifffile.imwrite(destFile, np.ascontiguousarray(img), photometric='minisblack', extrasamples=('unassalpha',), **options)
+        else:
+          tifffile.imwrite(destFile, np.ascontiguousarray(img[..., 0]), photometric='minisblack', **options)
+        return
+      if lower.endswith('.png') and img.dtype != np.uint8 and img.shape[-1] <= 4:
+        _write_png16(destFile, convert_dtype(img, np.uint16), compression)
+        return
+      options = {}
+      if compression is not None:
+        if tiff:
+          options['compression'] = 'tiff_adobe_deflate' if compression else 'raw'
+        else:
+          options['compress_level'] = compression
+      if quality is not None:
+        options['quality'] = quality
+      _pil().fromarray(np.ascontiguousarray(AbstractProjection._pilArray(img, destFile))).save(destFile, **options)
 
   def saveImage(self, destFile):
-    self._saveImage(self.image, self.imsize, destFile)
+    self._saveImage(self.image, self.imsize, destFile, **self._encoding())
+
+  # parameters beyond the projection type and image size that change where
+  # pixels map to; part of every RemapTable's description and cache key
+  def _geometry(self):
+    geometry = {}
+    if self.rotation is not None:
+      geometry['rotation'] = self.rotation.tolist()
+    if self.precision != 'float64':
+      geometry['precision'] = self.precision
+    return geometry
+
+  # output image[s] in the order they are saved
+  def _images(self):
+    return (self.image,)
 
-  # this isn't any faster because of the GIL on the image object
   def reprojectToThisThreaded(self, sourceProjection, numThreads):
-    uvList = []
-    fx = float(self.imsize[0])
-    fy = float(self.imsize[1])
+    self.reprojectToThis(sourceProjection, workers=numThreads)
 
-    angleList = [self.angular_position((float(i)/fx,float(j)/fy)) for i in range(self.imsize[0]) for j in range(self.imsize[1])]
+  # texture coordinates of every output pixel, matching the u, v computed per
+  # pixel in reprojectToThisScalar; rows selects a band of output rows
+  def texcoord_grid(self, rows=slice(None), dtype=np.float64):
+    u = np.arange(self.imsize[0], dtype=np.float64)/float(self.imsize[0])
+    v = np.arange(self.imsize[1], dtype=np.float64)[rows]/float(self.imsize[1])
+    return np.meshgrid(u.astype(dtype), v.astype(dtype))
 
-    poolAngles = ThreadPool(numThreads)
-    image = poolAngles.map(sourceProjection.pixel_value, angleList)
-    poolAngles.close()
-    poolAngles.join()
+  # pixels converted to channels bands of dtype (kept as they are when
+  # None); pixels for angles that have no position on this projection are
+  # black, and transparent when there is an alpha channel
+  @staticmethod
+  def _fit_pixels(pixels, invalid, channels, dtype=None):
+    if dtype is not None:
+      pixels = convert_dtype(pixels, dtype)
+    pixels = convert_channels(pixels, channels)
+    if invalid is not None and invalid.any():
+      pixels[invalid] = 0
+    return pixels
 
-    idx = 0
-    for x in range(self.imsize[0]):
-      for y in range(self.imsize[1]):
-        pixel = image[idx]
-        if pixel is None:
-          print(x,y)
+  # angles of every output pixel in the band of rows; NaN where the pixel has
+  # no position on the sphere
+  def angular_grid(self, rows=slice(None)):
+    u, v = self.texcoord_grid(rows)
+    return self.angular_position_array(u, v)
+
+  # unit direction vectors (x, y, z) of every output pixel in the band of
+  # rows, in dtype; NaN where the pixel has no position on the sphere
+  def direction_grid(self, rows=slice(None), dtype=np.float32):
+    u, v = self.texcoord_grid(rows, dtype)
+    return self.direction_array(u, v)
+
+  # output pixels in the band of rows that have a position on the sphere, or
+  # None when they all do. Worked out from the texture coordinates of the
+  # band alone, so masks never cost more memory than the band
+  def valid_mask(self, rows=slice(None)):
+    if not self.MASKED:
+      return None
+    return self._valid_texcoords(*self.texcoord_grid(rows))
+
+  # which texture coordinates of a MASKED projection lie on the sphere
+  def _valid_texcoords(self, u, v):
+    return np.ones(u.shape, bool)
+
+  # flat indices into the band of rows of its valid and invalid pixels
+  def _valid_indices(self, rows):
+    mask = self.valid_mask(rows).ravel()
+    return np.flatnonzero(mask), np.flatnonzero(~mask)
+
+  # angles of just the pixels in valid_mask(rows), as flat arrays, and
+  # their flat indices from _valid_indices; angular_grid(rows) and None for
+  # projections without a mask
+  def _valid_angles(self, rows=slice(None)):
+    if not self.MASKED:
+      theta, phi = self.angular_grid(rows)
+      return theta, phi, None
+    u, v, index = self._valid_texcoord_grid(rows)
+    theta, phi = self.angular_position_array(u, v)
+    return theta, phi, index
+
+  # _valid_angles as direction vectors of dtype
+  def _valid_directions(self, rows=slice(None), dtype=np.float32):
+    if not self.MASKED:
+      return self.direction_grid(rows, dtype) + (None,)
+    u, v, index = self._valid_texcoord_grid(rows, dtype)
+    return self.direction_array(u, v) + (index,)
+
+  # direction_grid for projections whose columns are lines of longitude
+  # and rows lines of latitude in angular_position_array, which is then
+  # only worked out once per column and once per row
+  def _latlong_direction_grid(self, rows, dtype):
+    u = np.arange(self.imsize[0], dtype=np.float64)/float(self.imsize[0])
+    v = np.arange(self.imsize[1], dtype=np.float64)[rows]/float(self.imsize[1])
+    theta, _ = self.angular_position_array(u, np.zeros_like(u))
+    _, phi = self.angular_position_array(np.zeros_like(v), v)
+    r = np.cos(phi).astype(dtype)[:, np.newaxis]
+    x = r*np.cos(theta).astype(dtype)
+    y = r*np.sin(theta).astype(dtype)
+    z = np.empty(x.shape, dtype)
+    z[...] = np.sin(phi).astype(dtype)[:, np.newaxis]
+    return x, y, z
+
+  # texture coordinates of just the pixels in valid_mask(rows), and their
+  # flat indices from _valid_indices
+  def _valid_texcoord_grid(self, rows, dtype=np.float64):
+    index = self._valid_indices(rows)
+    start = rows.indices(self.imsize[1])[0]
+    width, height = self.imsize
+    u = (index[0] % width)/float(width)
+    v = (index[0]//width + start)/float(height)
+    return u.astype(dtype, copy=False), v.astype(dtype, copy=False), index
+
+  # values computed for the valid pixels only, spread back over the band of
+  # shape; the rest are fill
+  @staticmethod
+  def _scatter(values, index, shape, fill=0):
+    full = np.full((int(np.prod(shape)),) + values.shape[1:], fill, values.dtype)
+    full[index[0]] = values
+    return full.reshape(tuple(shape) + values.shape[1:])
+
+  # (channels, dtype) of an output of this projection sampling a source of
+  # pixelFormat: the same, with an alpha channel added for the valid_mask of
+  # MASKED projections
+  def output_format(self, pixelFormat):
+    channels, dtype = pixelFormat
+    if self.MASKED and channels in (1, 3):
+      channels += 1
+    return channels, dtype
+
+  # write pixels sampled for angular_grid(rows) into the output image[s]
+  def _store_pixels(self, pixels, invalid, rows=slice(None)):
+    image = self.image[rows]
+    image[...] = self._fit_pixels(pixels, invalid, image.shape[-1], image.dtype)
+
+  # write pixels sampled for _valid_angles(rows) into the output image,
+  # clearing the pixels outside the mask
+  def _store_valid_pixels(self, pixels, invalid, index, rows=slice(None)):
+    image = self.image[rows]
+    pixels = self._fit_pixels(pixels, invalid, image.shape[-1], image.dtype)
+    if not image.flags.c_contiguous:
+      image[...] = self._scatter(pixels, index, image.shape[:-1])
+      return
+    flat = image.reshape((-1, image.shape[-1]))
+    flat[index[0]] = pixels
+    flat[index[1]] = 0
+
+  # output pixels written per row of self.imsize
+  def _pixels_per_row(self):
+    return self.imsize[0]
+
+  # approximate peak working memory per output pixel while sampling this
+  # projection; measured for each filter on a 3 band source
+  def _working_bytes_per_pixel(self):
+    radius, kernel = FILTERS[self.interpolation]
+    if kernel is None:
+      return 64
+    return 144 + 20*radius
+
+  # split the output rows into bands, a few per worker to balance the load.
+  # With maxMemory (bytes) the bands are also made small enough that all
+  # workers together stay within it
+  def _row_bands(self, workers, maxMemory=None, bytesPerPixel=0):
+    height = self.imsize[1]
+    count = max(1, min(height, workers*4 if workers > 1 else 1))
+    if maxMemory is not None:
+      rowBytes = self._pixels_per_row()*bytesPerPixel
+      rows = max(1, int(maxMemory // max(1, workers*rowBytes)))
+      count = max(count, min(height, -(-height // rows)))
+    edges = np.linspace(0, height, count+1).astype(int)
+    return [slice(edges[i], edges[i+1]) for i in range(count) if edges[i] < edges[i+1]]
+
+  # same as storing pixel_value_array(angular_grid(rows)), timed per stage
+  # when profiling
+  def _reproject_rows(self, sourceProjection, rows, remapTable=None):
+    if remapTable is not None:
+      remapTable.apply(sourceProjection, self, rows)
+      return
+    self._sample_rows(sourceProjection, rows, *self._map_rows(sourceProjection, rows))
+
+  # (u, v, face, invalid, index): where the output pixels in the band of
+  # rows sample sourceProjection, and which of them have no position on the
+  # sphere. Pixels outside valid_mask are left out, listed by index, except
+  # for mipmapped sources, which need whole rows to measure footprints
+  def _map_rows(self, sourceProjection, rows):
+    if self.precision != 'float64':
+      return self._map_rows_directions(sourceProjection, rows, PRECISIONS[self.precision])
+    with span('angles') as s:
+      if sourceProjection.mipmap:
+        theta, phi = self.angular_grid(rows)
+        index = None
+      else:
+        theta, phi, index = self._valid_angles(rows)
+      invalid = ~(np.isfinite(theta) & np.isfinite(phi))
+      s.set(pixels=theta.size, bytes=theta.nbytes+phi.nbytes)
+    with span('texcoords', pixels=theta.size) as s:
+      u, v, face = sourceProjection.texcoord_array(theta, phi)
+      s.set(bytes=u.nbytes+v.nbytes)
+    return u, v, face, invalid, index
+
+  # _map_rows through unit direction vectors of dtype instead of angles
+  def _map_rows_directions(self, sourceProjection, rows, dtype):
+    with span('directions') as s:
+      if sourceProjection.mipmap:
+        x, y, z = self.direction_grid(rows, dtype)
+        index = None
+      else:
+        x, y, z, index = self._valid_directions(rows, dtype)
+      # directions with no position on the sphere are NaN in every component
+      invalid = np.isnan(x)
+      s.set(pixels=x.size, bytes=3*x.nbytes)
+    with span('texcoords', pixels=x.size) as s:
+      u, v, face = sourceProjection.texcoord_from_direction_array(x, y, z)
+      s.set(bytes=u.nbytes+v.nbytes)
+    return u, v, face, invalid, index
+
+  # sample sourceProjection at the coordinates from _map_rows and store the
+  # pixels in the band of rows
+  def _sample_rows(self, sourceProjection, rows, u, v, face, invalid, index):
+    with span('sample', pixels=u.size, interpolation=sourceProjection.interpolation) as s:
+      pixels = sourceProjection.sample_array(u, v, face)
+      s.set(bytes=pixels.nbytes)
+    with span('store', pixels=u.size):
+      if index is None:
+        self._store_pixels(pixels, invalid, rows)
+      else:
+        self._store_valid_pixels(pixels, invalid, index, rows)
+
+  # build what sampling makes lazily, such as mip levels, before bands on
+  # several threads race to build their own; within maxMemory (bytes)
+  def _prepare_source(self, maxMemory=None):
+    if self.mipmap:
+      self._mip_levels(maxMemory)
+
+  # this projection as the eye of a stereo pair; mono projections are the
+  # same for both eyes
+  def eye(self, index):
+    return self
+
+  # workers > 1 splits the output into row bands that are reprojected on a
+  # thread pool; the NumPy kernels release the GIL and every band writes
+  # straight into the shared output image. workers <= 0 uses every core.
+  # maxMemory bounds the working memory of the bands in flight, in bytes;
+  # with memory-mapped source and output images only the source pages each
+  # band samples are read in
+  def reprojectToThis(self, sourceProjection, remapTable=None, workers=1, maxMemory=None):
+    if workers is None or workers <= 0:
+      workers = os.cpu_count() or 1
+    bands = self._row_bands(workers, maxMemory, sourceProjection._working_bytes_per_pixel())
+    with span('reprojectToThis', source=type(sourceProjection).__name__, target=type(self).__name__,
+              workers=workers, bands=len(bands), remapTable=remapTable is not None):
+      # build the mip levels once, before the bands race to build their own
+      sourceProjection._prepare_source(maxMemory)
+      if workers == 1 or len(bands) == 1:
+        for rows in bands:
+          self._reproject_rows(sourceProjection, rows, remapTable)
+        return
+      from concurrent.futures import ThreadPoolExecutor
+      with ThreadPoolExecutor(max_workers=workers) as pool:
+        for result in [pool.submit(self._reproject_rows, sourceProjection, rows, remapTable) for rows in bands]:
+          result.result()
+
+  # after sourceProjection has been edited inside rectangles (see
+  # changed_mask), update in place just the output pixels that read a
+  # texel in them; the rest are left as an earlier reprojectToThis of the
+  # same pair made them. The rectangles, grown by the filter radius, are
+  # mapped back through the inverse of this projection to find the output
+  # rows they can reach; only those rows are mapped, and only their pixels
+  # whose filter taps read a changed texel are resampled, so a small edit
+  # costs a few rows and not the whole output. Mipmapped sources map every
+  # row, as a pixel's mip level can reach far beyond the rectangles, but
+  # still only resample the pixels that read changed texels, matching a
+  # reprojectToThis with the same workers. Returns the number of output
+  # pixels resampled
+  def reprojectToThisChanged(self, sourceProjection, rectangles, remapTable=None, workers=1):
+    if workers is None or workers <= 0:
+      workers = os.cpu_count() or 1
+    rectangles = sourceProjection._eye_rectangles(rectangles, 0)
+    with span('reprojectToThisChanged', source=type(sourceProjection).__name__, target=type(self).__name__,
+              workers=workers, rectangles=len(rectangles), remapTable=remapTable is not None) as s:
+      if remapTable is not None:
+        remapTable._check_target(self)
+      sourceProjection._prepare_source()
+      levels = len(sourceProjection._mip_levels()) if sourceProjection.mipmap else 1
+      changed = changed_levels(sourceProjection.changed_mask(rectangles), levels)
+      if sourceProjection.mipmap:
+        # footprints are measured within a band, so these are the bands
+        # reprojectToThis would use
+        bands = self._row_bands(workers)
+        rows = self.imsize[1]
+      else:
+        rows = self._changed_rows(sourceProjection, rectangles)
+        bands = self._changed_bands(rows, workers)
+        rows = int(rows.sum())
+      s.set(rows=rows, bands=len(bands))
+      if workers == 1 or len(bands) <= 1:
+        updated = sum(self._reproject_changed_rows(sourceProjection, band, changed, remapTable) for band in bands)
+      else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+          updated = sum(pool.map(lambda band: self._reproject_changed_rows(sourceProjection, band, changed, remapTable), bands))
+      s.set(pixels=updated)
+      return updated
+
+  # a changed rectangle of this projection's pixels as (face, x0, y0, x1,
+  # y1); face is None for projections backed by a single image
+  def _changed_rectangle(self, rectangle):
+    if len(rectangle) != 4:
+      raise ValueError('Changed rectangles are x0,y0,x1,y1, got %s' % ','.join(str(v) for v in rectangle))
+    return (None,) + tuple(int(v) for v in rectangle)
+
+  # rectangles of this projection's pixels as seen by the eye index of a
+  # stereo pair; mono projections show the same to both eyes
+  def _eye_rectangles(self, rectangles, index):
+    return list(rectangles)
+
+  # boolean mask of this projection's texels, (height, width) or for cubemaps
+  # (6, height, width), set inside rectangles of (x0, y0, x1, y1) pixels, or
+  # (face, x0, y0, x1, y1) for cubemaps
+  def changed_mask(self, rectangles):
+    width, height = self.imsize
+    mask = np.zeros((height, width), bool)
+    for _, x0, y0, x1, y1 in (self._changed_rectangle(rectangle) for rectangle in rectangles):
+      mask[max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)] = True
+    return mask
+
+  # unit direction vectors through texture coordinates u, v of this
+  # projection's own image[s], before set_rotation; texture coordinates a
+  # little outside the image carry on past its edge
+  def _texel_directions(self, face, u, v):
+    return self.direction_array(u, v)
+
+  # output rows that may read the rectangles of sourceProjection, as a
+  # boolean array. Each rectangle, grown by the filter radius, is sampled
+  # densely enough to find every cell of _direction_index it looks into,
+  # and the rows are those of the output pixels looking into those cells
+  def _changed_rows(self, sourceProjection, rectangles):
+    index, blockRows = self._direction_index()
+    latitudes, longitudes = index.shape[:2]
+    cell = np.pi/latitudes
+    marked = np.zeros((latitudes, longitudes), bool)
+    margin = FILTERS[sourceProjection.interpolation][0] + 1
+    width, height = sourceProjection.imsize
+    for rectangle in rectangles:
+      face, x0, y0, x1, y1 = sourceProjection._changed_rectangle(rectangle)
+      x0, x1 = max(x0, 0), min(x1, width)
+      y0, y1 = max(y0, 0), min(y1, height)
+      if x0 >= x1 or y0 >= y1:
+        continue
+      area = (x0-margin, y0-margin, x1+margin, y1+margin)
+      extent = float(max(area[2]-area[0], area[3]-area[1]))
+      # a coarse pass measures how far apart neighbouring samples are
+      step = extent/16.0
+      directions, gaps = self._changed_directions(sourceProjection, face, area, step)
+      if gaps.size and gaps.max() > cell*0.5:
+        step = max(step*cell*0.5/gaps.max(), extent/1024.0)
+        directions, gaps = self._changed_directions(sourceProjection, face, area, step)
+      # much larger gaps are where the source tears, such as between the
+      # two circles of a side by side fisheye, and are not part of the area
+      if gaps.size:
+        gaps = gaps[gaps <= 8.0*max(np.percentile(gaps, 90), 1e-9)]
+      # every point of the area is within a cell diagonal of a sample
+      reach = 1.5*(gaps.max() if gaps.size else cell)
+      self._mark_cells(marked, directions, reach)
+    blocks = index[marked].any(axis=0)
+    return np.repeat(blocks, blockRows)[:self.imsize[1]]
+
+  # unit directions here (x, y, z, flat and finite) of a grid of step texels
+  # over area, (x0, y0, x1, y1) of sourceProjection's pixels on face, and the
+  # angles between neighbouring samples
+  def _changed_directions(self, sourceProjection, face, area, step):
+    x0, y0, x1, y1 = area
+    width, height = sourceProjection.imsize
+    u = np.linspace(x0, x1, int(np.ceil((x1-x0)/step))+1)/float(width)
+    v = np.linspace(y0, y1, int(np.ceil((y1-y0)/step))+1)/float(height)
+    u, v = np.meshgrid(u, v)
+    x, y, z = sourceProjection._texel_directions(face, u, v)
+    if sourceProjection.rotation is not None:
+      # the source is looked up at rotation times the output's direction
+      r = sourceProjection.rotation
+      x, y, z = (r[0, 0]*x + r[1, 0]*y + r[2, 0]*z,
+                 r[0, 1]*x + r[1, 1]*y + r[2, 1]*z,
+                 r[0, 2]*x + r[1, 2]*y + r[2, 2]*z)
+    norm = np.sqrt(x*x + y*y + z*z)
+    directions = np.stack((x/norm, y/norm, z/norm))
+    gaps = []
+    for axis in (1, 2):
+      # chord length to angle
+      chord = np.sqrt((np.diff(directions, axis=axis)**2).sum(axis=0))
+      gap = 2.0*np.arcsin(np.minimum(chord[np.isfinite(chord)]*0.5, 1.0))
+      gaps.append(gap)
+    directions = directions.reshape(3, -1)
+    return directions[:, np.isfinite(directions).all(axis=0)], np.concatenate(gaps)
+
+  # mark the cells of a latitude/longitude grid holding any point within
+  # reach radians of one of the unit directions
+  @staticmethod
+  def _mark_cells(marked, directions, reach):
+    latitudes, longitudes = marked.shape
+    if not directions.shape[1]:
+      return
+    seen = np.zeros(marked.shape, bool)
+    seen[AbstractProjection._direction_cells(*directions, latitudes=latitudes, longitudes=longitudes)] = True
+    cell = np.pi/latitudes
+    up = int(np.ceil(reach/cell))
+    for row in range(latitudes):
+      near = seen[max(0, row-up):row+up+1].any(axis=0)
+      if not near.any():
+        continue
+      # longitudes close in, and so spread over more columns, towards the
+      # pole; the most polar edge of the rows in reach bounds the spread
+      edge = max(abs(-0.5*np.pi + (row-up)*cell), abs(-0.5*np.pi + (row+up+1)*cell))
+      shrink = np.cos(min(edge, 0.5*np.pi))
+      ratio = np.sin(min(0.5*reach, 0.5*np.pi))/shrink if shrink > 1e-12 else 2.0
+      if ratio >= 1.0:
+        marked[row] = True
+        continue
+      across = int(np.ceil(2.0*np.arcsin(ratio)/(2.0*np.pi/longitudes)))
+      if 2*across+1 >= longitudes:
+        marked[row] = True
+        continue
+      columns = np.flatnonzero(near)[:, np.newaxis] + np.arange(-across, across+1)
+      marked[row, columns.ravel() % longitudes] = True
+
+  # (row, column) cells of a latitude/longitude grid for finite directions
+  @staticmethod
+  def _direction_cells(x, y, z, latitudes, longitudes):
+    theta = np.arctan2(y, x)
+    phi = np.arctan2(z, np.sqrt(x*x + y*y))
+    row = np.clip(((phi + 0.5*np.pi)*(latitudes/np.pi)).astype(np.intp), 0, latitudes-1)
+    column = np.clip(((theta + np.pi)*(longitudes/(2.0*np.pi))).astype(np.intp), 0, longitudes-1)
+    return row, column
+
+  # for every cell of a latitude/longitude grid over the sphere, which blocks
+  # of output rows have pixels looking into it, as a (latitudes, longitudes,
+  # blocks) boolean array, and the rows per block. Worked out from the
+  # output pixels' own directions, so outputs that show a direction in
+  # several places, such as the edges of cube faces, find all of them. Built
+  # on first use, once per image size and geometry
+  def _direction_index(self):
+    key = (tuple(self.imsize), repr(sorted(self._geometry().items())))
+    cached = getattr(self, '_directions', None)
+    if cached is not None and cached[0] == key:
+      return cached[1]
+    width, height = self.imsize
+    pixels = self._pixels_per_row()*height
+    # cells of about 128 pixels
+    latitudes = int(np.clip(np.sqrt(pixels/256.0), 16, 180))
+    longitudes = 2*latitudes
+    blockRows = -(-height // min(height, 128))
+    index = np.zeros((latitudes, longitudes, -(-height // blockRows)), bool)
+    with span('directionIndex', pixels=pixels, cells=latitudes*longitudes):
+      for rows in self._row_bands(1, 64*1024*1024, 16):
+        x, y, z, where = self._valid_directions(rows, np.float32)
+        if where is None:
+          block = np.broadcast_to((np.arange(rows.start, rows.stop)//blockRows)[:, np.newaxis], x.shape)
         else:
-          self.image[y,x] = pixel
-        idx = idx + 1
+          block = (where[0]//width + rows.start)//blockRows
+        finite = np.isfinite(x)
+        row, column = self._direction_cells(x[finite], y[finite], z[finite], latitudes, longitudes)
+        index[row, column, block[finite]] = True
+    self._directions = (key, (index, blockRows))
+    return self._directions[1]
 
+  # row bands over the runs of rows, a few per worker
+  def _changed_bands(self, rows, workers):
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], rows.astype(np.int8), [0]))))
+    longest = len(rows) if workers == 1 else max(1, -(-int(rows.sum()) // (4*workers)))
+    bands = []
+    for start, stop in zip(edges[0::2], edges[1::2]):
+      bands.extend(slice(band, min(band+longest, stop)) for band in range(start, stop, longest))
+    return bands
+
+  # resample the pixels in the band of rows that read a texel marked in
+  # changed, from changed_levels; returns how many there were
+  def _reproject_changed_rows(self, sourceProjection, rows, changed, remapTable=None):
+    if remapTable is not None:
+      u, v, face = remapTable.coordinates(sourceProjection, rows)
+      index = None
+    else:
+      u, v, face, _, index = self._map_rows(sourceProjection, rows)
+    with span('taps', pixels=u.size) as s:
+      where = np.flatnonzero(sourceProjection.changed_samples(u, v, face, changed))
+      s.set(changed=where.size)
+    if not where.size:
+      return 0
+    with span('sample', pixels=where.size, interpolation=sourceProjection.interpolation) as s:
+      pixels = sourceProjection.sample_array(u, v, face, where)
+      s.set(bytes=pixels.nbytes)
+    with span('store', pixels=where.size):
+      self._store_pixels_at(pixels, where if index is None else index[0][where], rows)
+    return where.size
 
-  def reprojectToThis(self, sourceProjection):
+  # write pixels sampled for just the pixels at flat indices into the band
+  # of rows of angular_grid(rows)
+  def _store_pixels_at(self, pixels, flat, rows=slice(None)):
+    image = self.image[rows]
+    y, x = np.unravel_index(flat, image.shape[:-1])
+    image[y, x] = self._fit_pixels(pixels, None, image.shape[-1], image.dtype)
+
+  # reference per-pixel implementation of reprojectToThis. It works in the
+  # same float64 arithmetic, so with nearest sampling the two give the same
+  # pixels; other interpolations here blend the pixels at four nearby angles
+  # instead of filtering in texel space
+  def reprojectToThisScalar(self, sourceProjection):
     for x in range(self.imsize[0]):
       for y in range(self.imsize[1]):
         u = float(x)/float(self.imsize[0])
         v = float(y)/float(self.imsize[1])
         theta, phi = self.angular_position((u,v))
-        if theta is None or phi is None:
-          pixel = (0,0,0)
-        else:
-          pixel = sourceProjection.pixel_value((theta, phi))
-        if len(pixel) == 3:
-            pixel = (pixel[0],pixel[1], pixel[2], 255)
-        self.image[y,x] = pixel
+        self.image[y,x] = self._scalar_pixel(sourceProjection, theta, phi, self.image)
+
+  # sourceProjection.pixel_value in the format of image; where the angles
+  # are None black, and transparent when image has alpha, as in
+  # _fit_pixels
+  @staticmethod
+  def _scalar_pixel(sourceProjection, theta, phi, image):
+    channels, dtype = sourceProjection.pixel_format()
+    if theta is None or phi is None:
+      pixel = np.zeros((1, channels), dtype)
+      invalid = np.ones(1, bool)
+    else:
+      pixel = np.asarray(sourceProjection.pixel_value((theta, phi)), dtype)[np.newaxis]
+      invalid = None
+    return AbstractProjection._fit_pixels(pixel, invalid, image.shape[-1], image.dtype)[0]
 
+  # the scalar path does its trigonometry with the NumPy functions of the
+  # array path rather than math's, whose last bit can differ and move a
+  # sample onto the neighbouring texel
   def point_on_sphere(self, theta, phi):
-    r = math.cos(phi)
-    return (r*math.cos(theta), r*math.sin(theta), math.sin(phi))
+    r = np.cos(phi)
+    return (r*np.cos(theta), r*np.sin(theta), np.sin(phi))
+
+  @staticmethod
+  def point_on_sphere_array(theta, phi):
+    r = np.cos(phi)
+    return (r*np.cos(theta), r*np.sin(theta), np.sin(phi))
+
+  # inverse of point_on_sphere_array; the elevation comes from arctan2, so
+  # the directions need not be unit length and keep their precision near
+  # the poles
+  @staticmethod
+  def angles_from_direction_array(x, y, z):
+    return np.arctan2(y, x), np.arctan2(z, np.sqrt(x*x + y*y))
+
+  # what _pixel_value returns where there is no sample: zero in every
+  # channel of the source, as sample_array gives there
+  def _no_sample(self):
+    channels, dtype = self.pixel_format()
+    return np.zeros(channels, dtype)
 
   def pixel_value(self, angle):
+    if self.rotation is not None and angle[0] is not None and angle[1] is not None:
+      theta, phi = self._rotate_angles(np.float64(angle[0]), np.float64(angle[1]))
+      angle = (float(theta), float(phi))
     if self.use_bilinear:
       return self._pixel_value_bilinear_interpolated(angle)
     else:
       return self._pixel_value(angle)
 
+  # array version of pixel_value; theta and phi are arrays of the same shape,
+  # NaN angles give zero pixels
+  def pixel_value_array(self, theta, phi):
+    u, v, face = self.texcoord_array(theta, phi)
+    return self.sample_array(u, v, face)
+
+  # source texture coordinates (u, v, face) for the given angles, after
+  # set_rotation
+  def texcoord_array(self, theta, phi):
+    if self.rotation is not None:
+      theta, phi = self._rotate_angles(theta, phi)
+    return self._texcoord_array(theta, phi)
+
+  # texcoord_array for unit direction vectors; the texture coordinates come
+  # back in the type of the directions
+  def texcoord_from_direction_array(self, x, y, z):
+    if self.rotation is not None:
+      x, y, z = self._rotate_directions(x, y, z)
+    return self._texcoord_from_direction(x, y, z)
+
+  # sample the source image[s] at texture coordinates from texcoord_array,
+  # filtered in texel space with the current interpolation mode, and from
+  # the matching mip level with mipmapping on. where, flat indices into u,
+  # takes just those samples, whose footprints are still measured on all of
+  # u and v
+  def sample_array(self, u, v, face, where=None):
+    if not self.mipmap:
+      if where is not None:
+        u, v, face = self._take_samples(where, u, v, face)
+      return self._sample_level(u, v, face)
+    levels = self._mip_levels()
+    lod = self._mip_lod(u, v, face, len(levels)-1)
+    if where is not None:
+      u, v, face, lod = self._take_samples(where, u, v, face, lod)
+    pixels = None
+    for level, where in self._mip_groups(lod, len(levels)):
+      if where is None:
+        pixels = levels[level]._sample_level(*self._mip_texcoords(level, u, v), face)
+        flat = pixels.reshape((-1,) + pixels.shape[u.ndim:])
+        continue
+      levelface = None if face is None else face.reshape(-1)[where]
+      flat[where] = levels[level]._sample_level(*self._mip_texcoords(level, u.reshape(-1)[where], v.reshape(-1)[where]), levelface)
+    return pixels
+
+  def _sample_level(self, u, v, face):
+    radius, kernel = FILTERS[self.interpolation]
+    if kernel is None:
+      return self._sample_array(u, v, face)
+
+    shape = np.shape(u)
+    u = np.reshape(u, -1)
+    v = np.reshape(v, -1)
+    valid = np.isfinite(u) & np.isfinite(v)
+    # texel i sits at u = i/width, the same convention get_pixel_from_uv and
+    # texcoord_grid use, so filtering an unscaled image leaves it unchanged
+    width, height = self.imsize
+    if not valid.all():
+      u = np.where(valid, u, 0.5)
+      v = np.where(valid, v, 0.5)
+    x = width*u
+    y = height*v
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    fx = (x - x0).astype(np.float32, copy=False)
+    fy = (y - y0).astype(np.float32, copy=False)
+    x0 = x0.astype(np.intp)
+    y0 = y0.astype(np.intp)
+    if face is not None:
+      face = np.where(valid, np.reshape(face, -1), 0).astype(np.intp)
+
+    channels, dtype = self.pixel_format()
+    fixed = dtype == np.uint8
+    offsets = range(1-radius, radius+1)
+    wx = self._filter_weights(kernel, fx, offsets, fixed)
+    wy = self._filter_weights(kernel, fy, offsets, fixed)
+
+    # footprints wholly inside the image are read at flat offsets from the
+    # texel of their first tap, without wrapping. The few that cross an
+    # edge are read clamped inside here and redone below with every tap
+    # wrapped
+    border = None
+    if width >= 2*radius and height >= 2*radius:
+      left = np.clip(x0, radius-1, width-1-radius)
+      top = np.clip(y0, radius-1, height-1-radius)
+      texels, base, pitch = self._flat_texels(face, left-(radius-1), top-(radius-1))
+      if texels is not None:
+        index = np.empty_like(base)
+        def inside(i, j):
+          return np.take(texels, np.add(base, j*pitch + i, out=index), axis=0)
+        pixels = self._blend(inside, wx, wy, dtype, fixed)
+        border = np.flatnonzero((left != x0) | (top != y0))
+    if border is None:
+      border = np.arange(x0.size)
+      pixels = np.empty((x0.size, channels), dtype)
+    if border.size:
+      face, x0, y0 = self._take_samples(border, face, x0, y0)
+      def wrapped(i, j):
+        return self._gather(*self._wrap_texels(face, x0+offsets[i], y0+offsets[j]))
+      pixels[border] = self._blend(wrapped, [w[border] for w in wx], [w[border] for w in wy], dtype, fixed)
+
+    if not valid.all():
+      pixels[~valid] = 0
+    return pixels.reshape(shape + (channels,))
+
+  # the weights of a filter's taps at offsets from texels a fraction f of a
+  # texel away, normalised so windowed kernels keep flat regions flat; as
+  # float32 arrays, or with fixed, integers that sum to exactly
+  # 1 << FILTER_BITS
+  @staticmethod
+  def _filter_weights(kernel, f, offsets, fixed):
+    weights = [kernel(f - k) for k in offsets]
+    norm = sum(weights)
+    if not fixed:
+      return [w/norm for w in weights]
+    scale = (1 << FILTER_BITS)/norm
+    centre = -offsets[0]
+    weights = [None if k == 0 else np.rint(w*scale).astype(np.int32) for k, w in zip(offsets, weights)]
+    # the tap at offset 0 takes what the others leave, so they sum exactly
+    weights[centre] = (1 << FILTER_BITS) - sum(w for w in weights if w is not None)
+    return weights
+
+  # the texels of a footprint weighted by wx[i]*wy[j] and summed, taps(i, j)
+  # returning those in its column i and row j, in dtype. Each row is summed
+  # before its weight is applied, and with fixed the sums are integers. The
+  # sums are kept a channel at a time, so every operation runs along the
+  # samples rather than along a handful of channels
+  @staticmethod
+  def _blend(taps, wx, wy, dtype, fixed):
+    work = np.int32 if fixed else np.float32
+    for j in range(len(wy)):
+      for i in range(len(wx)):
+        tap = taps(i, j).T
+        if i > 0:
+          np.multiply(tap, wx[i], out=weighted)
+          row += weighted
+          continue
+        if j == 0:
+          total = np.empty(tap.shape, work)
+          row = np.empty(tap.shape, work)
+          weighted = np.empty(tap.shape, work)
+        np.multiply(tap, wx[i], out=row)
+      if j == 0:
+        np.multiply(row, wy[j], out=total)
+      else:
+        row *= wy[j]
+        total += row
+    if fixed:
+      total += 1 << (2*FILTER_BITS-1)
+      total >>= 2*FILTER_BITS
+      np.clip(total, 0, 255, out=total)
+    elif np.issubdtype(dtype, np.integer):
+      info = np.iinfo(dtype)
+      np.clip(np.rint(total, out=total), info.min, info.max, out=total)
+    return total.T.astype(dtype, order='C')
+
+  # (level, face, x, y) integer coordinates of every texel sample_array
+  # reads for these texture coordinates, in groups of one mip level and
+  # filter tap; level is 0 without mipmapping, coordinates with no sample
+  # are left out, and face is None for single image sources
+  def sample_taps(self, u, v, face):
+    if not self.mipmap:
+      return [(0,) + tap for tap in self._level_taps(u, v, face)]
+    levels = self._mip_levels()
+    lod = self._mip_lod(u, v, face, len(levels)-1)
+    taps = []
+    for level, where in self._mip_groups(lod, len(levels)):
+      if where is None:
+        # just the pixels left at the most common level
+        where = np.flatnonzero(lod == level)
+      levelface = None if face is None else face.reshape(-1)[where]
+      taps.extend((level,) + tap for tap in levels[level]._level_taps(*self._mip_texcoords(level, u.reshape(-1)[where], v.reshape(-1)[where]), levelface))
+    return taps
+
+  # which samples at texture coordinates u, v read a texel marked in
+  # changed, the masks of changed_levels; a boolean array shaped like u
+  def changed_samples(self, u, v, face, changed):
+    hit = np.zeros(u.size, bool)
+    valid = np.isfinite(u) & np.isfinite(v)
+    if face is not None:
+      valid &= face >= 0
+    valid = valid.reshape(-1)
+    if self.mipmap:
+      levels = self._mip_levels()
+      lod = self._mip_lod(u, v, face, len(levels)-1).reshape(-1)
+      groups = [(level, np.flatnonzero(valid & (lod == level))) for level in np.unique(lod[valid])]
+    else:
+      levels = [self]
+      groups = [(0, np.flatnonzero(valid))]
+    reach = FILTERS[self.interpolation][0] + 1
+    for level, where in groups:
+      levelu, levelv, levelface = self._take_samples(where, u, v, face)
+      levelu, levelv = self._mip_texcoords(level, levelu, levelv)
+      # only samples whose taps can reach the bounds of the changed texels,
+      # or wrap round an edge of the image, need their taps looked at
+      width, height = levels[level].imsize
+      x = levelu*width
+      y = levelv*height
+      bounds = self._changed_bounds(changed[level])
+      bounds = bounds[:, 0] if levelface is None else bounds[:, levelface]
+      near = (x >= bounds[0]-reach) & (x < bounds[2]+reach) & (y >= bounds[1]-reach) & (y < bounds[3]+reach)
+      near |= (x < reach) | (x >= width-reach) | (y < reach) | (y >= height-reach)
+      near = np.flatnonzero(near)
+      where = where[near]
+      levelu, levelv, levelface = self._take_samples(near, levelu, levelv, levelface)
+      for tapface, x, y in levels[level]._level_taps(levelu, levelv, levelface):
+        hit[where] |= changed[level][y, x] if tapface is None else changed[level][tapface, y, x]
+    return hit.reshape(u.shape)
+
+  # (x0, y0, x1, y1) bounds of the texels set in a changed mask, one column
+  # per face for cubemap masks; faces with none set get empty bounds
+  @staticmethod
+  def _changed_bounds(mask):
+    faces = mask.reshape((-1,) + mask.shape[-2:])
+    bounds = np.empty((4, len(faces)))
+    bounds[:2] = np.inf
+    bounds[2:] = -np.inf
+    for index, face in enumerate(faces):
+      columns = np.flatnonzero(face.any(axis=0))
+      if columns.size:
+        rows = np.flatnonzero(face.any(axis=1))
+        bounds[:, index] = (columns[0], rows[0], columns[-1]+1, rows[-1]+1)
+    return bounds
+
+  # the samples at flat indices where of each array, None staying None
+  @staticmethod
+  def _take_samples(where, *arrays):
+    return tuple(None if a is None else a.reshape(-1)[where] for a in arrays)
+
+  def _level_taps(self, u, v, face):
+    valid = np.isfinite(u) & np.isfinite(v)
+    if face is not None:
+      valid &= face >= 0
+      face = face[valid]
+    x = self.imsize[0]*u[valid]
+    y = self.imsize[1]*v[valid]
+    radius, kernel = FILTERS[self.interpolation]
+    if kernel is None:
+      x = np.clip(x.astype(np.intp), 0, self.imsize[0]-1)
+      y = np.clip(y.astype(np.intp), 0, self.imsize[1]-1)
+      return [(face, x, y)]
+    x0 = np.floor(x).astype(np.intp)
+    y0 = np.floor(y).astype(np.intp)
+    offsets = range(1-radius, radius+1)
+    return [self._wrap_texels(face, x0+kx, y0+ky) for ky in offsets for kx in offsets]
+
+  # move integer texel coordinates that fall outside the image back inside
+  def _wrap_texels(self, face, x, y):
+    outside = (x < 0) | (x >= self.imsize[0]) | (y < 0) | (y >= self.imsize[1])
+    if not outside.any():
+      return face, x, y
+    outside = np.nonzero(outside)
+    x = x.copy()
+    y = y.copy()
+    if face is None:
+      _, x[outside], y[outside] = self._wrap_outside(None, x[outside], y[outside])
+    else:
+      face = face.copy()
+      face[outside], x[outside], y[outside] = self._wrap_outside(face[outside], x[outside], y[outside])
+    return face, x, y
+
+  # wrap just the out of range texels; clamps to the image edge by default,
+  # projections that wrap around the sphere override this
+  def _wrap_outside(self, face, x, y):
+    return face, np.clip(x, 0, self.imsize[0]-1), np.clip(y, 0, self.imsize[1]-1)
+
+  # fetch texels at integer coordinates returned by _wrap_texels
+  def _gather(self, face, x, y):
+    return self._take_texels(self.image, x, y)
+
+  # (texels, index, pitch): the image[s] as one (n, channels) array, the
+  # flat index into it of texels at integer coordinates inside the image,
+  # and the step between rows, so the texel j rows down and i columns
+  # across is at index + j*pitch + i. texels is None for images whose
+  # pixels cannot be viewed that way
+  def _flat_texels(self, face, x, y):
+    texels, pitch = self._texel_rows(self.image)
+    if texels is None:
+      return None, None, None
+    return texels, y*pitch + x, pitch
+
+  # an image's pixels as a view of (n, channels) texels, and the step
+  # between its rows in them; images that are views of a larger one, such
+  # as the eyes of a stereo frame, span the rows of the whole
+  @staticmethod
+  def _texel_rows(image):
+    height, width, channels = image.shape
+    if image.flags.c_contiguous:
+      return image.reshape((-1, channels)), width
+    pixel = channels*image.itemsize
+    if image.strides[2] != image.itemsize or image.strides[1] != pixel or image.strides[0] <= 0 or image.strides[0] % pixel:
+      return None, None
+    pitch = image.strides[0]//pixel
+    return np.lib.stride_tricks.as_strided(image, ((height-1)*pitch + width, channels), (pixel, image.itemsize)), pitch
+
+  # nearest neighbour sampling at texture coordinates from _texcoord_array
+  def _sample_array(self, u, v, face):
+    return self.get_pixel_from_uv_array(u, v, self.image)
+
   @abc.abstractmethod
   def _pixel_value(self, angle):
     return None
 
+  # returns (u, v, face) arrays for the given angles; face is None for
+  # projections backed by a single image
+  @abc.abstractmethod
+  def _texcoord_array(self, theta, phi):
+    return None
+
   @abc.abstractmethod
   def angular_position(self, texcoord):
     return None
 
+  # array version of angular_position; positions outside the projection come
+  # back as NaN
+  @abc.abstractmethod
+  def angular_position_array(self, u, v):
+    return None
+
+  # unit direction vectors through texture coordinates u, v, in their type;
+  # NaN outside the projection. Projections that can do without angles
+  # override this and _texcoord_from_direction
+  def direction_array(self, u, v):
+    return self.point_on_sphere_array(*self.angular_position_array(u, v))
+
+  # (u, v, face) arrays for unit direction vectors
+  def _texcoord_from_direction(self, x, y, z):
+    return self._texcoord_array(*self.angles_from_direction_array(x, y, z))
+
   @abc.abstractmethod
   def set_angular_resolution(self):
     return None
@@ -173,9 +1605,8 @@ class AbstractProjection:
     pixelC = self._pixel_value((angle[0]+angleeps, angle[1]-angleeps))
     pixelD = self._pixel_value((angle[0]+angleeps, angle[1]+angleeps))
 
-    oR = self.bilinear_interpolation(0,0, [(-1,-1, pixelA[0]), (-1,1, pixelB[0]), (1,-1, pixelC[0]), (1,1, pixelD[0])])
-    oG = self.bilinear_interpolation(0,0, [(-1,-1, pixelA[1]), (-1,1, pixelB[1]), (1,-1, pixelC[1]), (1,1, pixelD[1])])
-    oB = self.bilinear_interpolation(0,0, [(-1,-1, pixelA[2]), (-1,1, pixelB[2]), (1,-1, pixelC[2]), (1,1, pixelD[2])])
-    oA = self.bilinear_interpolation(0,0, [(-1,-1, pixelA[3]), (-1,1, pixelB[3]), (1,-1, pixelC[3]), (1,1, pixelD[3])])
+    _, dtype = self.pixel_format()
+    cast = int if np.issubdtype(dtype, np.integer) else float
+    return tuple(cast(self.bilinear_interpolation(0,0, [(-1,-1, float(a)), (-1,1, float(b)), (1,-1, float(c)), (1,1, float(d))]))
+                 for a, b, c, d in zip(pixelA, pixelB, pixelC, pixelD))
 
-    return (int(oR), int(oG), int(oB), int(oA))
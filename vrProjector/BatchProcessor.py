@@ -0,0 +1,257 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+import csv
+import json
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .CubemapProjection import CubemapProjection
+from .EquirectangularProjection import EquirectangularProjection
+from .FisheyeProjection import FisheyeProjection
+from .PerspectiveProjection import PerspectiveProjection
+from .Profiler import count
+from .RemapTable import RemapTable
+from .SideBySideFisheyeProjection import SideBySideFisheyeProjection
+from .StereoEquirectangularProjection import StereoEquirectangularProjection
+
+# Runs many conversions in one process. Jobs that share geometry are
+# grouped into chunks so a worker reuses the same warm mapping, chunks run
+# on a thread pool, and every job reports its own status so a failure
+# never stops the batch. Mappings are kept in memory (up to maxTables) and,
+# with remapCache, on disk between batches.
+class BatchProcessor:
+  PROJECTIONS = {
+    'equirectangular': EquirectangularProjection,
+    'sidebysidefisheye': SideBySideFisheyeProjection,
+    'cubemap': CubemapProjection,
+    'fisheye': FisheyeProjection,
+    'perspective': PerspectiveProjection,
+  }
+
+  # job fields that place a perspective output's viewport, in degrees
+  VIEW_FIELDS = ('yaw', 'pitch', 'roll', 'fov')
+
+  @staticmethod
+  def projectionClass(name):
+    projection = BatchProcessor.PROJECTIONS.get(name.lower())
+    if projection is None:
+      raise ValueError('Unsupported projection type %s, valid values are: Equirectangular, Cubemap, SideBySideFisheye, Fisheye, Perspective' % name)
+    return projection
+
+  # a new projection of type name; equirectangular projections with a
+  # layout (topbottom or sidebyside) are stereo pairs
+  @staticmethod
+  def newProjection(name, layout=None):
+    projection = BatchProcessor.projectionClass(name)
+    if projection is EquirectangularProjection and layout:
+      return StereoEquirectangularProjection(layout.lower())
+    return projection()
+
+  # manifest booleans: true, yes or 1 in any case; CSV fields are strings
+  @staticmethod
+  def parseFlag(value):
+    if isinstance(value, str):
+      return value.strip().lower() in ('true', 'yes', '1')
+    return bool(value)
+
+  # set_rotation arguments from "yaw,pitch,roll" in degrees or a "w,x,y,z"
+  # quaternion, given as a comma separated string or a list
+  @staticmethod
+  def parseRotation(value):
+    if isinstance(value, str):
+      value = value.split(',')
+    value = [float(v) for v in value]
+    if len(value) == 3:
+      return {'yaw': value[0], 'pitch': value[1], 'roll': value[2]}
+    if len(value) == 4:
+      return {'quaternion': value}
+    raise ValueError('Rotation must be yaw,pitch,roll or a w,x,y,z quaternion, got %d values' % len(value))
+
+  # a source projection loaded from an image, or for cubemaps from six space
+  # separated face images or one packed image in layout; see newProjection
+  # for stereo layouts
+  @staticmethod
+  def loadSource(name, image, layout=None, interpolation=None, rotation=None, mipmap=False):
+    source = BatchProcessor.newProjection(name, layout)
+    if isinstance(source, CubemapProjection):
+      if layout:
+        source.loadImage(image, layout.lower())
+      else:
+        source.loadImages(*image.split(' '))
+    else:
+      source.loadImage(image)
+    if interpolation:
+      source.set_interpolation(interpolation.lower())
+    if rotation:
+      source.set_rotation(**BatchProcessor.parseRotation(rotation))
+    if mipmap:
+      source.set_mipmap(True)
+    return source
+
+  # view is a dict of VIEW_FIELDS for perspective outputs, pixelFormat the
+  # (channels, dtype) of the source, which the output keeps, or None for
+  # RGBA uint8, precision one of PRECISIONS and filename a .npy file the
+  # output is memory-mapped to, as for initImage; cubemaps are kept in memory
+  @staticmethod
+  def initTarget(name, width, height, layout=None, view=None, pixelFormat=None, precision=None, filename=None):
+    out = BatchProcessor.newProjection(name, layout)
+    pixelFormat = () if pixelFormat is None else out.output_format(pixelFormat)
+    if isinstance(out, PerspectiveProjection) and view:
+      out.set_view(**dict((field, float(value)) for field, value in view.items()))
+    if precision:
+      out.set_precision(precision.lower())
+    if isinstance(out, CubemapProjection):
+      out.initImages(int(width), int(height), layout.lower() if layout else None, *pixelFormat)
+    else:
+      out.initImage(int(width), int(height), filename, *pixelFormat)
+    return out
+
+  # fill out, from initTarget, with the image[s] of a name projection an
+  # earlier conversion saved, as for loadSource, so reprojectToThisChanged
+  # can update them
+  @staticmethod
+  def loadTarget(out, name, image, layout=None):
+    previous = BatchProcessor.loadSource(name, image, layout)
+    if isinstance(out, CubemapProjection):
+      images, saved = out._faces(), previous._faces()
+    else:
+      images, saved = out._images(), previous._images()
+    for target, pixels in zip(images, saved):
+      if target.shape[:2] != pixels.shape[:2]:
+        raise ValueError('%s is %dx%d, not the %dx%d of the output' % (image, pixels.shape[1], pixels.shape[0], target.shape[1], target.shape[0]))
+      target[...] = out._fit_pixels(pixels, None, target.shape[-1], target.dtype)
+    return out
+
+  # save to image, or six space separated face images for unpacked cubemaps,
+  # with the compression and quality of set_encoding when given. Returns the
+  # seconds each face took for unpacked cubemaps, as saveImages does, and
+  # None otherwise
+  @staticmethod
+  def saveTarget(out, image, compression=None, quality=None):
+    if compression is not None or quality is not None:
+      out.set_encoding(None if compression is None else int(compression), None if quality is None else int(quality))
+    if isinstance(out, CubemapProjection) and getattr(out, 'layout', None) is None:
+      return out.saveImages(*image.split(' '))
+    out.saveImage(image)
+    return None
+
+  # jobs from a manifest of JSON lines or CSV with a header row, using the
+  # field names of vrProjectorCmd: sourceProjection, sourceImage, outProjection,
+  # outImage, outWidth, outHeight and optionally id, interpolation,
+  # sourceLayout, outLayout, rotation, mipmap, precision, compression,
+  # quality and the VIEW_FIELDS
+  @staticmethod
+  def readManifest(stream, format=None):
+    lines = [line for line in stream if line.strip()]
+    if format is None:
+      format = 'jsonl' if lines and lines[0].lstrip().startswith('{') else 'csv'
+    if format == 'jsonl':
+      return [json.loads(line) for line in lines]
+    if format == 'csv':
+      return [dict((k, v) for k, v in row.items() if v not in (None, '')) for row in csv.DictReader(lines)]
+    raise ValueError('Unsupported manifest format %s, valid values are: jsonl, csv' % format)
+
+  # jobs with the same geometry key can share a mapping once their sources
+  # are loaded
+  @staticmethod
+  def geometryKey(job):
+    return tuple(str(job.get(field, '')).lower() for field in
+                 ('sourceProjection', 'sourceLayout', 'outProjection', 'outWidth', 'outHeight', 'outLayout', 'interpolation', 'rotation', 'precision') + BatchProcessor.VIEW_FIELDS)
+
+  def __init__(self, workers=1, remapCache=None, chunkSize=16, maxTables=32):
+    self.workers = workers
+    self.remapCache = remapCache
+    self.chunkSize = chunkSize
+    self.maxTables = maxTables
+    self.tables = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.building = {}
+
+  # the mapping for this pair, shared by every job with the same description
+  def remapTable(self, out, source):
+    key = json.dumps(RemapTable.describe(out, source), sort_keys=True)
+    with self.lock:
+      table = self.tables.get(key)
+      if table is not None:
+        self.tables.move_to_end(key)
+        count('batch.tableHit')
+        return table
+      building = self.building.setdefault(key, threading.Lock())
+    # one thread builds a missing table while the others for it wait
+    with building:
+      with self.lock:
+        table = self.tables.get(key)
+      if table is None:
+        count('batch.tableMiss')
+        if self.remapCache is not None:
+          table = self.remapCache.lookup(out, source)
+        else:
+          table = RemapTable.build(out, source)
+        with self.lock:
+          self.tables[key] = table
+          while len(self.tables) > self.maxTables:
+            self.tables.popitem(last=False)
+          self.building.pop(key, None)
+      return table
+
+  def runJob(self, job):
+    source = self.loadSource(job['sourceProjection'], job['sourceImage'], job.get('sourceLayout'), job.get('interpolation'), job.get('rotation'),
+                             BatchProcessor.parseFlag(job.get('mipmap')))
+    view = dict((field, job[field]) for field in self.VIEW_FIELDS if field in job)
+    out = self.initTarget(job['outProjection'], job['outWidth'], job['outHeight'], job.get('outLayout'), view, source.pixel_format(), job.get('precision'))
+    out.reprojectToThis(source, remapTable=self.remapTable(out, source))
+    self.saveTarget(out, job['outImage'], job.get('compression'), job.get('quality'))
+
+  def _runChunk(self, chunk, report):
+    for index, job in chunk:
+      start = time.time()
+      result = {'job': index}
+      if 'id' in job:
+        result['id'] = job['id']
+      try:
+        self.runJob(job)
+        result['status'] = 'ok'
+      except Exception as e:
+        result['status'] = 'error'
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+      result['seconds'] = time.time() - start
+      with self.lock:
+        report(result)
+
+  # run every job, calling report(result) once per job as it finishes;
+  # returns the number of jobs that failed
+  def run(self, jobs, report):
+    groups = collections.OrderedDict()
+    for index, job in enumerate(jobs):
+      groups.setdefault(self.geometryKey(job), []).append((index, job))
+    chunks = []
+    for group in groups.values():
+      chunks.extend(group[i:i+self.chunkSize] for i in range(0, len(group), self.chunkSize))
+
+    failures = [0]
+    def counted(result):
+      if result['status'] != 'ok':
+        failures[0] += 1
+      report(result)
+
+    if self.workers <= 1:
+      for chunk in chunks:
+        self._runChunk(chunk, counted)
+    else:
+      with ThreadPoolExecutor(max_workers=self.workers) as pool:
+        for future in [pool.submit(self._runChunk, chunk, counted) for chunk in chunks]:
+          future.result()
+    return failures[0]
@@ -10,14 +10,57 @@
 # limitations under the License.
 
 
-from .AbstractProjection import AbstractProjection
-from PIL import Image
+from .AbstractProjection import AbstractProjection, _check_dtype
+from .Profiler import span
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import math
+import numpy as np
+import time
+
+FACES = ('front', 'right', 'back', 'left', 'top', 'bottom')
+
+# (centre, u axis, v axis) of each face of the cube with half-edge 1, in
+# faces order; face-local (a, b) in -1..1 points along
+# centre + a*uaxis + b*vaxis
+FACE_AXES = np.array((
+  ((1, 0, 0), (0, 1, 0), (0, 0, 1)),     # front
+  ((0, 1, 0), (-1, 0, 0), (0, 0, 1)),    # right
+  ((-1, 0, 0), (0, -1, 0), (0, 0, 1)),   # back
+  ((0, -1, 0), (1, 0, 0), (0, 0, 1)),    # left
+  ((0, 0, -1), (0, 1, 0), (1, 0, 0)),    # top
+  ((0, 0, 1), (0, 1, 0), (-1, 0, 0)),    # bottom
+), dtype=np.float64)
+
+# packed layouts: (columns, rows, (row, column) cell of each face). Faces
+# are placed unrotated; bottom edge of top and top edge of bottom meet front
+LAYOUTS = {
+  'strip': (6, 1, ((0, 0), (0, 1), (0, 2), (0, 3), (0, 4), (0, 5))),
+  'cross': (4, 3, ((1, 1), (1, 2), (1, 3), (1, 0), (0, 1), (2, 1))),
+  'grid': (3, 2, ((0, 1), (0, 2), (1, 1), (0, 0), (1, 2), (1, 0))),
+}
+
+# front, right, back, left, top and bottom are views into the stacked
+# (6, height, width, channels) faces array; assigning to one copies the new
+# face into the stack
+def _face_property(idx):
+  def get(self):
+    return self.faces[idx]
+  def set(self, image):
+    self.faces[idx][...] = image
+  return property(get, set)
 
 class CubemapProjection(AbstractProjection):
   def __init__(self):
     AbstractProjection.__init__(self)
 
+  front = _face_property(0)
+  right = _face_property(1)
+  back = _face_property(2)
+  left = _face_property(3)
+  top = _face_property(4)
+  bottom = _face_property(5)
+
   def set_angular_resolution(self):
     # imsize on a face: covers 90 degrees
     #     |\
@@ -28,97 +71,270 @@ class CubemapProjection(AbstractProjection):
     #  angular res ~= arctan(1/self.imsize[0], 0.5)
     self.angular_resolution = math.atan2(1/self.imsize[0], 0.5)
 
-  def loadImages(self, front, right, back, left, top, bottom):
-    self.front, self.imsize = self._loadImage(front)
-    self.right, self.imsize = self._loadImage(right)
-    self.back, self.imsize = self._loadImage(back)
-    self.left, self.imsize = self._loadImage(left)
-    self.top, self.imsize = self._loadImage(top)
-    self.bottom, self.imsize = self._loadImage(bottom)
+  # calls function(*arguments) for each face's arguments on up to workers
+  # threads; image codecs release the GIL, so faces decode and encode side by
+  # side. Returns the results in faces order and the seconds each face took,
+  # by name
+  @staticmethod
+  def _each_face(function, arguments, workers):
+    def timed(args):
+      start = time.perf_counter()
+      result = function(*args)
+      return result, time.perf_counter() - start
+    if workers <= 1:
+      timings = [timed(args) for args in arguments]
+    else:
+      with ThreadPoolExecutor(max_workers=min(workers, len(arguments))) as pool:
+        timings = list(pool.map(timed, arguments))
+    return [result for result, _ in timings], dict((name, seconds) for name, (_, seconds) in zip(FACES, timings))
+
+  # returns the seconds each face took to load, by name
+  def loadImages(self, front, right, back, left, top, bottom, workers=6):
+    files = (front, right, back, left, top, bottom)
+    with span('loadFaces', workers=workers):
+      loaded, seconds = self._each_face(self._loadImage, [(imageFile,) for imageFile in files], workers)
+    faces = []
+    for imageFile, (image, imsize) in zip(files, loaded):
+      if faces and imsize != self.imsize:
+        raise ValueError('Cubemap faces must all be the same size: %s is %dx%d, expected %dx%d' % ((imageFile,) + imsize + self.imsize))
+      self.imsize = imsize
+      faces.append(image)
+    # faces are sampled together, so give them all the same band count and
+    # the widest pixel type among them
+    channels = max(image.shape[-1] for image in faces)
+    dtype = np.result_type(*faces)
+    self.faces = np.stack([self._fit_pixels(image, None, channels, dtype) for image in faces])
     self.set_angular_resolution()
+    return seconds
 
-  def initImages(self, width, height):
+  # layout, one of LAYOUTS, renders the faces straight into a single packed
+  # image; faces is then a list of six views into it. channels and dtype
+  # are as for initImage
+  def initImages(self, width, height, layout=None, channels=4, dtype=np.uint8):
+    dtype = _check_dtype(dtype)
     self.imsize = (width, height)
-    self.front = self._initImage(width, height)
-    self.right = self._initImage(width, height)
-    self.back = self._initImage(width, height)
-    self.left = self._initImage(width, height)
-    self.top = self._initImage(width, height)
-    self.bottom = self._initImage(width, height)
+    self.layout = layout
+    if layout is None:
+      self.packed = None
+      self.faces = np.ndarray((6, height, width, channels), dtype=dtype)
+    else:
+      columns, rows, _ = self._layout(layout)
+      self.packed = np.zeros((rows*height, columns*width, channels), dtype=dtype)
+      self.faces = self._unpack(self.packed, layout, self.imsize)
+    self.set_angular_resolution()
+
+  @staticmethod
+  def _layout(layout):
+    if layout not in LAYOUTS:
+      raise ValueError('Unsupported cubemap layout %s, valid values are: %s' % (layout, ', '.join(sorted(LAYOUTS))))
+    return LAYOUTS[layout]
+
+  # views of the six faces in a packed image
+  @classmethod
+  def _unpack(cls, packed, layout, imsize):
+    columns, rows, cells = cls._layout(layout)
+    width, height = imsize
+    if packed.shape[:2] != (rows*height, columns*width):
+      raise ValueError('A %s layout of %dx%d faces is %dx%d, got %dx%d' % (layout, width, height, columns*width, rows*height, packed.shape[1], packed.shape[0]))
+    return [packed[row*height:(row+1)*height, column*width:(column+1)*width] for row, column in cells]
+
+  # load a packed cubemap image; the faces are copied into one stack
+  def loadImage(self, imageFile, layout):
+    packed, packedsize = self._loadImage(imageFile)
+    columns, rows, _ = self._layout(layout)
+    self.imsize = (packedsize[0]//columns, packedsize[1]//rows)
+    self.faces = np.stack(self._unpack(packed, layout, self.imsize))
     self.set_angular_resolution()
 
-  def saveImages(self, front, right, back, left, top, bottom):
-    self._saveImage(self.front, self.imsize, front)
-    self._saveImage(self.right, self.imsize, right)
-    self._saveImage(self.back, self.imsize, back)
-    self._saveImage(self.left, self.imsize, left)
-    self._saveImage(self.top, self.imsize, top)
-    self._saveImage(self.bottom, self.imsize, bottom)
+  # save the faces as one packed image; faces rendered with the same layout
+  # are saved without another copy
+  def saveImage(self, destFile, layout=None):
+    if layout is None:
+      layout = getattr(self, 'layout', None)
+      if layout is None:
+        raise ValueError('Cubemap was not rendered to a packed layout, pass one of: %s' % ', '.join(sorted(LAYOUTS)))
+    if layout == getattr(self, 'layout', None):
+      packed = self.packed
+    else:
+      columns, rows, _ = self._layout(layout)
+      packed = np.zeros((rows*self.imsize[1], columns*self.imsize[0], self.faces[0].shape[-1]), dtype=self.faces[0].dtype)
+      for view, face in zip(self._unpack(packed, layout, self.imsize), self._faces()):
+        view[...] = face
+    self._saveImage(packed, (packed.shape[1], packed.shape[0]), destFile, **self._encoding())
+
+  # with the encoding of set_encoding; returns the seconds each face took
+  # to save, by name
+  def saveImages(self, front, right, back, left, top, bottom, workers=6):
+    encoding = self._encoding()
+    def save(face, destFile):
+      self._saveImage(face, self.imsize, destFile, **encoding)
+    with span('saveFaces', workers=workers):
+      return self._each_face(save, list(zip(self._faces(), (front, right, back, left, top, bottom))), workers)[1]
 
   def _pixel_value(self, angle):
     theta = angle[0]
     phi = angle[1]
     if theta is None or phi is None:
-      return (0,0,0)
+      return self._no_sample()
 
     sphere_pnt = self.point_on_sphere(theta, phi)
-    x = sphere_pnt[0]
-    y = sphere_pnt[1]
-    z = sphere_pnt[2]
-
-    eps = 1e-6
-
-    if math.fabs(x)>eps:
-      if x>0:
-        t = 0.5/x
-        u = 0.5+t*y
-        v = 0.5+t*z
-        if u>=0.0 and u<=1.0 and v>=0.0 and v<=1.0:
-          return self.get_pixel_from_uv(u, v, self.front)
-      elif x<0:
-        t = 0.5/-x
-        u = 0.5+t*-y
-        v = 0.5+t*z
-        if u>=0.0 and u<=1.0 and v>=0.0 and v<=1.0:
-          return self.get_pixel_from_uv(u, v, self.back)
-
-    if math.fabs(y)>eps:
-      if y>0:
-        t = 0.5/y
-        u = 0.5+t*-x
-        v = 0.5+t*z
-        if u>=0.0 and u<=1.0 and v>=0.0 and v<=1.0:
-          return self.get_pixel_from_uv(u, v, self.right)
-      elif y<0:
-        t = 0.5/-y
-        u = 0.5+t*x
-        v = 0.5+t*z
-        if u>=0.0 and u<=1.0 and v>=0.0 and v<=1.0:
-          return self.get_pixel_from_uv(u, v, self.left)
-
-    if math.fabs(z)>eps:
-      if z>0:
-        t = 0.5/z
-        u = 0.5+t*y
-        v = 0.5+t*-x
-        if u>=0.0 and u<=1.0 and v>=0.0 and v<=1.0:
-          return self.get_pixel_from_uv(u, v, self.bottom)
-      elif z<0:
-        t = 0.5/-z
-        u = 0.5+t*y
-        v = 0.5+t*x
-        if u>=0.0 and u<=1.0 and v>=0.0 and v<=1.0:
-          return self.get_pixel_from_uv(u, v, self.top)
+    u, v, face = self._face_texcoord(*sphere_pnt)
+    return self.get_pixel_from_uv(u, v, self.faces[face])
 
-    return None
+  # the face a direction points at is the one of its dominant axis, so every
+  # direction lands on exactly one face; ties go to x, then y, then z.
+  # _texcoord_from_direction does the same arithmetic on arrays
+  @staticmethod
+  def _face_texcoord(x, y, z):
+    ax = math.fabs(x)
+    ay = math.fabs(y)
+    az = math.fabs(z)
+    if ax >= ay and ax >= az:
+      t = 0.5/ax
+      if x > 0:
+        return 0.5+t*y, 0.5+t*z, 0     # front
+      return 0.5+t*-y, 0.5+t*z, 2      # back
+    if ay >= az:
+      t = 0.5/ay
+      if y > 0:
+        return 0.5+t*-x, 0.5+t*z, 1    # right
+      return 0.5+t*x, 0.5+t*z, 3       # left
+    t = 0.5/az
+    if z > 0:
+      return 0.5+t*y, 0.5+t*-x, 5      # bottom
+    return 0.5+t*y, 0.5+t*x, 4         # top
+
+  # faces may be a list of views into a packed image; the list is stacked
+  # when the mip levels are built
+  def _mip_source(self):
+    return self.faces
+
+  def _mip_level(self, faces):
+    level = copy.copy(self)
+    level.mipmap = False
+    level._mips = None
+    level.faces = faces
+    level.packed = None
+    level.imsize = (faces.shape[2], faces.shape[1])
+    return level
+
+  # every output row covers all six faces
+  def _pixels_per_row(self):
+    return 6*self.imsize[0]
+
+  # face order of the stacked faces array
+  def _faces(self):
+    return tuple(self.faces)
+
+  def _images(self):
+    if getattr(self, 'packed', None) is not None:
+      return (self.packed,)
+    return self._faces()
+
+  def _texcoord_array(self, theta, phi):
+    x, y, z = self.point_on_sphere_array(theta, phi)
+    return self._texcoord_from_direction(x, y, z)
+
+  # array version of _face_texcoord; directions that are NaN or zero get
+  # NaN texture coordinates and face -1
+  def _texcoord_from_direction(self, x, y, z):
+    ax = np.abs(x)
+    ay = np.abs(y)
+    az = np.abs(z)
+    onx = (ax >= ay) & (ax >= az)
+    ony = ~onx & (ay >= az)
+    onz = ~onx & ~ony
+    major = np.where(onx, ax, np.where(ony, ay, az))
+
+    face = np.select([onx & (x > 0), onx, ony & (y > 0), ony, onz & (z > 0)], [0, 2, 1, 3, 5], 4).astype(np.int8)
+    du = np.select([face == 0, face == 2, face == 1, face == 3], [y, -y, -x, x], y)
+    dv = np.select([face <= 3, face == 5], [z, -x], x)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      t = 0.5/major
+      u = 0.5+t*du
+      v = 0.5+t*dv
+
+    missing = ~(np.isfinite(u) & np.isfinite(v))
+    if missing.any():
+      u[missing] = np.nan
+      v[missing] = np.nan
+      face[missing] = -1
+    return u, v, face
+
+  def _sample_array(self, u, v, face):
+    valid = (face >= 0) & np.isfinite(u) & np.isfinite(v)
+    x = (self.imsize[0]*np.where(valid, u, 0.0)).astype(np.intp)
+    y = (self.imsize[1]*np.where(valid, v, 0.0)).astype(np.intp)
+    x = np.clip(x, 0, self.imsize[0]-1)
+    y = np.clip(y, 0, self.imsize[1]-1)
+    pixels = self._gather(np.where(valid, face, 0), x, y)
+    pixels[~valid] = 0
+    return pixels
+
+  # direction through face-local texture coordinates (u, v); inverse of
+  # _texcoord_from_direction
+  @staticmethod
+  def _face_direction(face, u, v):
+    axes = FACE_AXES[face]
+    a = (2.0*u-1.0)[..., np.newaxis]
+    b = (2.0*v-1.0)[..., np.newaxis]
+    direction = axes[..., 0, :] + a*axes[..., 1, :] + b*axes[..., 2, :]
+    return direction[..., 0], direction[..., 1], direction[..., 2]
+
+  # texels that fall off a face are looked up on the neighbouring face, so
+  # filtering is continuous across cube edges
+  def _wrap_outside(self, face, x, y):
+    width, height = self.imsize
+    u = (x + 0.5) / width
+    v = (y + 0.5) / height
+    u, v, face = self._texcoord_from_direction(*self._face_direction(face, u, v))
+    x = (u*width).astype(np.intp)
+    y = (v*height).astype(np.intp)
+    return face, np.clip(x, 0, width-1), np.clip(y, 0, height-1)
+
+  # one gather from the faces stacked on top of each other, or when they
+  # are views into a packed image, from the packed image itself
+  def _gather(self, face, x, y):
+    face = face.astype(np.intp)
+    if not isinstance(self.faces, np.ndarray):
+      width, height = self.imsize
+      cells = np.array(self._layout(self.layout)[2], np.intp)
+      return self._take_texels(self.packed, cells[face, 1]*width + x, cells[face, 0]*height + y)
+    column = self.faces.reshape((-1,) + self.faces.shape[2:])
+    return self._take_texels(column, x, face*self.imsize[1] + y)
+
+  # in NumPy's arithmetic, like get_theta_phi_array
+  # flat indices into the stacked faces, or into the packed image, with
+  # the face's row and column offsets added
+  def _flat_texels(self, face, x, y):
+    face = face.astype(np.intp)
+    width, height = self.imsize
+    packed = not isinstance(self.faces, np.ndarray)
+    texels, pitch = self._texel_rows(self.packed if packed else self.faces.reshape((-1,) + self.faces.shape[2:]))
+    if texels is None:
+      return None, None, None
+    if packed:
+      cells = np.array(self._layout(self.layout)[2], np.intp)
+      return texels, (cells[face, 0]*height + y)*pitch + cells[face, 1]*width + x, pitch
+    return texels, (face*height + y)*pitch + x, pitch
 
   def get_theta_phi(self, _x, _y, _z):
-    dv = math.sqrt(_x*_x + _y*_y + _z*_z)
+    dv = np.sqrt(_x*_x + _y*_y + _z*_z)
+    x = _x/dv
+    y = _y/dv
+    z = _z/dv
+    theta = np.arctan2(y, x)
+    phi = np.arcsin(z)
+    return theta, phi
+
+  @staticmethod
+  def get_theta_phi_array(_x, _y, _z):
+    dv = np.sqrt(_x*_x + _y*_y + _z*_z)
     x = _x/dv
     y = _y/dv
     z = _z/dv
-    theta = math.atan2(y, x)
-    phi = math.asin(z)
+    theta = np.arctan2(y, x)
+    phi = np.arcsin(z)
     return theta, phi
 
   @staticmethod
@@ -127,7 +343,83 @@ class CubemapProjection(AbstractProjection):
     v = texcoord[1]
     return None
 
-  def reprojectToThis(self, sourceProjection):
+  @staticmethod
+  def angular_position_array(u, v):
+    return None
+
+  # angles for all six faces, stacked in _faces() order
+  def angular_grid(self, rows=slice(None)):
+    return self.get_theta_phi_array(*self._face_directions(rows))
+
+  # unit direction vectors for all six faces, stacked in _faces() order
+  def direction_grid(self, rows=slice(None), dtype=np.float32):
+    x, y, z = directions = self._face_directions(rows, dtype)
+    norm = np.sqrt(x*x + y*y + z*z)
+    directions /= norm
+    return x, y, z
+
+  # the direction vectors of all six faces, built as one (3, 6, rows,
+  # width) array of dtype; each component of a face is a constant, u or v,
+  # so no multiplies are wasted
+  def _face_directions(self, rows=slice(None), dtype=np.float64):
+    u, v = self.texcoord_grid(rows, dtype)
+    u = 2.0*(u-0.5)
+    v = 2.0*(v-0.5)
+    directions = np.empty((3, 6) + u.shape, dtype)
+    for face, axes in enumerate(FACE_AXES):
+      for i, (centre, ucoef, vcoef) in enumerate(axes.T):
+        if ucoef:
+          np.multiply(u, ucoef, out=directions[i, face])
+        elif vcoef:
+          np.multiply(v, vcoef, out=directions[i, face])
+        else:
+          directions[i, face] = centre
+    return directions
+
+  def _store_pixels(self, pixels, invalid, rows=slice(None)):
+    channels, dtype = self.pixel_format()
+    pixels = self._fit_pixels(pixels, invalid, channels, dtype)
+    if isinstance(self.faces, np.ndarray):
+      self.faces[:, rows] = pixels
+    else:
+      for face, facepixels in zip(self.faces, pixels):
+        face[rows] = facepixels
+
+  # pixels at flat indices into the (6, rows, width) band, as from
+  # angular_grid(rows)
+  def _store_pixels_at(self, pixels, flat, rows=slice(None)):
+    channels, dtype = self.pixel_format()
+    pixels = self._fit_pixels(pixels, None, channels, dtype)
+    start, stop, _ = rows.indices(self.imsize[1])
+    face, y, x = np.unravel_index(flat, (6, stop-start, self.imsize[0]))
+    y += start
+    if isinstance(self.faces, np.ndarray):
+      self.faces[face, y, x] = pixels
+    else:
+      for index, image in enumerate(self.faces):
+        on = face == index
+        image[y[on], x[on]] = pixels[on]
+
+  def _changed_rectangle(self, rectangle):
+    if len(rectangle) != 5 or not 0 <= int(rectangle[0]) < 6:
+      raise ValueError('Changed rectangles are face,x0,y0,x1,y1 with face 0 to 5, got %s' % ','.join(str(v) for v in rectangle))
+    return tuple(int(v) for v in rectangle)
+
+  def changed_mask(self, rectangles):
+    width, height = self.imsize
+    mask = np.zeros((6, height, width), bool)
+    for face, x0, y0, x1, y1 in (self._changed_rectangle(rectangle) for rectangle in rectangles):
+      mask[face, max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)] = True
+    return mask
+
+  # past the edge of the face, the face's plane carries on onto the next
+  def _texel_directions(self, face, u, v):
+    x, y, z = self._face_direction(face, u, v)
+    norm = np.sqrt(x*x + y*y + z*z)
+    return x/norm, y/norm, z/norm
+
+  # reference per-pixel implementation of reprojectToThis
+  def reprojectToThisScalar(self, sourceProjection):
     halfcubeedge = 1.0
 
     for x in range(self.imsize[0]):
@@ -137,30 +429,24 @@ class CubemapProjection(AbstractProjection):
 
         # front
         theta, phi = self.get_theta_phi(halfcubeedge, u, v)
-        pixel = sourceProjection.pixel_value((theta, phi))
-        self.front[y,x] = pixel
+        self.front[y,x] = self._scalar_pixel(sourceProjection, theta, phi, self.front)
 
         # right
         theta, phi = self.get_theta_phi(-u, halfcubeedge, v)
-        pixel = sourceProjection.pixel_value((theta, phi))
-        self.right[y,x] = pixel
+        self.right[y,x] = self._scalar_pixel(sourceProjection, theta, phi, self.right)
 
         # left
         theta, phi = self.get_theta_phi(u, -halfcubeedge, v)
-        pixel = sourceProjection.pixel_value((theta, phi))
-        self.left[y,x] = pixel
+        self.left[y,x] = self._scalar_pixel(sourceProjection, theta, phi, self.left)
 
         # back
         theta, phi = self.get_theta_phi(-halfcubeedge, -u, v)
-        pixel = sourceProjection.pixel_value((theta, phi))
-        self.back[y,x] = pixel
+        self.back[y,x] = self._scalar_pixel(sourceProjection, theta, phi, self.back)
 
         # bottom
         theta, phi = self.get_theta_phi(-v, u, halfcubeedge)
-        pixel = sourceProjection.pixel_value((theta, phi))
-        self.bottom[y,x] = pixel
+        self.bottom[y,x] = self._scalar_pixel(sourceProjection, theta, phi, self.bottom)
 
         # top
         theta, phi = self.get_theta_phi(v, u, -halfcubeedge)
-        pixel = sourceProjection.pixel_value((theta, phi))
-        self.top[y,x] = pixel
+        self.top[y,x] = self._scalar_pixel(sourceProjection, theta, phi, self.top)
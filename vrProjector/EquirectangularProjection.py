@@ -12,6 +12,7 @@
 
 from .AbstractProjection import AbstractProjection
 import math
+import numpy as np
 
 class EquirectangularProjection(AbstractProjection):
   def __init__(self):
@@ -24,13 +25,32 @@ class EquirectangularProjection(AbstractProjection):
     theta = angle[0]
     phi = angle[1]
     if theta is None or phi is None:
-      return (0,0,0)
+      return self._no_sample()
     # theta: -pi..pi -> u: 0..1
     u = 0.5+0.5*(theta/math.pi)
     # phi: -pi/2..pi/2 -> v: 0..1
     v = 0.5+(phi/math.pi)
     return self.get_pixel_from_uv(u,v, self.image)
 
+  def _texcoord_array(self, theta, phi):
+    u = 0.5+0.5*(theta/np.pi)
+    v = 0.5+(phi/np.pi)
+    return u, v, None
+
+  def _texel_delta(self, dx, dy):
+    width = self.imsize[0]
+    return dx - width*np.round(dx/width), dy
+
+  # wrap around the longitude seam, and reflect over the poles onto the
+  # opposite meridian. Texel i sits at v = i/height, so the north pole is
+  # row 0 and the south pole y = height, one past the last row
+  def _wrap_outside(self, face, x, y):
+    width, height = self.imsize
+    over = (y < 0) | (y >= height)
+    y = np.where(y < 0, -y, np.where(y >= height, 2*height-y, y))
+    x = np.where(over, x + width//2, x)
+    return face, np.mod(x, width), np.clip(y, 0, height-1)
+
   @staticmethod
   def angular_position(texcoord):
     u = texcoord[0]
@@ -40,3 +60,13 @@ class EquirectangularProjection(AbstractProjection):
     # phi: v: 0..1 - > -pi/2..pi/2
     phi = math.pi*(v-0.5)
     return (theta,phi)
+
+
+  @staticmethod
+  def angular_position_array(u, v):
+    theta = np.pi*2.0*(u-0.5)
+    phi = np.pi*(v-0.5)
+    return (theta,phi)
+
+  def direction_grid(self, rows=slice(None), dtype=np.float32):
+    return self._latlong_direction_grid(rows, dtype)
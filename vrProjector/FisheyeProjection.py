@@ -12,6 +12,7 @@
 
 from .AbstractProjection import AbstractProjection
 import math
+import numpy as np
 
 class FisheyeProjection(AbstractProjection):
   def __init__(self):
@@ -22,13 +23,12 @@ class FisheyeProjection(AbstractProjection):
 
   def _pixel_value(self, angle):
     FOV = math.pi
-    
+
+    if angle[0] is None or angle[1] is None:
+      return self._no_sample()
     theta = angle[0] * 0.5
     phi = angle[1]
-    if theta is None or phi is None:
-      return (0,0,0)
 
-    
     # phi: -pi/2..pi/2 
     # theta: -pi..pi
 
@@ -38,15 +38,60 @@ class FisheyeProjection(AbstractProjection):
     p_x = pt[1]
     p_z = pt[2]
 
-    theta_l = math.atan2(p_z,p_x);
-    phi_l = math.atan2(math.sqrt(p_x*p_x+p_z*p_z),p_y);
-    r = phi_l / FOV;
+    # the arithmetic of _lens_texcoord, one direction at a time
+    s = np.sqrt(p_x*p_x+p_z*p_z)
+    phi_l = np.arctan2(s,p_y)
+    if s > 0:
+      k = phi_l / (FOV*s)
+      u = 0.5 + k*p_x
+      v = 0.5 + k*p_z
+    else:
+      u = 0.5 + phi_l/FOV
+      v = 0.5
 
-    u = 0.5 + r * math.cos(theta_l);
-    v = 0.5 + r * math.sin(theta_l);    
-    
     return self.get_pixel_from_uv(u,v, self.image)
 
+  def _texcoord_array(self, theta, phi):
+    theta = theta * 0.5
+    p_y, p_x, p_z = self.point_on_sphere_array(theta, phi)
+    return self._lens_texcoord(p_x, p_y, p_z)
+
+  # the longitude is halved before the lens maps it, so the direction is
+  # turned half way back to the x axis without going through angles: cos
+  # and sin of half the longitude are (r+x, y) normalised, or where x < 0,
+  # and r+x loses precision, (|y|, r-x) with the sign of y
+  def _texcoord_from_direction(self, x, y, z):
+    r = np.sqrt(x*x + y*y)
+    front = x >= 0
+    a = np.where(front, r + x, np.abs(y))
+    b = np.where(front, y, np.copysign(r - x, y))
+    n = np.sqrt(a*a + b*b)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      k = r/n
+    # at the poles the longitude is 0
+    k[n == 0] = 0
+    return self._lens_texcoord(k*b, k*a, z)
+
+  # texture coordinates of a direction with the halved longitude
+  def _lens_texcoord(self, p_x, p_y, p_z):
+    FOV = np.pi
+
+    # cos and sin of the angle atan2(p_z, p_x) around the centre are p_x/s
+    # and p_z/s, so only one arctangent is needed; along the axis (s == 0)
+    # the angle is 0
+    s = np.sqrt(p_x*p_x+p_z*p_z)
+    phi_l = np.arctan2(s,p_y)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+      k = phi_l / (FOV*s)
+    u = 0.5 + k*p_x
+    v = 0.5 + k*p_z
+    axis = s == 0
+    if axis.any():
+      u[axis] = 0.5 + phi_l[axis]/FOV
+      v[axis] = 0.5
+    return u, v, None
+
   @staticmethod
   def angular_position(texcoord):
     u = texcoord[0]
@@ -56,3 +101,13 @@ class FisheyeProjection(AbstractProjection):
     # phi: v: 0..1 - > -pi/2..pi/2
     phi = math.pi*(v-0.5)
     return (theta,phi)
+
+
+  @staticmethod
+  def angular_position_array(u, v):
+    theta = np.pi*2.0*(u-0.5)
+    phi = np.pi*(v-0.5)
+    return (theta,phi)
+
+  def direction_grid(self, rows=slice(None), dtype=np.float32):
+    return self._latlong_direction_grid(rows, dtype)
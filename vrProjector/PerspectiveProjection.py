@@ -0,0 +1,153 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from .AbstractProjection import AbstractProjection, rotation_matrix
+import math
+import numpy as np
+
+# A rectilinear (pinhole camera) view of part of the sphere. At rest the
+# camera looks at the centre of an equirectangular image (the front cubemap
+# face), with +y to the right of the image and +z down, like the front face.
+# Angles are in degrees: yaw turns the camera right, pitch tilts it up and
+# roll turns it clockwise about the view direction. fov is the horizontal
+# field of view; the vertical one follows from the image's aspect ratio
+# unless vfov is given.
+class PerspectiveProjection(AbstractProjection):
+  def __init__(self, fov=90.0, yaw=0.0, pitch=0.0, roll=0.0, vfov=None):
+    AbstractProjection.__init__(self)
+    self.fov = fov
+    self.vfov = vfov
+    self.yaw = yaw
+    self.pitch = pitch
+    self.roll = roll
+
+  # move the viewport; arguments left as None keep their current value
+  def set_view(self, yaw=None, pitch=None, roll=None, fov=None, vfov=None):
+    if yaw is not None:
+      self.yaw = yaw
+    if pitch is not None:
+      self.pitch = pitch
+    if roll is not None:
+      self.roll = roll
+    if fov is not None:
+      self.fov = fov
+    if vfov is not None:
+      self.vfov = vfov
+    if getattr(self, 'imsize', None) is not None:
+      self.set_angular_resolution()
+
+  def set_angular_resolution(self):
+    if not 0 < self.fov < 180 or (self.vfov is not None and not 0 < self.vfov < 180):
+      raise ValueError('Field of view must be between 0 and 180 degrees, got %s' % (self.fov if self.vfov is None else (self.fov, self.vfov),))
+    self.angular_resolution = math.radians(self.fov)/self.imsize[0]
+
+  def _geometry(self):
+    return dict(AbstractProjection._geometry(self), fov=self.fov, vfov=self.vfov, yaw=self.yaw, pitch=self.pitch, roll=self.roll)
+
+  # tangents of half the horizontal and vertical fields of view: the extent
+  # of the image plane one unit in front of the camera
+  def _half_extent(self):
+    tx = math.tan(math.radians(self.fov)*0.5)
+    if self.vfov is not None:
+      ty = math.tan(math.radians(self.vfov)*0.5)
+    else:
+      ty = tx*self.imsize[1]/float(self.imsize[0])
+    return tx, ty
+
+  # camera to world rotation; its columns are the view direction, image
+  # right and image down
+  def _view_rotation(self):
+    return rotation_matrix(self.yaw, self.pitch, self.roll)
+
+  def _pixel_value(self, angle):
+    theta = angle[0]
+    phi = angle[1]
+    if theta is None or phi is None:
+      return self._no_sample()
+    texcoord = self._view_texcoord(*self.point_on_sphere(theta, phi))
+    if texcoord is None:
+      return self._no_sample()
+    return self.get_pixel_from_uv(texcoord[0], texcoord[1], self.image)
+
+  # image texture coordinates of a world direction, or None when it is
+  # outside the view; summed in the order of _texcoord_from_direction
+  def _view_texcoord(self, x, y, z):
+    rotation = self._view_rotation()
+    forward = rotation[0, 0]*x + rotation[1, 0]*y + rotation[2, 0]*z
+    right = rotation[0, 1]*x + rotation[1, 1]*y + rotation[2, 1]*z
+    down = rotation[0, 2]*x + rotation[1, 2]*y + rotation[2, 2]*z
+    if forward <= 0:
+      return None
+    tx, ty = self._half_extent()
+    u = 0.5+0.5*right/(forward*tx)
+    v = 0.5+0.5*down/(forward*ty)
+    if not (0 <= u < 1 and 0 <= v < 1):
+      return None
+    return u, v
+
+  # directions outside the view get NaN texture coordinates, so only the
+  # source pixels inside it are ever sampled
+  def _texcoord_array(self, theta, phi):
+    return self._texcoord_from_direction(*self.point_on_sphere_array(theta, phi))
+
+  def _texcoord_from_direction(self, x, y, z):
+    rotation = self._view_rotation().astype(np.result_type(x, np.float32))
+    forward = rotation[0, 0]*x + rotation[1, 0]*y + rotation[2, 0]*z
+    right = rotation[0, 1]*x + rotation[1, 1]*y + rotation[2, 1]*z
+    down = rotation[0, 2]*x + rotation[1, 2]*y + rotation[2, 2]*z
+    tx, ty = self._half_extent()
+    with np.errstate(invalid='ignore', divide='ignore'):
+      u = 0.5+0.5*right/(forward*tx)
+      v = 0.5+0.5*down/(forward*ty)
+    outside = ~((forward > 0) & (u >= 0) & (u < 1) & (v >= 0) & (v < 1))
+    u[outside] = np.nan
+    v[outside] = np.nan
+    return u, v, None
+
+  def angular_position(self, texcoord):
+    theta, phi = self.angular_position_array(np.float64(texcoord[0]), np.float64(texcoord[1]))
+    return float(theta), float(phi)
+
+  # u and v may be any broadcastable shapes; directions are not normalised,
+  # so the elevation comes from arctan2 rather than arcsin
+  def angular_position_array(self, u, v):
+    return self.angles_from_direction_array(*self._view_directions(u, v))
+
+  def direction_array(self, u, v):
+    x, y, z = self._view_directions(u, v)
+    norm = np.sqrt(x*x + y*y + z*z)
+    return x/norm, y/norm, z/norm
+
+  # directions through the image plane, in the type of u and v; not
+  # normalised
+  def _view_directions(self, u, v):
+    tx, ty = self._half_extent()
+    rotation = self._view_rotation().astype(np.result_type(u, v, np.float32))
+    a = tx*(2.0*u-1.0)
+    b = ty*(2.0*v-1.0)
+    x = (rotation[0, 0] + rotation[0, 1]*a) + rotation[0, 2]*b
+    y = (rotation[1, 0] + rotation[1, 1]*a) + rotation[1, 2]*b
+    z = (rotation[2, 0] + rotation[2, 1]*a) + rotation[2, 2]*b
+    return x, y, z
+
+  # every term of a direction depends on just the column or just the row,
+  # so they are computed on one row and one column and only summed at full
+  # size
+  def angular_grid(self, rows=slice(None)):
+    u = np.arange(self.imsize[0], dtype=np.float64)/float(self.imsize[0])
+    v = np.arange(self.imsize[1], dtype=np.float64)[rows]/float(self.imsize[1])
+    return self.angular_position_array(u[np.newaxis, :], v[:, np.newaxis])
+
+  def direction_grid(self, rows=slice(None), dtype=np.float32):
+    u = (np.arange(self.imsize[0], dtype=np.float64)/float(self.imsize[0])).astype(dtype)
+    v = (np.arange(self.imsize[1], dtype=np.float64)[rows]/float(self.imsize[1])).astype(dtype)
+    return self.direction_array(u[np.newaxis, :], v[:, np.newaxis])
@@ -0,0 +1,130 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+import threading
+import time
+
+# the profiler spans and counts are recorded into; None when profiling is
+# off, so every hook costs one global lookup
+_active = None
+
+class _NullSpan:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+  def set(self, **args):
+    pass
+
+_NULL_SPAN = _NullSpan()
+
+# time a stage of the library: with span('sample', pixels=n) as s: ...
+def span(name, **args):
+  if _active is None:
+    return _NULL_SPAN
+  return _Span(_active, name, args)
+
+# add value to a named counter, e.g. cache hits
+def count(name, value=1):
+  if _active is not None:
+    _active._count(name, value)
+
+class _Span:
+  def __init__(self, profiler, name, args):
+    self.profiler = profiler
+    self.name = name
+    self.args = args
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.profiler._record(self.name, self.start, time.perf_counter(), self.args)
+    return False
+
+  # attach results known only at the end of the span, such as pixel counts
+  # or bytes allocated
+  def set(self, **args):
+    self.args.update(args)
+
+# Records timing spans and counters for every stage of loading,
+# reprojecting and saving while it is active:
+#
+#   with vrProjector.Profiler() as profiler:
+#     out.reprojectToThis(source)
+#   profiler.save('trace.json')
+#
+# Traces are in the Chrome trace event format (chrome://tracing, Perfetto).
+# callback, if given, is called with every finished span as a dict.
+class Profiler:
+  def __init__(self, callback=None):
+    self.callback = callback
+    self.events = []
+    self.counters = {}
+    self.lock = threading.Lock()
+    self.origin = time.perf_counter()
+    self.previous = None
+
+  def __enter__(self):
+    global _active
+    self.previous = _active
+    _active = self
+    return self
+
+  def __exit__(self, *exc):
+    global _active
+    _active = self.previous
+    return False
+
+  def _record(self, name, start, end, args):
+    event = {
+      'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+      'ts': (start - self.origin)*1e6, 'dur': (end - start)*1e6, 'args': args,
+    }
+    with self.lock:
+      self.events.append(event)
+    if self.callback is not None:
+      self.callback(event)
+
+  def _count(self, name, value):
+    with self.lock:
+      total = self.counters.get(name, 0) + value
+      self.counters[name] = total
+      self.events.append({
+        'name': name, 'ph': 'C', 'pid': os.getpid(), 'tid': threading.get_ident(),
+        'ts': (time.perf_counter() - self.origin)*1e6, 'args': {name: total},
+      })
+
+  # totals per span name: calls, seconds and summed pixels/bytes
+  def summary(self):
+    totals = {}
+    for event in self.events:
+      if event['ph'] != 'X':
+        continue
+      total = totals.setdefault(event['name'], {'calls': 0, 'seconds': 0.0, 'pixels': 0, 'bytes': 0})
+      total['calls'] += 1
+      total['seconds'] += event['dur']/1e6
+      total['pixels'] += event['args'].get('pixels', 0)
+      total['bytes'] += event['args'].get('bytes', 0)
+    return {'spans': totals, 'counters': dict(self.counters)}
+
+  def toChromeTrace(self):
+    return {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+
+  def save(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.toChromeTrace(), f)
@@ -0,0 +1,174 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from .Profiler import count, span
+from .RemapTable import RemapTable
+
+_libraryHash = None
+
+# staging (tmp-) and trash (old-) directories older than this many seconds
+# were left by a process that died mid-write or mid-delete
+STALE_SECONDS = 3600
+
+# hash of the library's own source, so tables built by a different version
+# of the mapping code are never reused
+def libraryHash():
+  global _libraryHash
+  if _libraryHash is None:
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+      with open(path, 'rb') as f:
+        digest.update(f.read())
+    _libraryHash = digest.hexdigest()
+  return _libraryHash
+
+def defaultCacheDir():
+  if os.environ.get('VRPROJECTOR_CACHE'):
+    return os.environ['VRPROJECTOR_CACHE']
+  base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'vrProjector')
+
+# A directory of RemapTables shared by every process using it. Entries are
+# named by a hash of the table description and library version, written
+# to a temporary directory and renamed into place so readers never see a
+# partial entry, and loaded memory-mapped read-only. Once the cache grows
+# past maxBytes the least recently used entries are removed.
+class RemapCache:
+  def __init__(self, directory=None, maxBytes=1024*1024*1024):
+    self.directory = directory if directory is not None else defaultCacheDir()
+    self.maxBytes = maxBytes
+
+  def key(self, targetProjection, sourceProjection):
+    return self._key(RemapTable.describe(targetProjection, sourceProjection))
+
+  @staticmethod
+  def _key(description):
+    description = dict(description, library=libraryHash())
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.directory, key)
+
+  # the cached table for this pair, or None
+  def get(self, targetProjection, sourceProjection):
+    path = self._path(self.key(targetProjection, sourceProjection))
+    try:
+      table = RemapTable.load(path)
+    except (IOError, OSError, ValueError):
+      # missing, or removed by another process while we were loading it
+      return None
+    try:
+      # the directory mtime is the entry's last use for LRU eviction
+      os.utime(path, None)
+    except OSError:
+      pass
+    return table
+
+  def put(self, table):
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory, exist_ok=True)
+    path = self._path(self._key(table.meta))
+    staging = os.path.join(self.directory, 'tmp-%s' % uuid.uuid4().hex)
+    table.save(staging)
+    try:
+      os.rename(staging, path)
+    except OSError:
+      # another process stored the same entry first
+      shutil.rmtree(staging, ignore_errors=True)
+    self.evict()
+    return path
+
+  # the table for this pair, from the cache or built and stored
+  def lookup(self, targetProjection, sourceProjection):
+    with span('remap.cache') as s:
+      table = self.get(targetProjection, sourceProjection)
+      if table is not None:
+        count('remapCache.hit')
+        s.set(hit=True)
+        return table
+      count('remapCache.miss')
+      s.set(hit=False)
+      table = RemapTable.build(targetProjection, sourceProjection)
+      self.put(table)
+      return table
+
+  # (last use, bytes, path) of every complete entry
+  def entries(self):
+    entries = []
+    if not os.path.isdir(self.directory):
+      return entries
+    for name in os.listdir(self.directory):
+      path = self._path(name)
+      if name.startswith('tmp-') or name.startswith('old-') or not os.path.isdir(path):
+        continue
+      try:
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, path))
+      except OSError:
+        continue
+    return entries
+
+  @property
+  def nbytes(self):
+    return sum(size for _, size, _ in self.entries())
+
+  # drop least recently used entries until the cache fits in maxBytes;
+  # entries are renamed away before deletion, and processes that already
+  # mapped them keep reading the unlinked files. Stale leftovers of crashed
+  # writers and deleters go first
+  def evict(self):
+    self._removeStale()
+    entries = sorted(self.entries())
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+      if total <= self.maxBytes:
+        break
+      self._remove(path)
+      total -= size
+
+  def clear(self):
+    for _, _, path in self.entries():
+      self._remove(path)
+
+  # tmp- and old- directories not touched for STALE_SECONDS; younger ones
+  # may still be being written or deleted by another process
+  def _removeStale(self, now=None):
+    if not os.path.isdir(self.directory):
+      return
+    now = time.time() if now is None else now
+    for name in os.listdir(self.directory):
+      if not (name.startswith('tmp-') or name.startswith('old-')):
+        continue
+      path = self._path(name)
+      try:
+        if now - os.path.getmtime(path) < STALE_SECONDS:
+          continue
+      except OSError:
+        continue
+      count('remapCache.stale')
+      shutil.rmtree(path, ignore_errors=True)
+
+  def _remove(self, path):
+    trash = os.path.join(self.directory, 'old-%s' % uuid.uuid4().hex)
+    try:
+      os.rename(path, trash)
+    except OSError:
+      return
+    shutil.rmtree(trash, ignore_errors=True)
@@ -0,0 +1,162 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+
+import numpy as np
+
+from .AbstractProjection import AbstractProjection
+from .Profiler import span
+
+# A RemapTable stores, for every output pixel of a target projection, where to
+# sample the source projection. Build it once for a (source, target) pair and
+# apply it to any number of source images of the same geometry.
+class RemapTable:
+  def __init__(self, u, v, face=None, invalid=None, meta=None):
+    # u, v: source texture coordinates per output pixel, NaN = no sample
+    # face: matching cubemap face indices, or None for single image sources
+    # invalid: output pixels with no position on the target sphere, or None
+    self.u = u
+    self.v = v
+    self.face = face
+    self.invalid = invalid
+    self.meta = meta if meta is not None else {}
+
+  # a stereo pair maps just like one of its eyes, so tables are described,
+  # and shared, by eye
+  @staticmethod
+  def describe(targetProjection, sourceProjection):
+    targetProjection = targetProjection.eye(0)
+    sourceProjection = sourceProjection.eye(0)
+    return {
+      'source': type(sourceProjection).__name__,
+      'sourceSize': list(sourceProjection.imsize),
+      'target': type(targetProjection).__name__,
+      'targetSize': list(targetProjection.imsize),
+      'interpolation': sourceProjection.interpolation,
+      'sourceGeometry': sourceProjection._geometry(),
+      'targetGeometry': targetProjection._geometry(),
+    }
+
+  @classmethod
+  def build(cls, targetProjection, sourceProjection, dtype=np.float32):
+    with span('remap.build') as s:
+      u, v, face, invalid, index = targetProjection._map_rows(sourceProjection, slice(None))
+      u = u.astype(dtype)
+      v = v.astype(dtype)
+      if face is not None:
+        face = face.astype(np.int8)
+      if index is not None:
+        shape = (targetProjection.imsize[1], targetProjection.imsize[0])
+        invalid = AbstractProjection._scatter(invalid, index, shape, True)
+        u = AbstractProjection._scatter(u, index, shape, np.nan)
+        v = AbstractProjection._scatter(v, index, shape, np.nan)
+        if face is not None:
+          face = AbstractProjection._scatter(face, index, shape, -1)
+      if not invalid.any():
+        invalid = None
+      table = cls(u, v, face, invalid, cls.describe(targetProjection, sourceProjection))
+      s.set(pixels=u.size, bytes=table.nbytes)
+      return table
+
+  @property
+  def shape(self):
+    return self.u.shape
+
+  @property
+  def nbytes(self):
+    arrays = (self.u, self.v, self.face, self.invalid)
+    return sum(a.nbytes for a in arrays if a is not None)
+
+  def _check_source(self, sourceProjection):
+    if not self.meta:
+      return
+    sourceProjection = sourceProjection.eye(0)
+    expected = (self.meta['source'], tuple(self.meta['sourceSize']))
+    actual = (type(sourceProjection).__name__, tuple(sourceProjection.imsize))
+    # the table only holds coordinates, so any interpolation mode can be used
+    # to sample it
+    if expected != actual:
+      raise ValueError('RemapTable built for source %s %s, got %s %s' % (expected + actual))
+    # compared after a JSON round trip, as tables loaded from disk have lists
+    # where the projection has tuples
+    geometry = json.loads(json.dumps(sourceProjection._geometry()))
+    if self.meta.get('sourceGeometry', geometry) != geometry:
+      raise ValueError('RemapTable built for source geometry %s, got %s' % (self.meta['sourceGeometry'], geometry))
+
+  def _check_target(self, targetProjection):
+    if not self.meta:
+      return
+    targetProjection = targetProjection.eye(0)
+    expected = (self.meta['target'], tuple(self.meta['targetSize']))
+    actual = (type(targetProjection).__name__, tuple(targetProjection.imsize))
+    if expected != actual:
+      raise ValueError('RemapTable built for target %s %s, got %s %s' % (expected + actual))
+    geometry = json.loads(json.dumps(targetProjection._geometry()))
+    if self.meta.get('targetGeometry', geometry) != geometry:
+      raise ValueError('RemapTable built for target geometry %s, got %s' % (self.meta['targetGeometry'], geometry))
+
+  # (u, v, face) source texture coordinates of a band of output rows
+  def coordinates(self, sourceProjection, rows=slice(None)):
+    self._check_source(sourceProjection)
+    face = None if self.face is None else self.face[..., rows, :]
+    return self.u[..., rows, :], self.v[..., rows, :], face
+
+  # gather source pixels for every output pixel, or for a band of output
+  # rows; invalid output pixels are skipped and come back as zero, except
+  # for mipmapped sources, which need whole rows to measure footprints
+  def sample(self, sourceProjection, rows=slice(None)):
+    u, v, face = self.coordinates(sourceProjection, rows)
+    if self.invalid is None or sourceProjection.mipmap:
+      return sourceProjection.sample_array(u, v, face)
+    valid = np.flatnonzero(~self.invalid[..., rows, :])
+    face = None if face is None else face.reshape(-1)[valid]
+    pixels = sourceProjection.sample_array(u.reshape(-1)[valid], v.reshape(-1)[valid], face)
+    return AbstractProjection._scatter(pixels, (valid,), u.shape)
+
+  # sample sourceProjection straight into targetProjection's image[s]
+  def apply(self, sourceProjection, targetProjection, rows=slice(None)):
+    self._check_target(targetProjection)
+    invalid = None if self.invalid is None else self.invalid[..., rows, :]
+    with span('sample', interpolation=sourceProjection.interpolation, remapTable=True) as s:
+      pixels = self.sample(sourceProjection, rows)
+      s.set(pixels=pixels.size//pixels.shape[-1], bytes=pixels.nbytes)
+    with span('store', pixels=pixels.size//pixels.shape[-1]):
+      targetProjection._store_pixels(pixels, invalid, rows)
+    return targetProjection
+
+  # a table is saved as a directory of .npy files so it can be memory-mapped
+  def save(self, path):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    np.save(os.path.join(path, 'u.npy'), self.u)
+    np.save(os.path.join(path, 'v.npy'), self.v)
+    if self.face is not None:
+      np.save(os.path.join(path, 'face.npy'), self.face)
+    if self.invalid is not None:
+      np.save(os.path.join(path, 'invalid.npy'), self.invalid)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+      json.dump(self.meta, f)
+
+  @classmethod
+  def load(cls, path, mmap_mode='r'):
+    def optional(name):
+      filename = os.path.join(path, name)
+      if os.path.exists(filename):
+        return np.load(filename, mmap_mode=mmap_mode)
+      return None
+    with open(os.path.join(path, 'meta.json')) as f:
+      meta = json.load(f)
+    u = np.load(os.path.join(path, 'u.npy'), mmap_mode=mmap_mode)
+    v = np.load(os.path.join(path, 'v.npy'), mmap_mode=mmap_mode)
+    return cls(u, v, optional('face.npy'), optional('invalid.npy'), meta)
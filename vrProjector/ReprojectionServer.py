@@ -0,0 +1,394 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+import hmac
+import http.client
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .BatchProcessor import BatchProcessor
+from .Profiler import span
+from .RemapTable import RemapTable
+
+# largest job body accepted, in bytes; jobs name their images by path
+MAX_REQUEST_BYTES = 1024*1024
+
+# Host headers a request to a server on localhost carries; anything else is
+# a page that resolved its own name to 127.0.0.1
+LOOPBACK_HOSTS = ('localhost', '127.0.0.1', '[::1]')
+
+# header carrying the token of a server started with one
+TOKEN_HEADER = 'X-vrProjector-Token'
+
+# jobs finished within this many seconds count towards the recent rate
+RECENT_SECONDS = 60.0
+
+# raised by submit when every worker is busy and the queue is full
+class ServerBusy(Exception):
+  pass
+
+# Latency and throughput counters of a ReprojectionServer. Latencies are
+# kept for the last window jobs, from when a job was accepted to when it
+# finished, and split into the time it queued and the time it ran
+class ServerStats:
+  def __init__(self, window=1024):
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.counters = collections.Counter()
+    self.latencies = collections.deque(maxlen=window)
+    self.finished = collections.deque()
+    self.pixels = 0
+
+  def count(self, name, value=1):
+    with self.lock:
+      self.counters[name] += value
+
+  def record(self, queued, ran, pixels, ok):
+    now = time.time()
+    with self.lock:
+      self.counters['completed' if ok else 'failed'] += 1
+      self.latencies.append((queued + ran, queued, ran))
+      self.finished.append(now)
+      while self.finished and self.finished[0] < now - RECENT_SECONDS:
+        self.finished.popleft()
+      self.pixels += pixels
+
+  # milliseconds at the given fractions of sorted values
+  @staticmethod
+  def _percentiles(values, fractions=(0.5, 0.95, 0.99)):
+    if not values:
+      return None
+    values = sorted(values)
+    result = dict(('p%d' % round(f*100), 1000*values[min(len(values)-1, int(f*len(values)))]) for f in fractions)
+    result['max'] = 1000*values[-1]
+    return result
+
+  def snapshot(self):
+    now = time.time()
+    with self.lock:
+      uptime = now - self.started
+      latencies = list(self.latencies)
+      recent = sum(1 for t in self.finished if t >= now - RECENT_SECONDS)
+      done = self.counters['completed']
+      return {
+        'uptimeSeconds': uptime,
+        'counters': dict(self.counters),
+        'latencyMs': self._percentiles([l[0] for l in latencies]),
+        'queuedMs': self._percentiles([l[1] for l in latencies]),
+        'runMs': self._percentiles([l[2] for l in latencies]),
+        'jobsPerSecond': done/uptime if uptime > 0 else 0.0,
+        'recentJobsPerSecond': recent/min(uptime, RECENT_SECONDS) if uptime > 0 else 0.0,
+        'megapixelsPerSecond': self.pixels/1e6/uptime if uptime > 0 else 0.0,
+      }
+
+# A long running reprojection service, so requests skip process start,
+# imports, decoding sources seen recently and building their mappings.
+# Jobs are the objects of a batch manifest (see BatchProcessor.readManifest)
+# and name their images by path. Decoded sources are kept in an LRU of up
+# to maxSourceBytes, and mappings in the BatchProcessor's LRU of maxTables,
+# backed by remapCache when given. Jobs run on workers threads with up to
+# queueSize more waiting; beyond that submit raises ServerBusy at once,
+# so callers can back off rather than pile up. Serve it over HTTP with
+# httpServer.
+class ReprojectionServer:
+  def __init__(self, workers=1, queueSize=4, maxSourceBytes=1024*1024*1024, maxTables=32, remapCache=None):
+    self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+    self.queueSize = queueSize
+    self.maxSourceBytes = maxSourceBytes
+    self.batch = BatchProcessor(self.workers, remapCache, maxTables=maxTables)
+    self.pool = ThreadPoolExecutor(max_workers=self.workers)
+    self.slots = threading.BoundedSemaphore(self.workers + queueSize)
+    self.stats = ServerStats()
+    self.lock = threading.Lock()
+    # key -> (source, bytes), least recently used first
+    self.sources = collections.OrderedDict()
+    self.sourceBytes = 0
+    self.loading = {}
+    self.active = 0
+
+  # files of a job's source, and their size and modification time, so a
+  # source replaced on disk is decoded again
+  @staticmethod
+  def sourceKey(job):
+    stamps = []
+    for path in str(job['sourceImage']).split(' '):
+      info = os.stat(path)
+      stamps.append((path, info.st_size, info.st_mtime_ns))
+    fields = tuple(str(job.get(field, '')).lower() for field in ('sourceProjection', 'sourceLayout', 'interpolation', 'rotation', 'mipmap'))
+    return json.dumps([fields, stamps])
+
+  # the decoded source of a job, from the LRU or loaded into it; one thread
+  # loads a missing source while the others for it wait
+  def source(self, job):
+    key = self.sourceKey(job)
+    with self.lock:
+      entry = self.sources.get(key)
+      if entry is not None:
+        self.sources.move_to_end(key)
+        self.stats.count('sourceHit')
+        return entry[0]
+      loading = self.loading.setdefault(key, threading.Lock())
+    with loading:
+      with self.lock:
+        entry = self.sources.get(key)
+      if entry is not None:
+        self.stats.count('sourceHit')
+        return entry[0]
+      self.stats.count('sourceMiss')
+      try:
+        source = BatchProcessor.loadSource(job['sourceProjection'], job['sourceImage'], job.get('sourceLayout'), job.get('interpolation'),
+                                           job.get('rotation'), BatchProcessor.parseFlag(job.get('mipmap')))
+        nbytes = sum(image.nbytes for image in source._images())
+        with self.lock:
+          self.sources[key] = (source, nbytes)
+          self.sourceBytes += nbytes
+          # the newest source stays even when it alone is over the limit
+          while self.sourceBytes > self.maxSourceBytes and len(self.sources) > 1:
+            _, (_, dropped) = self.sources.popitem(last=False)
+            self.sourceBytes -= dropped
+      finally:
+        with self.lock:
+          self.loading.pop(key, None)
+      return source
+
+  def run(self, job):
+    with span('server.job'):
+      source = self.source(job)
+      view = dict((field, job[field]) for field in BatchProcessor.VIEW_FIELDS if field in job)
+      out = BatchProcessor.initTarget(job['outProjection'], job['outWidth'], job['outHeight'], job.get('outLayout'), view,
+                                      source.pixel_format(), job.get('precision'))
+      with self.batch.lock:
+        hit = json.dumps(RemapTable.describe(out, source), sort_keys=True) in self.batch.tables
+      self.stats.count('tableHit' if hit else 'tableMiss')
+      out.reprojectToThis(source, remapTable=self.batch.remapTable(out, source))
+      BatchProcessor.saveTarget(out, job['outImage'], job.get('compression'), job.get('quality'))
+      return out._pixels_per_row()*out.imsize[1]
+
+  # queue a job; returns a future of its result, a dict like a batch
+  # status line. Raises ServerBusy when the queue is full
+  def submit(self, job):
+    if not self.slots.acquire(blocking=False):
+      self.stats.count('rejected')
+      raise ServerBusy('%d jobs running and %d queued' % (self.workers, self.queueSize))
+    self.stats.count('accepted')
+    accepted = time.time()
+    try:
+      return self.pool.submit(self._runJob, job, accepted)
+    except Exception:
+      self.slots.release()
+      raise
+
+  def _runJob(self, job, accepted):
+    started = time.time()
+    result = {}
+    if 'id' in job:
+      result['id'] = job['id']
+    with self.lock:
+      self.active += 1
+    pixels = 0
+    try:
+      pixels = self.run(job)
+      result['status'] = 'ok'
+    except Exception as e:
+      result['status'] = 'error'
+      result['error'] = '%s: %s' % (type(e).__name__, e)
+    finally:
+      with self.lock:
+        self.active -= 1
+      self.slots.release()
+    finished = time.time()
+    result['seconds'] = finished - accepted
+    result['queuedSeconds'] = started - accepted
+    self.stats.record(started - accepted, finished - started, pixels, result['status'] == 'ok')
+    return result
+
+  def snapshot(self):
+    stats = self.stats.snapshot()
+    with self.lock:
+      stats['running'] = self.active
+      stats['workers'] = self.workers
+      stats['queueSize'] = self.queueSize
+      stats['sources'] = {'entries': len(self.sources), 'bytes': self.sourceBytes, 'maxBytes': self.maxSourceBytes}
+    with self.batch.lock:
+      stats['tables'] = {'entries': len(self.batch.tables), 'maxEntries': self.batch.maxTables}
+    return stats
+
+  # an HTTP server of this service on host:port, or on the Unix socket at
+  # socketPath; call serve_forever on it. Jobs read and write any file this
+  # process can, so it only listens on localhost, the socket is only open to
+  # this user, and requests from web pages are refused: jobs must be
+  # application/json, and requests with an Origin or a Host other than
+  # localhost are turned away. With a token, every request must also carry
+  # it in TOKEN_HEADER
+  def httpServer(self, port=8123, host='127.0.0.1', socketPath=None, verbose=False, token=None):
+    if socketPath is not None:
+      if os.path.exists(socketPath) and stat.S_ISSOCK(os.stat(socketPath).st_mode):
+        os.remove(socketPath)
+      server = _UnixHTTPServer(socketPath, _Handler)
+      os.chmod(socketPath, 0o600)
+    else:
+      server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.service = self
+    server.verbose = verbose
+    server.token = token
+    return server
+
+  def close(self):
+    self.pool.shutdown(wait=True)
+
+  # (HTTP status, decoded JSON reply) of a request to a running server: a
+  # job for POST /jobs, or None for GET /stats and /health. token is that of
+  # the server, if it has one
+  @staticmethod
+  def call(path, job=None, port=8123, host='127.0.0.1', socketPath=None, timeout=None, token=None):
+    if socketPath is not None:
+      connection = _UnixHTTPConnection(socketPath, timeout)
+    else:
+      connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    headers = {} if token is None else {TOKEN_HEADER: token}
+    try:
+      if job is None:
+        connection.request('GET', path, headers=headers)
+      else:
+        headers['Content-Type'] = 'application/json'
+        connection.request('POST', path, json.dumps(job), headers)
+      response = connection.getresponse()
+      return response.status, json.loads(response.read().decode('utf-8'))
+    finally:
+      connection.close()
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def server_close(self):
+    socketserver.UnixStreamServer.server_close(self)
+    try:
+      os.remove(self.server_address)
+    except OSError:
+      pass
+
+# POST /jobs runs a job, answering 200 with its status when it succeeds,
+# 500 when it fails, 400 for requests that are not a job, 415 for bodies
+# that are not application/json and 503 with Retry-After when the server
+# is busy. GET /stats and GET /health. Requests from browsers, or without
+# the server's token, get 403
+class _Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def _reply(self, code, body, headers=()):
+    data = (json.dumps(body) + '\n').encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    for name, value in headers:
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(data)
+
+  # an error for requests that may come from a web page rather than a local
+  # client: browsers send Origin on cross-site requests, and a page using
+  # DNS rebinding still names its own host. None when the request may run
+  def _refusal(self):
+    if self.headers.get('Origin') is not None:
+      return 'requests from web pages are not accepted'
+    host = (self.headers.get('Host') or '').strip().lower()
+    if host.startswith('['):
+      host = host[:host.find(']')+1]
+    else:
+      host = host.partition(':')[0]
+    if host not in LOOPBACK_HOSTS:
+      return 'requests must be addressed to localhost'
+    token = self.server.token
+    if token is not None and not hmac.compare_digest(self.headers.get(TOKEN_HEADER, '').encode('utf-8'), token.encode('utf-8')):
+      return 'missing or wrong %s' % TOKEN_HEADER
+    return None
+
+  def do_GET(self):
+    refusal = self._refusal()
+    if refusal is not None:
+      self._reply(403, {'status': 'error', 'error': refusal})
+    elif self.path == '/stats':
+      self._reply(200, self.server.service.snapshot())
+    elif self.path == '/health':
+      self._reply(200, {'status': 'ok'})
+    else:
+      self._reply(404, {'status': 'error', 'error': 'no such path %s' % self.path})
+
+  def do_POST(self):
+    if self.path != '/jobs':
+      self._reply(404, {'status': 'error', 'error': 'no such path %s' % self.path})
+      return
+    # the body is left unread on every refusal, so the connection closes
+    refusal = self._refusal()
+    if refusal is not None:
+      self.close_connection = True
+      self._reply(403, {'status': 'error', 'error': refusal})
+      return
+    if self.headers.get_content_type() != 'application/json':
+      self.close_connection = True
+      self._reply(415, {'status': 'error', 'error': 'jobs must be sent as application/json'})
+      return
+    try:
+      length = int(self.headers.get('Content-Length') or 0)
+    except ValueError:
+      length = -1
+    if length < 0:
+      self.close_connection = True
+      self._reply(400, {'status': 'error', 'error': 'bad Content-Length %s' % self.headers.get('Content-Length')})
+      return
+    if length > MAX_REQUEST_BYTES:
+      self.close_connection = True
+      self._reply(413, {'status': 'error', 'error': 'jobs are at most %d bytes' % MAX_REQUEST_BYTES})
+      return
+    try:
+      job = json.loads(self.rfile.read(length).decode('utf-8'))
+      missing = [field for field in ('sourceProjection', 'sourceImage', 'outProjection', 'outImage', 'outWidth', 'outHeight') if field not in job]
+      if missing:
+        raise ValueError('job is missing %s' % ', '.join(missing))
+    except (ValueError, TypeError, AttributeError) as e:
+      self._reply(400, {'status': 'error', 'error': '%s: %s' % (type(e).__name__, e)})
+      return
+    try:
+      future = self.server.service.submit(job)
+    except ServerBusy as e:
+      self._reply(503, {'status': 'busy', 'error': str(e)}, [('Retry-After', '1')])
+      return
+    result = future.result()
+    self._reply(200 if result['status'] == 'ok' else 500, result)
+
+  def address_string(self):
+    return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+  def __init__(self, socketPath, timeout=None):
+    http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+    self.socketPath = socketPath
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if self.timeout is not None:
+      self.sock.settimeout(self.timeout)
+    self.sock.connect(self.socketPath)
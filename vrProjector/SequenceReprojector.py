@@ -0,0 +1,182 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import glob
+import queue
+import threading
+import time
+
+import numpy as np
+
+from .AbstractProjection import AbstractProjection, _check_dtype
+from .Profiler import count
+from .RemapTable import RemapTable
+
+# end of stream marker passed down the queues
+_DONE = object()
+
+# Reprojects a sequence of frames of the same size with one RemapTable.
+# Decoding, reprojection and encoding run on their own threads connected
+# by bounded queues, so the three stages overlap.
+class SequenceReprojector:
+  def __init__(self, targetProjection, sourceProjection, workers=1, queueSize=4, remapCache=None):
+    # targetProjection: initialised output projection, reused for every frame
+    # sourceProjection: projection type of the frames; its image is replaced
+    # by each frame in turn
+    # remapCache: optional RemapCache the mapping is looked up in
+    self.target = targetProjection
+    self.source = sourceProjection
+    self.workers = workers
+    self.queueSize = queueSize
+    self.remapCache = remapCache
+    self.remapTable = None
+
+  # decoded frames from files matching a glob pattern, in sorted order
+  @staticmethod
+  def readFrameFiles(pattern):
+    paths = sorted(glob.glob(pattern))
+    if not paths:
+      raise ValueError('No frames match %s' % pattern)
+    for path in paths:
+      frame, _ = AbstractProjection._loadImage(path)
+      yield frame
+
+  # raw interleaved frames of dtype read back to back from a binary stream,
+  # as written by e.g. ffmpeg -f rawvideo -pix_fmt rgb24
+  @staticmethod
+  def readRawFrames(stream, width, height, channels=3, dtype=np.uint8):
+    dtype = _check_dtype(dtype)
+    frameBytes = width*height*channels*dtype.itemsize
+    while True:
+      frame = np.empty((height, width, channels), dtype)
+      buf = memoryview(frame).cast('B')
+      got = 0
+      while got < frameBytes:
+        n = stream.readinto(buf[got:])
+        if not n:
+          break
+        got += n
+      if got == 0:
+        return
+      if got < frameBytes:
+        raise ValueError('Truncated raw frame: got %d of %d bytes' % (got, frameBytes))
+      yield frame
+
+  # sink saving output image[s] of frame index to printf-style patterns such
+  # as "out/%05d.png", one pattern per output image
+  @staticmethod
+  def writeFrameFiles(patterns):
+    def write(index, images):
+      if len(patterns) != len(images):
+        raise ValueError('Expected %d output patterns, got %d' % (len(images), len(patterns)))
+      for pattern, image in zip(patterns, images):
+        AbstractProjection._saveImage(image, (image.shape[1], image.shape[0]), pattern % index)
+    return write
+
+  # sink writing output image[s] as raw interleaved frames to a binary
+  # stream; cubemap faces follow each other, giving a vertical strip
+  @staticmethod
+  def writeRawFrames(stream):
+    def write(index, images):
+      for image in images:
+        stream.write(memoryview(np.ascontiguousarray(image)).cast('B'))
+    return write
+
+  def _setFrame(self, frame):
+    imsize = getattr(self.source, 'imsize', None)
+    self.source.setImage(frame)
+    if self.source.imsize != imsize:
+      self.remapTable = None
+    if self.remapTable is None:
+      count('remapTable.miss')
+      if self.remapCache is not None:
+        self.remapTable = self.remapCache.lookup(self.target, self.source)
+      else:
+        self.remapTable = RemapTable.build(self.target, self.source)
+    else:
+      count('remapTable.hit')
+
+  # run every frame of the iterable through the pipeline, handing output
+  # image[s] to sink(index, images); returns frame count and throughput
+  def run(self, frames, sink):
+    decoded = queue.Queue(self.queueSize)
+    reprojected = queue.Queue(self.queueSize)
+    errors = []
+
+    # put and get that give up once any stage has failed, so no thread
+    # blocks on a queue that nobody serves any more
+    def put(q, item):
+      while not errors:
+        try:
+          q.put(item, timeout=0.1)
+          return
+        except queue.Full:
+          pass
+
+    def get(q):
+      while not errors:
+        try:
+          return q.get(timeout=0.1)
+        except queue.Empty:
+          pass
+      return _DONE
+
+    def decode():
+      try:
+        for frame in frames:
+          if errors:
+            return
+          put(decoded, frame)
+      except Exception as e:
+        errors.append(e)
+      finally:
+        put(decoded, _DONE)
+
+    def encode():
+      try:
+        index = 0
+        while True:
+          images = get(reprojected)
+          if images is _DONE:
+            return
+          sink(index, images)
+          index += 1
+      except Exception as e:
+        errors.append(e)
+
+    start = time.time()
+    done = 0
+    threads = [threading.Thread(target=decode), threading.Thread(target=encode)]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    try:
+      while True:
+        frame = get(decoded)
+        if frame is _DONE:
+          break
+        self._setFrame(frame)
+        self.target.reprojectToThis(self.source, remapTable=self.remapTable, workers=self.workers)
+        # the target is reused for the next frame, so hand copies downstream
+        put(reprojected, [np.array(image) for image in self.target._images()])
+        done += 1
+    except Exception as e:
+      errors.append(e)
+    finally:
+      put(reprojected, _DONE)
+      for thread in threads:
+        thread.join()
+    if errors:
+      raise errors[0]
+
+    seconds = time.time() - start
+    return {'frames': done, 'seconds': seconds, 'fps': done/seconds if seconds > 0 else 0.0}
@@ -12,8 +12,12 @@
 
 from .AbstractProjection import AbstractProjection
 import math
+import numpy as np
 
 class SideBySideFisheyeProjection(AbstractProjection):
+  # only the two circles are covered
+  MASKED = True
+
   def __init__(self):
     AbstractProjection.__init__(self)
 
@@ -24,7 +28,7 @@ class SideBySideFisheyeProjection(AbstractProjection):
     theta = angle[0]
     phi = angle[1]
     if theta is None or phi is None:
-      return (0,0,0)
+      return self._no_sample()
 
     r = math.cos(phi)
     # z is elevation in this case
@@ -42,6 +46,22 @@ class SideBySideFisheyeProjection(AbstractProjection):
 
     return self.get_pixel_from_uv(u,v, self.image)
 
+  def _texcoord_array(self, theta, phi):
+    sphere_pnt = self.point_on_sphere_array(theta, phi)
+
+    u = 0.5+(sphere_pnt[0]*-0.5)
+    u = np.where(theta>=0, u*0.5 + 0.5, (1.0-u)*0.5)
+    v = 0.5+(sphere_pnt[2]*0.5)
+    return u, v, None
+
+  # the circles are orthographic views of the hemispheres, so texture
+  # coordinates are linear in the direction
+  def _texcoord_from_direction(self, x, y, z):
+    u = 0.5+(x*-0.5)
+    u = np.where(y>=0, u*0.5 + 0.5, (1.0-u)*0.5)
+    v = 0.5+(z*0.5)
+    return u, v, None
+
   @staticmethod
   def angular_position(texcoord):
     up = texcoord[0]
@@ -57,14 +77,62 @@ class SideBySideFisheyeProjection(AbstractProjection):
       return None, None
 
     # v: 0..1-> vp: -1..1
-    phi = math.asin(2.0*(v-0.5))
+    z = 2.0*(v-0.5)
+    phi = np.arcsin(z)
 
     # u = math.cos(phi)*math.cos(theta)
     # u: 0..1 -> upp: -1..1
+    # worked out as in angular_position_array, so both paths agree
     u = 1.0-u
-    theta = math.acos( 2.0*(u-0.5) / math.cos(phi) )
+    r = np.sqrt(max(1.0-z*z, 0.0))
+    x = 2.0*(u-0.5)/r if r > 0 else 0.0
+    theta = np.arccos(min(max(x, -1.0), 1.0))
 
     if up<0.5:
        theta = theta-math.pi
 
-    return (theta,phi)
\ No newline at end of file
+    return (theta,phi)
+
+  # inside one of the circles
+  @staticmethod
+  def _valid_texcoords(up, v):
+    u = np.where(up>=0.5, 2.0*(up-0.5), 2.0*up)
+    return ((u-0.5)*(u-0.5) + (v-0.5)*(v-0.5)) <= 0.25
+
+  @staticmethod
+  def angular_position_array(up, v):
+    u = np.where(up>=0.5, 2.0*(up-0.5), 2.0*up)
+
+    # points outside of circles come back as NaN
+    outside = ((u-0.5)*(u-0.5) + (v-0.5)*(v-0.5))>0.25
+    z = 2.0*(v-0.5)
+    phi = np.arcsin(z)
+
+    u = 1.0-u
+    # cos(asin(z)) without the round trip; at the poles, where it is 0, the
+    # only point inside the circle is on the centre line
+    r = np.sqrt(np.maximum(1.0-z*z, 0.0))
+    x = np.divide(2.0*(u-0.5), r, out=np.zeros(np.shape(r)), where=r > 0)
+    theta = np.arccos(np.clip(x, -1.0, 1.0))
+    theta = np.where(up<0.5, theta-np.pi, theta)
+
+    theta[outside] = np.nan
+    phi[outside] = np.nan
+    return (theta,phi)
+
+  # angular_position_array as directions, which need no trigonometry: x and
+  # z are read straight off the circle and y completes the unit vector
+  @staticmethod
+  def direction_array(up, v):
+    right = up>=0.5
+    u = np.where(right, 2.0*(up-0.5), 2.0*up)
+    outside = ((u-0.5)*(u-0.5) + (v-0.5)*(v-0.5))>0.25
+    z = 2.0*(v-0.5)
+    x = 1.0-2.0*u
+    x = np.where(right, x, -x)
+    y = np.sqrt(np.maximum(1.0-x*x-z*z, 0.0))
+    y = np.where(right, y, -y)
+    x[outside] = np.nan
+    y[outside] = np.nan
+    z[outside] = np.nan
+    return x, y, z
@@ -0,0 +1,138 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from .EquirectangularProjection import EquirectangularProjection
+import numpy as np
+
+# packed stereo layouts: (columns, rows) of eyes in the frame, left eye
+# first, top or left
+STEREO_LAYOUTS = {
+  'topbottom': (1, 2),
+  'sidebyside': (2, 1),
+}
+
+# A stereo 360 frame: left and right equirectangular eyes packed top/bottom
+# or side by side. imsize is the size of one eye, and packed the whole
+# frame; eyes are views into it, so nothing is cropped or copied. As a
+# source on its own it shows the left eye, as a target from a mono source
+# both eyes show the same. Stereo to stereo maps each eye to its own, with
+# one mapping and a gather per eye.
+class StereoEquirectangularProjection(EquirectangularProjection):
+  def __init__(self, layout='topbottom'):
+    EquirectangularProjection.__init__(self)
+    self._layout(layout)
+    self.layout = layout
+    self._eyes = [None, None]
+
+  @staticmethod
+  def _layout(layout):
+    if layout not in STEREO_LAYOUTS:
+      raise ValueError('Unsupported stereo layout %s, valid values are: %s' % (layout, ', '.join(sorted(STEREO_LAYOUTS))))
+    return STEREO_LAYOUTS[layout]
+
+  # views of the two eyes in a packed frame
+  def _unpack(self, packed):
+    columns, rows = self._layout(self.layout)
+    height, width = packed.shape[0], packed.shape[1]
+    if height % rows or width % columns:
+      raise ValueError('A %s frame splits into %dx%d eyes, got %dx%d' % (self.layout, columns, rows, width, height))
+    height //= rows
+    width //= columns
+    return [packed[(i//columns)*height:(i//columns+1)*height, (i % columns)*width:(i % columns+1)*width] for i in range(2)]
+
+  def setImage(self, image):
+    self.packed, _ = self._checkArrayImage(image, 'Image')
+    self.eyes = self._unpack(self.packed)
+    self.image = self.eyes[0]
+    self.imsize = (self.image.shape[1], self.image.shape[0])
+    self.set_angular_resolution()
+
+  def loadImage(self, imageFile):
+    self.setImage(self._loadImage(imageFile)[0])
+
+  def loadRawImage(self, imageFile, width, height, channels=3, dtype=np.uint8, offset=0):
+    self.setImage(np.memmap(imageFile, dtype=dtype, mode='r', offset=offset, shape=(height, width, channels)))
+
+  # width and height are those of one eye
+  def initImage(self, width, height, filename=None, channels=4, dtype=np.uint8):
+    columns, rows = self._layout(self.layout)
+    self.setImage(self._initImage(columns*width, rows*height, filename, channels, dtype))
+
+  def saveImage(self, destFile):
+    self._saveImage(self.packed, (self.packed.shape[1], self.packed.shape[0]), destFile, **self._encoding())
+
+  def _images(self):
+    return (self.packed,)
+
+  # the eye as an EquirectangularProjection over its view of packed, with
+  # this projection's settings. Each eye is kept between calls so its mip
+  # levels are too
+  def eye(self, index):
+    eye = self._eyes[index]
+    if eye is None:
+      eye = self._eyes[index] = EquirectangularProjection()
+    mips = eye._mips
+    for name, value in self.__dict__.items():
+      if name not in ('packed', 'eyes', '_eyes', 'layout'):
+        eye.__dict__[name] = value
+    eye.image = self.eyes[index]
+    eye._mips = mips
+    return eye
+
+  # sampled on its own, the left eye is, mip levels and all
+  def _mip_levels(self, maxMemory=None):
+    return self.eye(0)._mip_levels(maxMemory)
+
+  def _prepare_source(self, maxMemory=None):
+    for index in range(2):
+      self.eye(index)._prepare_source(maxMemory)
+
+  # one mapping for the band, sampled once per eye; a mono source is only
+  # sampled once and stored in both
+  def _reproject_rows(self, sourceProjection, rows, remapTable=None):
+    sources = [sourceProjection.eye(index) for index in range(2)]
+    if sources[1] is sources[0]:
+      sources = sources[:1]
+    if remapTable is not None:
+      for index, source in enumerate(sources):
+        remapTable.apply(source, self.eye(index), rows)
+    else:
+      mapping = self.eye(0)._map_rows(sources[0], rows)
+      for index, source in enumerate(sources):
+        self.eye(index)._sample_rows(source, rows, *mapping)
+    if len(sources) == 1:
+      self.eyes[1][rows] = self.eyes[0][rows]
+
+  # rectangles of the packed frame clipped to eye index, in its pixels
+  def _eye_rectangles(self, rectangles, index):
+    columns, _ = self._layout(self.layout)
+    width, height = self.imsize
+    left = (index % columns)*width
+    top = (index // columns)*height
+    eye = []
+    for rectangle in rectangles:
+      _, x0, y0, x1, y1 = self._changed_rectangle(rectangle)
+      x0, x1 = max(x0-left, 0), min(x1-left, width)
+      y0, y1 = max(y0-top, 0), min(y1-top, height)
+      if x0 < x1 and y0 < y1:
+        eye.append((x0, y0, x1, y1))
+    return eye
+
+  # each eye from its own eye of the source, with rectangles of a stereo
+  # source given in its packed frame
+  def reprojectToThisChanged(self, sourceProjection, rectangles, remapTable=None, workers=1):
+    return sum(self.eye(index).reprojectToThisChanged(sourceProjection.eye(index), sourceProjection._eye_rectangles(rectangles, index), remapTable, workers)
+               for index in range(2))
+
+  def reprojectToThisScalar(self, sourceProjection):
+    for index in range(2):
+      self.eye(index).reprojectToThisScalar(sourceProjection.eye(index))
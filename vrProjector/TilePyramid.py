@@ -0,0 +1,219 @@
+# Copyright 2016 Bhautik J Joshi
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .AbstractProjection import AbstractProjection, changed_levels, downsample
+from .CubemapProjection import FACES, CubemapProjection
+from .Profiler import count, span
+
+# Cubemap faces at every zoom level of a tiled panorama viewer, cut into
+# tileSize square tiles. Level 0 is the smallest, fitting one tile per
+# face; each level above doubles the face size up to faceSize. Only the top
+# level is reprojected, the others are area averaged from the level above,
+# and tiles are encoded on a thread pool. Tiles are written to pattern, a
+# format string of level, face, row and col, under directory, next to a
+# pyramid.json describing the levels.
+class TilePyramid:
+  def __init__(self, directory, faceSize, tileSize=512, workers=1, pattern='{level}/{face}/{row}_{col}.png'):
+    self.directory = directory
+    self.faceSize = faceSize
+    self.tileSize = tileSize
+    self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+    self.pattern = pattern
+    sizes = [faceSize]
+    while sizes[-1] > tileSize:
+      sizes.append(-(-sizes[-1] // 2))
+    self.sizes = sizes[::-1]
+    # (6, size, size, channels) faces of every level, and which of their
+    # tiles are held in them; filled by render, or read back from the
+    # written tiles when update needs them
+    self.images = [None]*len(self.sizes)
+    self.present = [None]*len(self.sizes)
+    # whether every tile has been written, by render or an earlier run
+    self.written = False
+
+  # a pyramid written before, so update can regenerate part of it
+  @classmethod
+  def open(cls, directory, workers=1):
+    with open(os.path.join(directory, 'pyramid.json')) as f:
+      meta = json.load(f)
+    pyramid = cls(directory, meta['faceSize'], meta['tileSize'], workers, meta['pattern'])
+    pyramid.written = True
+    return pyramid
+
+  @property
+  def levels(self):
+    return len(self.sizes)
+
+  # tiles along each side of a face at level
+  def tiles(self, level):
+    return -(-self.sizes[level] // self.tileSize)
+
+  def tilePath(self, level, face, row, col):
+    return os.path.join(self.directory, self.pattern.format(level=level, face=FACES[face], row=row, col=col))
+
+  # (rows, columns) slices of a tile's pixels within its face
+  def _tileSlices(self, level, row, col):
+    size = self.sizes[level]
+    t = self.tileSize
+    return slice(row*t, min(size, (row+1)*t)), slice(col*t, min(size, (col+1)*t))
+
+  def describe(self):
+    return {
+      'faceSize': self.faceSize,
+      'tileSize': self.tileSize,
+      'pattern': self.pattern,
+      'faces': list(FACES),
+      'levels': [{'level': level, 'size': size, 'tiles': self.tiles(level)} for level, size in enumerate(self.sizes)],
+    }
+
+  # reproject the top level from sourceProjection, average the levels below
+  # and write every tile; returns the tile paths written
+  def render(self, sourceProjection, remapTable=None):
+    top = self.levels-1
+    cube = CubemapProjection()
+    cube.initImages(self.faceSize, self.faceSize, None, *sourceProjection.pixel_format())
+    cube.reprojectToThis(sourceProjection, remapTable=remapTable, workers=self.workers)
+    self.images[top] = cube.faces
+    for level in range(top-1, -1, -1):
+      with span('pyramid.downsample', level=level, pixels=6*self.sizes[level]**2):
+        self.images[level] = downsample(self.images[level+1])
+    tiles = []
+    for level in range(self.levels):
+      n = self.tiles(level)
+      self.present[level] = np.ones((6, n, n), bool)
+      tiles.extend((level, face, row, col) for face in range(6) for row in range(n) for col in range(n))
+    self._writeTiles(tiles)
+    with open(os.path.join(self.directory, 'pyramid.json'), 'w') as f:
+      json.dump(self.describe(), f, indent=2)
+    self.written = True
+    return [self.tilePath(*tile) for tile in tiles]
+
+  # changed mask for update with the given source pixel rectangles set:
+  # (x0, y0, x1, y1), or (face, x0, y0, x1, y1) for cubemap sources
+  @staticmethod
+  def changedMask(sourceProjection, rectangles):
+    return sourceProjection.changed_mask(sourceProjection._eye_rectangles(rectangles, 0))
+
+  # regenerate just the tiles that read source texels marked in changed, a
+  # boolean mask of the source image (height, width), or (6, height, width)
+  # for cubemap sources; returns the tile paths written. Tiles not held
+  # from render are read back from disk where the lower levels need them,
+  # so a pyramid from open can be updated in a new process. remapTable, the
+  # top level mapping render used, saves recomputing it tile by tile
+  def update(self, sourceProjection, changed, remapTable=None):
+    changed = changed_levels(np.asarray(changed, bool), len(sourceProjection._mip_levels()) if sourceProjection.mipmap else 1)
+    top = self.levels-1
+    n = self.tiles(top)
+    channels, dtype = sourceProjection.pixel_format()
+    if self.images[top] is None:
+      self.images[top] = np.zeros((6, self.faceSize, self.faceSize, channels), dtype)
+      self.present[top] = np.zeros((6, n, n), bool)
+    candidates = [(face, row, col) for face in range(6) for row in range(n) for col in range(n)]
+    with ThreadPoolExecutor(max_workers=self.workers) as pool:
+      redrawn = list(pool.map(lambda tile: self._updateTopTile(sourceProjection, changed, remapTable, *tile), candidates))
+    dirty = np.zeros((6, n, n), bool)
+    for (face, row, col), hit in zip(candidates, redrawn):
+      dirty[face, row, col] = hit
+    count('pyramid.tilesChanged', int(dirty.sum()))
+
+    tiles = [(top,) + tuple(tile) for tile in np.argwhere(dirty)]
+    for level in range(top-1, -1, -1):
+      # a tile covers the 2x2 tiles below it at the next level up
+      m = self.tiles(level)
+      padded = np.zeros((6, 2*m, 2*m), bool)
+      padded[:, :dirty.shape[1], :dirty.shape[2]] = dirty
+      dirty = padded.reshape(6, m, 2, m, 2).any(axis=(2, 4))
+      if self.images[level] is None:
+        self.images[level] = np.zeros((6, self.sizes[level], self.sizes[level], channels), dtype)
+        self.present[level] = np.zeros((6, m, m), bool)
+      for face, row, col in np.argwhere(dirty):
+        self._downsampleTile(level, face, row, col)
+        tiles.append((level, face, row, col))
+    self._writeTiles(tiles)
+    self.written = True
+    return [self.tilePath(*tile) for tile in tiles]
+
+  # resample a top level tile if any texel it reads is marked changed, or
+  # the pyramid has not been written yet; returns whether it was
+  def _updateTopTile(self, sourceProjection, changed, remapTable, face, row, col):
+    top = self.levels-1
+    rows, cols = self._tileSlices(top, row, col)
+    if remapTable is not None:
+      su = remapTable.u[face, rows, cols]
+      sv = remapTable.v[face, rows, cols]
+      sface = None if remapTable.face is None else remapTable.face[face, rows, cols]
+    else:
+      u = np.arange(cols.start, cols.stop, dtype=np.float64)/float(self.faceSize)
+      v = np.arange(rows.start, rows.stop, dtype=np.float64)/float(self.faceSize)
+      u, v = np.meshgrid(u, v)
+      theta, phi = CubemapProjection.get_theta_phi_array(*CubemapProjection._face_direction(face, u, v))
+      su, sv, sface = sourceProjection.texcoord_array(theta, phi)
+    if self.written:
+      touched = False
+      for level, tapface, x, y in sourceProjection.sample_taps(su, sv, sface):
+        hits = changed[level][y, x] if tapface is None else changed[level][tapface, y, x]
+        if hits.any():
+          touched = True
+          break
+      if not touched:
+        return False
+    pixels = sourceProjection.sample_array(su, sv, sface)
+    image = self.images[top]
+    image[face, rows, cols] = AbstractProjection._fit_pixels(pixels, None, image.shape[-1], image.dtype)
+    self.present[top][face, row, col] = True
+    return True
+
+  def _downsampleTile(self, level, face, row, col):
+    above = level+1
+    for r in range(2*row, min(2*row+2, self.tiles(above))):
+      for c in range(2*col, min(2*col+2, self.tiles(above))):
+        self._ensureTile(above, face, r, c)
+    rows, cols = self._tileSlices(level, row, col)
+    size = self.sizes[above]
+    region = self.images[above][face:face+1, 2*rows.start:min(size, 2*rows.stop), 2*cols.start:min(size, 2*cols.stop)]
+    self.images[level][face, rows, cols] = downsample(region)[0]
+    self.present[level][face, row, col] = True
+
+  # read back a tile written by an earlier run that this one has not held
+  def _ensureTile(self, level, face, row, col):
+    if self.present[level][face, row, col]:
+      return
+    image, _ = AbstractProjection._loadImage(self.tilePath(level, face, row, col))
+    rows, cols = self._tileSlices(level, row, col)
+    self.images[level][face, rows, cols] = AbstractProjection._fit_pixels(image, None, self.images[level].shape[-1], self.images[level].dtype)
+    self.present[level][face, row, col] = True
+
+  def _writeTile(self, level, face, row, col):
+    rows, cols = self._tileSlices(level, row, col)
+    path = self.tilePath(level, face, row, col)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+      os.makedirs(directory, exist_ok=True)
+    tile = self.images[level][face, rows, cols]
+    AbstractProjection._saveImage(tile, (tile.shape[1], tile.shape[0]), path)
+
+  def _writeTiles(self, tiles):
+    with span('pyramid.write', tiles=len(tiles)):
+      if self.workers == 1:
+        for tile in tiles:
+          self._writeTile(*tile)
+        return
+      with ThreadPoolExecutor(max_workers=self.workers) as pool:
+        for result in [pool.submit(self._writeTile, *tile) for tile in tiles]:
+          result.result()
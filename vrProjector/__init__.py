@@ -9,8 +9,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .AbstractProjection import AbstractProjection
-from .EquirectangularProjection import EquirectangularProjection
-from .SideBySideFisheyeProjection import SideBySideFisheyeProjection
-from .CubemapProjection import CubemapProjection
-from .FisheyeProjection import FisheyeProjection
\ No newline at end of file
+import importlib
+import sys
+import types
+
+# Every public class lives in the module of the same name. They are imported
+# on first use, so importing the package (e.g. for vrProjectorCmd --help)
+# does not pull in NumPy or Pillow.
+__all__ = [
+  'AbstractProjection',
+  'EquirectangularProjection',
+  'StereoEquirectangularProjection',
+  'SideBySideFisheyeProjection',
+  'CubemapProjection',
+  'FisheyeProjection',
+  'PerspectiveProjection',
+  'TilePyramid',
+  'RemapTable',
+  'RemapCache',
+  'SequenceReprojector',
+  'Profiler',
+  'BatchProcessor',
+  'ReprojectionServer',
+]
+
+# importing a submodule binds it as a package attribute, which would shadow
+# the class of the same name, as for import vrProjector.RemapTable; bind the
+# class instead, so vrProjector.X is always the class
+class _Package(types.ModuleType):
+  def __setattr__(self, name, value):
+    if name in __all__ and isinstance(value, types.ModuleType) and hasattr(value, name):
+      value = getattr(value, name)
+    types.ModuleType.__setattr__(self, name, value)
+
+sys.modules[__name__].__class__ = _Package
+
+def __getattr__(name):
+  if name not in __all__:
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+  importlib.import_module('.' + name, __name__)
+  return globals()[name]
+
+def __dir__():
+  return sorted(set(globals()) | set(__all__))
@@ -11,69 +11,320 @@
 
 
 import argparse
+import itertools
+import json
+import os
+import signal
+import sys
+import threading
 
+# the package loads its classes, NumPy and Pillow on first use, so --help
+# and argument errors return without importing them
 import vrProjector
 
+def addCacheArguments(parser):
+  parser.add_argument('--cacheDir', required=False, help='directory of cached mappings shared between runs. Default: $VRPROJECTOR_CACHE or ~/.cache/vrProjector')
+  parser.add_argument('--cacheSize', required=False, type=int, default=1024, help='size limit of the mapping cache in megabytes; least recently used mappings are removed beyond it')
+  parser.add_argument('--noCache', required=False, action='store_true', help='build the mapping without reading or writing the cache')
+
+def addViewArguments(parser):
+  parser.add_argument('--yaw', required=False, type=float, default=0.0, help='Perspective output: degrees the view is turned right from the centre of an equirectangular image')
+  parser.add_argument('--pitch', required=False, type=float, default=0.0, help='Perspective output: degrees the view is tilted up')
+  parser.add_argument('--roll', required=False, type=float, default=0.0, help='Perspective output: degrees the view is turned clockwise')
+  parser.add_argument('--fov', required=False, type=float, default=90.0, help='Perspective output: horizontal field of view in degrees')
+
+def addRotationArguments(parser):
+  parser.add_argument('--rotation', required=False, help='re-orient the source while reprojecting, in the same pass: "yaw,pitch,roll" in degrees (turn right, tilt up, turn clockwise) or a "w,x,y,z" quaternion')
+
+def addMipmapArguments(parser):
+  parser.add_argument('--mipmap', required=False, action='store_true', help='sample the source from a mip pyramid at the level matching each output pixel, so shrinking a large source does not alias')
+
+def addPrecisionArguments(parser):
+  parser.add_argument('--precision', required=False, default='float64', help='type the mapping from output pixels to the source is worked out in. float32 goes through unit direction vectors rather than angles, which is faster and needs half the memory. Valid values are: float64, float32')
+
+def addEncodingArguments(parser):
+  parser.add_argument('--compression', required=False, type=int, help='PNG zlib level from 0 (stored, fastest) to 9 (smallest), or for TIFFs 0 for uncompressed and above 0 for deflate. Default: the image library\'s own')
+  parser.add_argument('--quality', required=False, type=int, help='JPEG quality from 1 to 100. Default: the image library\'s own')
+
+def setRotation(source, args):
+  if args.rotation is not None:
+    source.set_rotation(**vrProjector.BatchProcessor.parseRotation(args.rotation))
+
+def setView(out, args):
+  if isinstance(out, vrProjector.PerspectiveProjection):
+    out.set_view(args.yaw, args.pitch, args.roll, args.fov)
+  out.set_precision(args.precision)
+
+def remapCache(args):
+  if args.noCache:
+    return None
+  return vrProjector.RemapCache(args.cacheDir, args.cacheSize*1024*1024)
+
+# vrProjectorCmd batch ...: many conversions in one process, one JSON
+# status line per job on stdout
+def batchMain(argv):
+  parser = argparse.ArgumentParser(prog='vrProjectorCmd batch', description='Run many reprojections from a manifest')
+  parser.add_argument('--manifest', required=False, default='-', help='JSON lines or CSV file of jobs, - for stdin. Jobs use the option names of a single conversion: sourceProjection, sourceImage, outProjection, outImage, outWidth, outHeight and optionally id, interpolation, sourceLayout, outLayout, rotation, mipmap, precision, compression, quality, yaw, pitch, roll, fov')
+  parser.add_argument('--format', required=False, help='manifest format: jsonl or csv. Default: guessed from the first line')
+  parser.add_argument('--workers', required=False, type=int, default=1, help='number of jobs to run at once. 0 uses every core.')
+  parser.add_argument('--chunkSize', required=False, type=int, default=16, help='jobs with the same geometry handed to a worker at a time')
+  parser.add_argument('--profile', required=False, help='write a Chrome trace of the whole batch to this JSON file, and print a summary')
+  addCacheArguments(parser)
+
+  args = parser.parse_args(argv)
+
+  if args.manifest == '-':
+    jobs = vrProjector.BatchProcessor.readManifest(sys.stdin, args.format)
+  else:
+    with open(args.manifest) as f:
+      jobs = vrProjector.BatchProcessor.readManifest(f, args.format)
+
+  def report(result):
+    sys.stdout.write(json.dumps(result) + '\n')
+    sys.stdout.flush()
+
+  workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+  processor = vrProjector.BatchProcessor(workers, remapCache(args), args.chunkSize)
+  failures = profiled(args.profile, processor.run, jobs, report)
+  sys.stderr.write('%d jobs, %d failed\n' % (len(jobs), failures))
+  if failures:
+    sys.exit(1)
+
+# vrProjectorCmd sequence ...: reproject every frame of a video with one
+# mapping, decoding, reprojecting and encoding on separate threads
+def sequenceMain(argv):
+  parser = argparse.ArgumentParser(prog='vrProjectorCmd sequence', description='Reproject a sequence of frames')
+  parser.add_argument('--sourceProjection', required=True, help='Type of source projection. Valid values are: Equirectangular, SideBySideFisheye, Fisheye')
+  parser.add_argument('--sourceFrames', required=True, help='Source frames: a glob pattern in quotes like so "frames/*.png", or - to read raw frames from stdin')
+  parser.add_argument('--sourceWidth', required=False, type=int, help='width of raw source frames in pixels')
+  parser.add_argument('--sourceHeight', required=False, type=int, help='height of raw source frames in pixels')
+  parser.add_argument('--sourceChannels', required=False, type=int, default=3, help='channels of raw source frames, e.g. 3 for ffmpeg -pix_fmt rgb24')
+  parser.add_argument('--sourceLayout', required=False, help='Stereo layout of equirectangular source frames. Valid values are: topbottom, sidebyside')
+  parser.add_argument('--sourceDtype', required=False, default='uint8', help='pixel type of raw source frames, e.g. uint16 for ffmpeg -pix_fmt rgb48le. Valid values are: uint8, uint16, float32')
+  parser.add_argument('--interpolation', required=False, help='Interpolation used when sampling the source. Valid values are: nearest, bilinear, bicubic, lanczos')
+  parser.add_argument('--outProjection', required=True, help='Type of output projection. Valid values are: Equirectangular, Cubemap, SideBySideFisheye, Fisheye, Perspective')
+  parser.add_argument('--outFrames', required=True, help='output frame pattern[s] numbered from 0, like so "out/%%05d.png"; six patterns in double quotes for cubemaps. - writes raw frames with the channels and pixel type of the source frames to stdout, cubemap faces one after another')
+  parser.add_argument('--outWidth', required=True, type=int, help='output image[s] width in pixels')
+  parser.add_argument('--outHeight', required=True, type=int, help='output image[s] height in pixels')
+  parser.add_argument('--outLayout', required=False, help='Write cubemap faces into one packed output frame, or both eyes of a stereo equirectangular output. Valid values are: strip (6x1), cross (4x3), grid (3x2) for cubemaps and topbottom, sidebyside for stereo')
+  parser.add_argument('--workers', required=False, type=int, default=1, help='number of worker threads to reproject with. 0 uses every core.')
+  parser.add_argument('--queueSize', required=False, type=int, default=4, help='frames buffered between the decode, reproject and encode stages')
+  parser.add_argument('--profile', required=False, help='write a Chrome trace of every decode, reprojection and encode stage to this JSON file, and print a summary')
+  addRotationArguments(parser)
+  addMipmapArguments(parser)
+  addPrecisionArguments(parser)
+  addViewArguments(parser)
+  addCacheArguments(parser)
+
+  args = parser.parse_args(argv)
+
+  PROJECTIONS = vrProjector.BatchProcessor.PROJECTIONS
+  sourceType = PROJECTIONS.get(args.sourceProjection.lower())
+  if sourceType is None or sourceType is vrProjector.CubemapProjection:
+    parser.error('unsupported source projection type: %s' % args.sourceProjection)
+  outType = PROJECTIONS.get(args.outProjection.lower())
+  if outType is None:
+    parser.error('unsupported output projection type: %s' % args.outProjection)
+
+  source = vrProjector.BatchProcessor.newProjection(args.sourceProjection, args.sourceLayout)
+  if args.interpolation is not None:
+    source.set_interpolation(args.interpolation.lower())
+  setRotation(source, args)
+  source.set_mipmap(args.mipmap)
+  if args.sourceFrames == '-':
+    if args.sourceWidth is None or args.sourceHeight is None:
+      parser.error('--sourceWidth and --sourceHeight are required for raw frames on stdin')
+    frames = vrProjector.SequenceReprojector.readRawFrames(sys.stdin.buffer, args.sourceWidth, args.sourceHeight, args.sourceChannels, args.sourceDtype)
+  else:
+    frames = vrProjector.SequenceReprojector.readFrameFiles(args.sourceFrames)
+  out = vrProjector.BatchProcessor.newProjection(args.outProjection, args.outLayout)
+  setView(out, args)
+  # output frames keep the channels and pixel type of the first frame
+  first = next(frames, None)
+  pixelFormat = () if first is None else out.output_format((first.shape[-1], first.dtype))
+  frames = itertools.chain(() if first is None else (first,), frames)
+  if outType is vrProjector.CubemapProjection:
+    out.initImages(args.outWidth, args.outHeight, None if args.outLayout is None else args.outLayout.lower(), *pixelFormat)
+  else:
+    out.initImage(args.outWidth, args.outHeight, None, *pixelFormat)
+
+  if args.outFrames == '-':
+    sink = vrProjector.SequenceReprojector.writeRawFrames(sys.stdout.buffer)
+  else:
+    sink = vrProjector.SequenceReprojector.writeFrameFiles(args.outFrames.split(' '))
+
+  pipeline = vrProjector.SequenceReprojector(out, source, args.workers, args.queueSize, remapCache(args))
+  stats = profiled(args.profile, pipeline.run, frames, sink)
+  sys.stdout.flush()
+  # stdout may be carrying frames, so report on stderr
+  sys.stderr.write('%d frames in %.2fs: %.2f fps\n' % (stats['frames'], stats['seconds'], stats['fps']))
+
+# vrProjectorCmd tiles ...: cubemap tiles at every zoom level of a tiled
+# viewer, or with --changed, just the tiles a changed source region touches
+def tilesMain(argv):
+  parser = argparse.ArgumentParser(prog='vrProjectorCmd tiles', description='Write a multi-resolution cubemap tile pyramid')
+  parser.add_argument('--sourceProjection', required=True, help='Type of source projection. Valid values are: Equirectangular, Cubemap, SideBySideFisheye, Fisheye, Perspective')
+  parser.add_argument('--sourceImage', required=True, help='Source image[s]. List multiple images in double quotes like so "front.png right.png back.png left.png top.png bottom.png"')
+  parser.add_argument('--sourceLayout', required=False, help='Packed cubemap layout of a single source image, or for equirectangular sources the stereo layout, of which the left eye is used. Valid values are: strip, cross, grid for cubemaps and topbottom, sidebyside for stereo')
+  parser.add_argument('--interpolation', required=False, help='Interpolation used when sampling the source. Valid values are: nearest, bilinear, bicubic, lanczos')
+  parser.add_argument('--outDir', required=True, help='directory the tiles and pyramid.json are written to')
+  parser.add_argument('--faceSize', required=False, type=int, help='cubemap face size of the most detailed level in pixels. Required unless --changed updates an existing pyramid')
+  parser.add_argument('--tileSize', required=False, type=int, default=512, help='tile size in pixels; the least detailed level has one tile per face')
+  parser.add_argument('--pattern', required=False, default='{level}/{face}/{row}_{col}.png', help='tile path under --outDir, formatted with level (0 is least detailed), face, row and col')
+  parser.add_argument('--changed', required=False, action='append', help='update an existing pyramid, rewriting only the tiles that sample this x0,y0,x1,y1 rectangle of source pixels; may be given more than once. Cubemap sources add the face index: face,x0,y0,x1,y1')
+  parser.add_argument('--workers', required=False, type=int, default=1, help='number of worker threads to reproject and write tiles with. 0 uses every core.')
+  parser.add_argument('--profile', required=False, help='write a Chrome trace of every stage to this JSON file, and print a summary')
+  addRotationArguments(parser)
+  addMipmapArguments(parser)
+  addCacheArguments(parser)
+
+  args = parser.parse_args(argv)
+  if args.changed is None and args.faceSize is None:
+    parser.error('--faceSize is required to write a new pyramid')
+  profiled(args.profile, tiles, args)
+
+def tiles(args):
+  source = vrProjector.BatchProcessor.loadSource(args.sourceProjection, args.sourceImage, args.sourceLayout, args.interpolation, args.rotation, args.mipmap)
+  if args.changed is None:
+    pyramid = vrProjector.TilePyramid(args.outDir, args.faceSize, args.tileSize, args.workers, args.pattern)
+  else:
+    pyramid = vrProjector.TilePyramid.open(args.outDir, args.workers)
+  cache = remapCache(args)
+  table = None
+  if cache is not None:
+    top = vrProjector.CubemapProjection()
+    top.initImages(pyramid.faceSize, pyramid.faceSize)
+    table = cache.lookup(top, source)
+
+  if args.changed is None:
+    written = pyramid.render(source, table)
+  else:
+    rectangles = [[int(v) for v in rectangle.split(',')] for rectangle in args.changed]
+    written = pyramid.update(source, pyramid.changedMask(source, rectangles), table)
+  sys.stderr.write('%d tiles written\n' % len(written))
+
+# vrProjectorCmd serve ...: a long running server taking jobs over HTTP on
+# localhost or a Unix socket, with decoded sources and mappings kept warm
+def serveMain(argv):
+  parser = argparse.ArgumentParser(prog='vrProjectorCmd serve', description='Serve reprojection jobs over HTTP on localhost or a Unix socket')
+  parser.add_argument('--port', required=False, type=int, default=8123, help='localhost port to listen on')
+  parser.add_argument('--socket', required=False, help='listen on this Unix socket path instead of a port')
+  parser.add_argument('--workers', required=False, type=int, default=1, help='number of jobs to run at once. 0 uses every core.')
+  parser.add_argument('--queueSize', required=False, type=int, default=4, help='jobs waiting for a worker before new ones are turned away with 503 Busy')
+  parser.add_argument('--maxSources', required=False, type=int, default=1024, help='memory for decoded sources kept between jobs, in megabytes')
+  parser.add_argument('--maxTables', required=False, type=int, default=32, help='mappings kept in memory between jobs')
+  parser.add_argument('--verbose', required=False, action='store_true', help='log every request to stderr')
+  parser.add_argument('--token', required=False, default=os.environ.get('VRPROJECTOR_TOKEN'), help='require this token in the X-vrProjector-Token header of every request. Default: $VRPROJECTOR_TOKEN')
+  addCacheArguments(parser)
+
+  args = parser.parse_args(argv)
+  service = vrProjector.ReprojectionServer(args.workers, args.queueSize, args.maxSources*1024*1024, args.maxTables, remapCache(args))
+  server = service.httpServer(args.port, socketPath=args.socket, verbose=args.verbose, token=args.token)
+  # SIGTERM stops the server like Ctrl-C, letting running jobs finish
+  signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+  sys.stderr.write('serving on %s\n' % (args.socket or 'http://127.0.0.1:%d' % args.port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    service.close()
+
 def main():
+  if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+    serveMain(sys.argv[2:])
+    return
+  if len(sys.argv) > 1 and sys.argv[1] == 'sequence':
+    sequenceMain(sys.argv[2:])
+    return
+  if len(sys.argv) > 1 and sys.argv[1] == 'tiles':
+    tilesMain(sys.argv[2:])
+    return
+  if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+    batchMain(sys.argv[2:])
+    return
+
   parser = argparse.ArgumentParser(description='Reproject photospheres')
-  parser.add_argument('--sourceProjection', required=True, help='Type of source projection. Valid values are: Equirectangular, Cubemap, SideBySideFisheye')
+  parser.add_argument('--sourceProjection', required=True, help='Type of source projection. Valid values are: Equirectangular, Cubemap, SideBySideFisheye, Fisheye, Perspective')
   parser.add_argument('--sourceImage', required=True, help='Source image[s]. List multiple images in double quotes like so "front.png right.png back.png left.png top.png bottom.png"')
+  parser.add_argument('--sourceLayout', required=False, help='Packed cubemap layout of a single source image, or for equirectangular sources the stereo layout. Valid values are: strip, cross, grid for cubemaps and topbottom, sidebyside for stereo')
   parser.add_argument('--useBilnear', required=False, help='Use bilinear interpolation when reprojecting. Valid values are true and false.')
-  parser.add_argument('--outProjection', required=True, help='Type of output projection. Valid values are: Equirectangular, Cubemap, SideBySideFisheye, Fisheye')
+  parser.add_argument('--interpolation', required=False, help='Interpolation used when sampling the source. Valid values are: nearest, bilinear, bicubic, lanczos')
+  parser.add_argument('--outProjection', required=True, help='Type of output projection. Valid values are: Equirectangular, Cubemap, SideBySideFisheye, Fisheye, Perspective')
   parser.add_argument('--outImage', required=True, help='output image[s]. List multiple images in double quotes like so "front.png right.png back.png left.png top.png bottom.png"')
   parser.add_argument('--outWidth', required=True, help='output image[s] width in pixels')
   parser.add_argument('--outHeight', required=True, help='output image[s] height in pixels')
+  parser.add_argument('--outLayout', required=False, help='Write cubemap faces of --outWidth x --outHeight into one packed output image, or for equirectangular outputs both eyes of a stereo pair. Valid values are: strip (6x1), cross (4x3), grid (3x2) for cubemaps and topbottom, sidebyside for stereo')
+  parser.add_argument('--workers', required=False, type=int, default=1, help='number of worker threads to reproject with. 0 uses every core.')
+  parser.add_argument('--maxMemory', required=False, type=int, help='approximate working memory to reproject with, in megabytes. Use .npy source and output images to keep images larger than RAM on disk.')
+  parser.add_argument('--profile', required=False, help='write a Chrome trace of every load, reprojection and save stage to this JSON file, and print a summary')
+  parser.add_argument('--changed', required=False, action='append', help='update the existing output image[s] of an earlier conversion after the source was edited inside this x0,y0,x1,y1 rectangle of source pixels, resampling only the output pixels that read it; may be given more than once. Cubemap sources add the face index: face,x0,y0,x1,y1')
+  addRotationArguments(parser)
+  addMipmapArguments(parser)
+  addPrecisionArguments(parser)
+  addEncodingArguments(parser)
+  addViewArguments(parser)
+  addCacheArguments(parser)
 
   args = parser.parse_args()
+  if args.changed is not None:
+    unpacked = args.outProjection.lower() == 'cubemap' and args.outLayout is None
+    missing = [f for f in (args.outImage.split(' ') if unpacked else [args.outImage]) if not os.path.exists(f)]
+    if missing:
+      parser.error('--changed updates an existing output, but %s does not exist' % ', '.join(missing))
+  profiled(args.profile, convert, args)
 
-  source = None
-  if args.sourceProjection.lower() == "Equirectangular".lower():
-    source = vrProjector.EquirectangularProjection()
-    source.loadImage(args.sourceImage)
-  elif args.sourceProjection.lower() == "SideBySideFisheye".lower():
-    source = vrProjector.SideBySideFisheyeProjection()
-    source.loadImage(args.sourceImage)
-  elif args.sourceProjection.lower() == "Cubemap".lower():
-    source = vrProjector.CubemapProjection()
-    imageList = args.sourceImage.split(' ')
-    source.loadImages(imageList[0], imageList[1], imageList[2], imageList[3], imageList[4], imageList[5])
-  elif args.sourceProjection.lower() == "Fisheye".lower():
-    source = vrProjector.FisheyeProjection()
-    source.loadImage(args.sourceImage)
+# run fn(*args), recording a trace to profilePath when it is given
+def profiled(profilePath, fn, *args):
+  if profilePath is None:
+    return fn(*args)
+  with vrProjector.Profiler() as profiler:
+    result = fn(*args)
+  profiler.save(profilePath)
+  summary = profiler.summary()
+  for name, total in sorted(summary['spans'].items(), key=lambda item: -item[1]['seconds']):
+    sys.stderr.write('%-16s %5d calls %9.3fs %12d pixels %8.1fMB\n' % (name, total['calls'], total['seconds'], total['pixels'], total['bytes']/1e6))
+  for name, value in sorted(summary['counters'].items()):
+    sys.stderr.write('%-16s %5d\n' % (name, value))
+  return result
 
-  else:
+def convert(args):
+  if args.sourceProjection.lower() not in vrProjector.BatchProcessor.PROJECTIONS:
     print("Quitting because unsupported source projection type: ", args.sourceProjection)
     return
+  if args.outProjection.lower() not in vrProjector.BatchProcessor.PROJECTIONS:
+    print("Quitting because unsupported output projection type: ", args.outProjection)
+    return
 
-  if args.useBilnear is not None:
+  source = vrProjector.BatchProcessor.loadSource(args.sourceProjection, args.sourceImage, args.sourceLayout, args.interpolation, args.rotation, args.mipmap)
+  if args.useBilnear is not None and args.interpolation is None:
     if args.useBilnear.lower() == "true":
       source.set_use_bilinear(True)
 
-  out = None
-  if args.outProjection.lower() == "Equirectangular".lower():
-    out = vrProjector.EquirectangularProjection()
-    out.initImage(int(args.outWidth), int(args.outHeight))
-  elif args.outProjection.lower() == "SideBySideFisheye".lower():
-    out = vrProjector.SideBySideFisheyeProjection()
-    out.initImage(int(args.outWidth), int(args.outHeight))
-  elif args.outProjection.lower() == "Cubemap".lower():
-    out = vrProjector.CubemapProjection()
-    out.initImages(int(args.outWidth), int(args.outHeight))
-  elif args.outProjection.lower() == "Fisheye".lower():
-    out = vrProjector.FisheyeProjection()
-    out.initImage(int(args.outWidth), int(args.outHeight))
-  else:
-    print("Quitting because unsupported output projection type: ", args.outProjection)
-    return
+  # .npy outputs are memory-mapped and written in place; with --changed the
+  # existing output is read first
+  outFile = args.outImage if args.outImage.lower().endswith('.npy') and args.changed is None else None
+  view = dict((field, getattr(args, field)) for field in vrProjector.BatchProcessor.VIEW_FIELDS)
+  out = vrProjector.BatchProcessor.initTarget(args.outProjection, args.outWidth, args.outHeight, args.outLayout, view,
+                                              source.pixel_format(), args.precision, outFile)
 
-  out.reprojectToThis(source)
-  # out.reprojectToThisThreaded(source, 16)
-
-  if args.outProjection.lower() == "Cubemap".lower():
-    imageList = args.outImage.split(' ')
-    out.saveImages(imageList[0], imageList[1], imageList[2], imageList[3], imageList[4], imageList[5])
+  maxMemory = None if args.maxMemory is None else args.maxMemory*1024*1024
+  # a whole-image mapping would defeat the memory bound, so memory-bounded
+  # runs always compute the mapping band by band
+  cache = remapCache(args) if maxMemory is None else None
+  table = None if cache is None else cache.lookup(out, source)
+  if args.changed is not None:
+    vrProjector.BatchProcessor.loadTarget(out, args.outProjection, args.outImage, args.outLayout)
+    rectangles = [[int(v) for v in rectangle.split(',')] for rectangle in args.changed]
+    out.reprojectToThisChanged(source, rectangles, remapTable=table, workers=args.workers)
   else:
-    out.saveImage(args.outImage)
+    out.reprojectToThis(source, remapTable=table, workers=args.workers, maxMemory=maxMemory)
+
+  seconds = vrProjector.BatchProcessor.saveTarget(out, args.outImage, args.compression, args.quality)
+  if seconds is not None and args.profile is not None:
+    for face, faceSeconds in seconds.items():
+      sys.stderr.write('save %-11s %9.3fs\n' % (face, faceSeconds))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file